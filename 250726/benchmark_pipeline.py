@@ -0,0 +1,263 @@
+# benchmark_pipeline.py
+# ローカルのモックサーバー（mock_openai_server.py）を相手に、3つのフェーズのスループットを計測するベンチマーク。
+# APIキーもネットワークも使わずに、並列化・キャッシュ・リトライなどの変更による速度の変化を確認できる。
+# 各計測は、一時ディレクトリを作業ディレクトリとする別プロセスで実行する（キャッシュや集計が計測間で混ざらないようにするため）。
+
+import argparse
+import glob
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from mock_openai_server import MockOpenAIServer, add_behavior_arguments, behavior_from_args, synthetic_qa_record
+
+PHASE_UNITS = {"A": "QAペア", "B": "ペルソナ", "C": "ターン"}
+# ベンチマークではローカルのレート制限を実質的に外し、モックサーバーの遅延と429だけで律速させる
+UNLIMITED_REQUESTS_PER_MINUTE = 10 ** 7
+UNLIMITED_TOKENS_PER_MINUTE = 10 ** 10
+
+
+# ---------------------------------
+# 計測用の入力データ（フェーズB・C）
+# ---------------------------------
+def write_synthetic_qa_pairs(path, num_personas, other_facts_per_persona=4, seed=0):
+    """フェーズBの入力として、ペルソナ数に見合う件数のQAペア（JSONL）を合成する"""
+    import generate_qa_5000_in_colab as qa
+    import create_pilot_personas_v4_api as personas
+    rng = random.Random(seed)
+    records = [synthetic_qa_record(category, rng, tier=3)
+               for category in personas.Config.ANCHOR_CATEGORIES for _ in range(num_personas)]
+    other_plan = [(int(tier), category) for tier, category in qa.get_full_generation_plan(num_personas * other_facts_per_persona * 2)
+                  if category not in personas.Config.ANCHOR_CATEGORIES]
+    records += [synthetic_qa_record(category, rng, tier=tier)
+                for tier, category in other_plan[:num_personas * other_facts_per_persona]]
+    with open(path, 'w', encoding='utf-8') as f:
+        for i, record in enumerate(records):
+            f.write(json.dumps({**record, "id": i + 1}, ensure_ascii=False) + "\n")
+
+
+def write_synthetic_personas(persona_dir, num_personas, other_facts_per_persona=4, seed=0):
+    """フェーズCの入力として、persona_XX.json を合成する"""
+    rng = random.Random(seed)
+    os.makedirs(persona_dir, exist_ok=True)
+    for persona_id in range(1, num_personas + 1):
+        other_facts = [
+            {**synthetic_qa_record(category, rng, tier=4), "id": persona_id * 100 + i}
+            for i, category in enumerate(rng.sample(["好きな作家・音楽・映画", "趣味・休日の過ごし方", "好きな食べ物・飲み物",
+                                                     "嫌いな食べ物・飲み物", "価値観", "人生の目標"], other_facts_per_persona))
+        ]
+        persona = {
+            "persona_id": persona_id,
+            "persona": {
+                "profile": {"name": f"ベンチ{persona_id}", "birthday": f"{rng.randint(1, 12)}月{rng.randint(1, 28)}日", "from": "東京都"},
+                "source_anchor_facts": [],
+            },
+            "other_facts": other_facts,
+        }
+        with open(os.path.join(persona_dir, f"persona_{persona_id:02d}.json"), 'w', encoding='utf-8') as f:
+            json.dump(persona, f, ensure_ascii=False)
+
+
+# ---------------------------------
+# 計測1回分（別プロセスで実行される）
+# ---------------------------------
+def _apply_limits(config, spec):
+    config.REQUESTS_PER_MINUTE = spec["requests_per_minute"]
+    config.TOKENS_PER_MINUTE = spec["tokens_per_minute"]
+    if spec.get("max_concurrency"):
+        config.MAX_CONCURRENCY = spec["max_concurrency"]
+
+
+def run_worker(spec):
+    """spec で指定された1フェーズ・1規模分の生成を実行し、所要時間と件数を result_file に書き出す"""
+    from telemetry import TELEMETRY
+    phase, scale = spec["phase"], spec["scale"]
+
+    if phase == "A":
+        import generate_qa_5000_in_colab as qa
+        _apply_limits(qa.Config, spec)
+        started = time.perf_counter()
+        qa.run_batch_generation(total_items=scale, batch_size=100, items_per_request=spec["qa_items_per_request"])
+        wall = time.perf_counter() - started
+        items = 0
+        for batch_file in glob.glob(os.path.join(qa.Config.BATCH_OUTPUT_DIR, "batch_*.json")):
+            with open(batch_file, 'r', encoding='utf-8') as f:
+                items += len(json.load(f))
+    elif phase == "B":
+        import create_pilot_personas_v4_api as personas
+        _apply_limits(personas.Config, spec)
+        write_synthetic_qa_pairs("bench_qa_pairs.jsonl", scale)
+        personas.Config.INPUT_FILE = "bench_qa_pairs.jsonl"
+        personas.Config.NUM_PERSONAS = scale
+        started = time.perf_counter()
+        personas.create_personas()
+        wall = time.perf_counter() - started
+        items = 0
+        for persona_file in glob.glob(os.path.join(personas.Config.OUTPUT_DIR, "persona_*.json")):
+            with open(persona_file, 'r', encoding='utf-8') as f:
+                profile = json.load(f)["persona"]["profile"]
+            items += len(profile) == len(personas.Config.ANCHOR_CATEGORIES)
+    elif phase == "C":
+        import generate_dialogue_v7_llm_judge as dialogue
+        _apply_limits(dialogue.Config, spec)
+        write_synthetic_personas("bench_personas", scale)
+        dialogue.Config.PERSONA_DIR = "bench_personas"
+        dialogue.Config.NUM_TURNS = spec["dialogue_turns"]
+        dialogue.Config.NUM_CANDIDATES = spec["dialogue_candidates"]
+        dialogue.Config.LONG_DIALOGUE = spec["long_dialogue"]
+        started = time.perf_counter()
+        completed, _ = dialogue.run_dialogue_generation(1, scale)
+        wall = time.perf_counter() - started
+        items = len(completed) * dialogue.Config.NUM_TURNS
+    else:
+        raise ValueError(f"不明なフェーズ: {phase}")
+
+    stats = TELEMETRY.summary().get(phase, {})
+    result = {
+        "phase": phase,
+        "scale": scale,
+        "wall_s": round(wall, 3),
+        "items": items,
+        "items_per_s": round(items / wall, 3) if wall else 0.0,
+        "api_calls": stats.get("calls", 0),
+        "errors": stats.get("errors", 0) + stats.get("error", 0),
+        "retries": stats.get("retry", 0),
+        "latency_p50_s": stats.get("latency_p50_s", 0.0),
+        "latency_p95_s": stats.get("latency_p95_s", 0.0),
+    }
+    if phase == "A":
+        result["items_per_request"] = spec["qa_items_per_request"]
+        result["prompt_tokens_per_item"] = round(stats.get("prompt_tokens", 0) / items, 1) if items else 0.0
+        result["completion_tokens_per_item"] = round(stats.get("completion_tokens", 0) / items, 1) if items else 0.0
+    elif phase == "C":
+        # 長い対話モードで、ターン数を増やしても1ターンあたりの入力トークン数が増えないことを確かめるために記録する
+        result["prompt_tokens_per_turn"] = round(stats.get("prompt_tokens", 0) / items, 1) if items else 0.0
+    with open(spec["result_file"], 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False)
+
+
+def run_measurement(spec, base_url, verbose=False):
+    """一時ディレクトリで run_worker を別プロセスとして実行し、その結果を返す"""
+    with tempfile.TemporaryDirectory(prefix=f"bench_{spec['phase']}_{spec['scale']}_") as workdir:
+        spec = {**spec, "result_file": os.path.join(workdir, "result.json")}
+        env = {**os.environ, "OPENAI_BASE_URL": base_url, "OPENAI_API_KEY": "mock-key",
+               "TQDM_DISABLE": "0" if verbose else "1"}
+        output = None if verbose else subprocess.DEVNULL
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--worker_spec", json.dumps(spec)],
+            cwd=workdir, env=env, stdout=output, stderr=output, check=True,
+        )
+        with open(spec["result_file"], 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+
+# ---------------------------------
+# 結果の表示と、前回の結果との比較
+# ---------------------------------
+def format_result(result):
+    unit = PHASE_UNITS[result["phase"]]
+    line = (
+        f"フェーズ{result['phase']} 規模 {result['scale']:>6}: {result['wall_s']:>8.1f}s / "
+        f"{result['items']}{unit} → {result['items_per_s']:.2f} {unit}/秒 / "
+        f"API呼び出し {result['api_calls']}回（429 {result.get('rate_limited', 0)}回・エラー {result['errors']}件） / "
+        f"レイテンシ p50 {result['latency_p50_s']}s・p95 {result['latency_p95_s']}s"
+    )
+    if "items_per_request" in result:
+        line += (f" / 1リクエスト {result['items_per_request']}件: 1件あたりのトークン 入力 {result['prompt_tokens_per_item']}・"
+                 f"出力 {result['completion_tokens_per_item']}")
+    if "prompt_tokens_per_turn" in result:
+        line += f" / 1ターンあたりの入力トークン {result['prompt_tokens_per_turn']}"
+    return line
+
+
+def measurement_key(result):
+    """前回の結果と突き合わせるキー（フェーズAは、1リクエストあたりの件数ごとに別の計測として扱う）"""
+    return result["phase"], result["scale"], result.get("items_per_request", 1 if result["phase"] == "A" else None)
+
+
+def find_regressions(results, baseline_results, tolerance):
+    """前回の結果と比べて、スループットが tolerance（割合）を超えて下がった計測を返す"""
+    baseline = {measurement_key(r): r for r in baseline_results}
+    regressions = []
+    for result in results:
+        previous = baseline.get(measurement_key(result))
+        if previous and previous["items_per_s"] and result["items_per_s"] < previous["items_per_s"] * (1 - tolerance):
+            regressions.append((result, previous))
+    return regressions
+
+
+def main(args):
+    measurements = []
+    if "A" in args.phases:
+        measurements += [("A", scale, k) for scale in args.qa_scales for k in args.qa_items_per_request]
+    if "B" in args.phases:
+        measurements += [("B", scale, 1) for scale in args.persona_scales]
+    if "C" in args.phases:
+        measurements += [("C", scale, 1) for scale in args.persona_scales]
+
+    results = []
+    with MockOpenAIServer(behavior_from_args(args)) as server:
+        print(f"モックサーバー: {server.base_url}")
+        for phase, scale, items_per_request in measurements:
+            spec = {
+                "phase": phase, "scale": scale, "qa_items_per_request": items_per_request, "dialogue_turns": args.dialogue_turns,
+                "dialogue_candidates": args.dialogue_candidates, "long_dialogue": args.long_dialogue,
+                "max_concurrency": args.max_concurrency,
+                "requests_per_minute": args.requests_per_minute or UNLIMITED_REQUESTS_PER_MINUTE,
+                "tokens_per_minute": args.tokens_per_minute or UNLIMITED_TOKENS_PER_MINUTE,
+            }
+            rate_limited_before = server.behavior.stats["rate_limited"]
+            result = run_measurement(spec, server.base_url, args.verbose)
+            result["rate_limited"] = server.behavior.stats["rate_limited"] - rate_limited_before
+            results.append(result)
+            print(format_result(result))
+
+    if args.output_file:
+        with open(args.output_file, 'w', encoding='utf-8') as f:
+            json.dump({"settings": {key: value for key, value in vars(args).items() if key != "worker_spec"},
+                       "results": results}, f, indent=2, ensure_ascii=False)
+        print(f"\n✅ 計測結果を '{args.output_file}' に保存しました。")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            regressions = find_regressions(results, json.load(f)["results"], args.tolerance)
+        if regressions:
+            print(f"\n⚠️ スループットの低下を検出しました（許容幅 {args.tolerance * 100:.0f}%）:")
+            for result, previous in regressions:
+                print(f"   - フェーズ{result['phase']} 規模 {result['scale']}: "
+                      f"{previous['items_per_s']:.2f} → {result['items_per_s']:.2f} {PHASE_UNITS[result['phase']]}/秒")
+            return 1
+        print(f"\n✅ '{args.compare}' と比べて、スループットの低下はありません。")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="モックサーバーを使って、3つのフェーズのスループットを計測するベンチマーク")
+    parser.add_argument('--phases', nargs='+', choices=["A", "B", "C"], default=["A", "B", "C"], help='計測するフェーズ')
+    parser.add_argument('--qa_scales', nargs='+', type=int, default=[100, 5000, 50000], help='フェーズAで生成するQAペアの件数')
+    parser.add_argument('--qa_items_per_request', nargs='+', type=int, default=[1],
+                        help='フェーズAで1回のリクエストで生成するQAペアの件数（複数指定すると、それぞれの件数で計測して比べる）')
+    parser.add_argument('--persona_scales', nargs='+', type=int, default=[10, 100, 1000], help='フェーズB・Cのペルソナ数')
+    parser.add_argument('--dialogue_turns', type=int, default=20, help='フェーズCの1対話あたりのターン数（15以上）')
+    parser.add_argument('--dialogue_candidates', type=int, default=1, help='フェーズCのユーザー発話の候補数（Config.NUM_CANDIDATES）')
+    parser.add_argument('--long_dialogue', action='store_true', help='フェーズCを長い対話モード（Config.LONG_DIALOGUE）で計測する')
+    parser.add_argument('--max_concurrency', type=int, default=None, help='各スクリプトの同時実行数（省略時は各スクリプトの設定値）')
+    parser.add_argument('--requests_per_minute', type=int, default=None, help='ローカルのレート制限（省略時は制限なし）')
+    parser.add_argument('--tokens_per_minute', type=int, default=None, help='ローカルのトークン数制限（省略時は制限なし）')
+    parser.add_argument('--output_file', type=str, default="benchmark_results.json", help='計測結果の保存先')
+    parser.add_argument('--compare', type=str, default=None, help='比較する前回の計測結果ファイル')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='スループットの低下とみなさない許容幅（割合）')
+    parser.add_argument('--verbose', action='store_true', help='各スクリプトの出力と進捗バーをそのまま表示する')
+    parser.add_argument('--worker_spec', type=str, default=None, help=argparse.SUPPRESS)
+    add_behavior_arguments(parser)
+    args = parser.parse_args()
+
+    if args.worker_spec:
+        run_worker(json.loads(args.worker_spec))
+    else:
+        if "C" in args.phases and args.dialogue_turns < 15:
+            parser.error("--dialogue_turns は15以上を指定してください")
+        sys.exit(main(args))
@@ -0,0 +1,286 @@
+# budget.py
+
+import threading
+from collections import Counter, defaultdict
+from client_wrapper import ClientWrapper
+from telemetry import MODEL_PRICING, estimate_cost
+
+try:
+    # 入っていれば、OpenAIのモデルと同じトークナイザーでプロンプトを数える
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# chat形式の1メッセージあたりに付く付加トークン（ロールと区切り）と、応答の開始に付くトークンの目安
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+# 予約に使う、max_tokens を指定しない呼び出しの生成トークン数の上限の目安
+DEFAULT_RESERVED_COMPLETION_TOKENS = 500
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+
+def _encoding(model):
+    """モデルのトークナイザー（読み込めなければ None）。ワーカースレッド間で共有し、モデルごとに1回だけ読み込む"""
+    if model in _encodings:
+        return _encodings[model]
+    with _encodings_lock:
+        if model not in _encodings:
+            try:
+                try:
+                    encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    encoding = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                # オフライン環境などでトークナイザーの定義を取得できない場合は、tiktoken が無い場合と同じ目安で数える
+                print(f"⚠️ tiktoken のトークナイザーを読み込めないため、1文字1トークンの目安で数えます: {e}")
+                encoding = None
+            _encodings[model] = encoding
+        return _encodings[model]
+
+
+def count_text_tokens(text, model=None):
+    """テキストのトークン数。tiktoken が無い（使えない）環境では、日本語のおおよその目安として1文字1トークンで数える"""
+    text = str(text or "")
+    encoding = _encoding(model) if tiktoken is not None else None
+    if encoding is None:
+        return len(text)
+    return len(encoding.encode(text))
+
+
+def count_message_tokens(messages, model=None):
+    """chat.completions に送るメッセージ列の入力トークン数"""
+    return sum(TOKENS_PER_MESSAGE + count_text_tokens(m.get("content"), model) for m in messages) + TOKENS_PER_REPLY
+
+
+class CostEstimate:
+    """
+    実行前の見積もり（ドライラン）の集計。
+    実際に送るプロンプトを組み立てて数えた入力トークン数と、想定する生成トークン数を、呼び出しの種類ごとに
+    「想定」（Config の想定再試行率などによる期待値）と「最大」（再試行をすべて使い切った場合）の2通りで積み上げる。
+    """
+
+    def __init__(self, title):
+        self.title = title
+        self.rows = defaultdict(Counter)
+        self.models = {}
+        self.notes = []
+
+    def add(self, label, model, prompt_tokens, completion_tokens, expected_calls=1.0, max_calls=1):
+        """1回あたり prompt_tokens / completion_tokens の呼び出しを、想定 expected_calls 回・最大 max_calls 回として加える"""
+        row = self.rows[label]
+        self.models[label] = model
+        row["calls"] += expected_calls
+        row["prompt_tokens"] += prompt_tokens * expected_calls
+        row["completion_tokens"] += completion_tokens * expected_calls
+        row["max_calls"] += max_calls
+        row["max_prompt_tokens"] += prompt_tokens * max_calls
+        row["max_completion_tokens"] += completion_tokens * max_calls
+
+    def note(self, text):
+        self.notes.append(text)
+
+    def merge(self, other):
+        """他のフェーズの見積もりを、呼び出しの種類の名前にそのフェーズの名前（タイトルの括弧より前）を付けて合算する"""
+        phase = other.title.split("（")[0]
+        for label, row in other.rows.items():
+            self.rows[f"{phase} {label}"].update(row)
+            self.models[f"{phase} {label}"] = other.models[label]
+        self.notes.extend(f"{phase}: {note}" for note in other.notes)
+
+    def _cost(self, label, prefix=""):
+        row = self.rows[label]
+        return estimate_cost(self.models[label], row[f"{prefix}prompt_tokens"], row[f"{prefix}completion_tokens"])
+
+    def totals(self):
+        """{"calls", "prompt_tokens", "completion_tokens", "cost_usd"} と、その最大値（max_ で始まるキー）"""
+        totals = Counter()
+        for label, row in self.rows.items():
+            totals.update(row)
+            totals["cost_usd"] += self._cost(label)
+            totals["max_cost_usd"] += self._cost(label, "max_")
+        return totals
+
+    def format(self, max_cost_usd=None):
+        """見積もりの表示。max_cost_usd（予算の上限）を渡した場合は、想定・最大のコストが収まるかも表示する"""
+        lines = [f"--- 実行前の見積もり: {self.title} ---"]
+        for label, row in self.rows.items():
+            lines.append(
+                f"   - {label}（{self.models[label]}）: 想定 {round(row['calls'])}回・入力 {round(row['prompt_tokens'])}・"
+                f"出力 {round(row['completion_tokens'])}トークン → ${self._cost(label):.4f} / "
+                f"最大 {row['max_calls']}回 → ${self._cost(label, 'max_'):.4f}"
+            )
+        totals = self.totals()
+        lines.append(
+            f"合計: 想定 API呼び出し {round(totals['calls'])}回 / 入力 {round(totals['prompt_tokens'])}・"
+            f"出力 {round(totals['completion_tokens'])}トークン / 推定コスト ${totals['cost_usd']:.4f}"
+            f"（再試行をすべて使い切った場合の最大 ${totals['max_cost_usd']:.4f}）"
+        )
+        if max_cost_usd is not None:
+            if totals["max_cost_usd"] <= max_cost_usd:
+                verdict = "最大の場合も収まります"
+            elif totals["cost_usd"] <= max_cost_usd:
+                verdict = "想定どおりなら収まりますが、再試行が多いと途中で停止します"
+            else:
+                verdict = "想定のコストが上限を超えるため、途中で停止します"
+            lines.append(f"予算の上限 ${max_cost_usd:.4f}: {verdict}")
+        lines.append("   ※ 応答キャッシュのヒットとプロンプトキャッシュの割引は見込んでいないため、実際のコストはこれより低くなることがあります。")
+        unpriced = sorted({model for model in self.models.values() if model not in MODEL_PRICING})
+        if unpriced:
+            lines.append(f"   ※ 料金表（telemetry.MODEL_PRICING）にないモデル {unpriced} は $0 として計算しています。")
+        if tiktoken is None or None in _encodings.values():
+            lines.append("   ※ tiktoken が無い（使えない）ため、トークン数は1文字1トークンの目安で数えています（pip install tiktoken で正確になります）。")
+        lines.extend(f"   ※ {note}" for note in self.notes)
+        return "\n".join(lines)
+
+
+class BudgetExceeded(Exception):
+    """
+    予算の上限に達したため、API呼び出しを行わなかったことを表す。
+    再試行しても成功しないため、各フェーズはこの例外を項目の失敗として記録せずに中断し、次回の実行での再開に備える。
+    """
+
+
+class CostBudget:
+    """
+    実行全体で共有する、推定コスト（USD）とトークン数の上限。
+    呼び出しの前に、入力トークン数と生成トークン数の上限（max_tokens）による見積もりを予約し、
+    予約済みの分と合わせて上限を超える呼び出しは BudgetExceeded で止める。応答が返ったら、実際の usage で精算する。
+    一度上限に達したら、それ以降の呼び出しはすべて止める（小さな呼び出しだけが続けて通ることはない。
+    ただし、料金のかからない応答キャッシュのヒットは BudgetedClient が通す）。
+    """
+
+    def __init__(self, max_cost_usd=None, max_tokens=None):
+        self.max_cost_usd = max_cost_usd
+        self.max_tokens = max_tokens
+        self.spent_usd = 0.0
+        self.spent_tokens = 0
+        self.exhausted = False
+        self.stats = Counter()
+        self._reserved_usd = 0.0
+        self._reserved_tokens = 0
+        self._lock = threading.Lock()
+
+    def require_pricing(self, models):
+        """
+        USDの上限がある場合に、料金表（telemetry.MODEL_PRICING）に無いモデルがあれば ValueError を送出する
+        （料金の分からないモデルを $0 として数えると、上限に達しないまま呼び出し続けてしまうため）
+        """
+        unpriced = sorted({model for model in models if model not in MODEL_PRICING})
+        if self.max_cost_usd is not None and unpriced:
+            raise ValueError(
+                f"予算の上限（${self.max_cost_usd}）が指定されていますが、モデル {unpriced} の料金が telemetry.MODEL_PRICING にありません。"
+                'Config.MODEL_ROUTES の該当する役割に "pricing": {"input": ..., "cached_input": ..., "output": ...}'
+                "（100万トークンあたりのUSD）を指定してください。"
+            )
+
+    def _estimate(self, params):
+        model = params.get("model")
+        prompt_tokens = count_message_tokens(params.get("messages", []), model)
+        completion_tokens = params.get("max_tokens", DEFAULT_RESERVED_COMPLETION_TOKENS) * params.get("n", 1)
+        return prompt_tokens + completion_tokens, estimate_cost(model, prompt_tokens, completion_tokens)
+
+    @property
+    def limited(self):
+        return self.max_cost_usd is not None or self.max_tokens is not None
+
+    def reserve(self, params):
+        """
+        呼び出しの見積もりを予約して返す。予約すると上限を超える場合は BudgetExceeded を送出する。
+        上限が無い場合は、プロンプトのトークン数を数えずに (0, 0.0) を返す（消費量は settle で usage から計上する）
+        """
+        if not self.limited:
+            return 0, 0.0
+        tokens, cost = self._estimate(params)
+        with self._lock:
+            over_cost = self.max_cost_usd is not None and self.spent_usd + self._reserved_usd + cost > self.max_cost_usd
+            over_tokens = self.max_tokens is not None and self.spent_tokens + self._reserved_tokens + tokens > self.max_tokens
+            if self.exhausted or over_cost or over_tokens:
+                self.exhausted = True
+                raise BudgetExceeded(
+                    f"予算の上限に達しました（推定コスト ${self.spent_usd:.4f} / 上限 {self._format_limit()}）"
+                )
+            self._reserved_usd += cost
+            self._reserved_tokens += tokens
+        return tokens, cost
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def release(self, reservation):
+        """応答が得られなかった呼び出し・応答キャッシュから返した呼び出しの予約を取り消す"""
+        tokens, cost = reservation
+        with self._lock:
+            self._reserved_usd -= cost
+            self._reserved_tokens -= tokens
+
+    def settle(self, reservation, model, response):
+        """予約を取り消し、応答の usage から実際のトークン数とコストを計上する（usage が無ければ予約分を計上する）"""
+        tokens, cost = reservation
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+            completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+            cached_tokens = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", 0) or 0
+            actual_tokens = prompt_tokens + completion_tokens
+            actual_cost = estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens)
+        else:
+            actual_tokens, actual_cost = tokens, cost
+        with self._lock:
+            self._reserved_usd -= cost
+            self._reserved_tokens -= tokens
+            self.spent_usd += actual_cost
+            self.spent_tokens += actual_tokens
+            self.stats["calls"] += 1
+
+    def _format_limit(self):
+        limits = []
+        if self.max_cost_usd is not None:
+            limits.append(f"${self.max_cost_usd:.4f}")
+        if self.max_tokens is not None:
+            limits.append(f"{self.max_tokens}トークン")
+        return "・".join(limits) or "なし"
+
+    def format_stats(self):
+        return (
+            f"予算: 推定コスト ${self.spent_usd:.4f}・トークン {self.spent_tokens}（API呼び出し {self.stats['calls']}回） / "
+            f"上限 {self._format_limit()}"
+            + (f" / 上限に達したため止めた呼び出し {self.stats['refused']}回" if self.exhausted else "")
+            + (f"（上限に達した後に応答キャッシュから返した呼び出し {self.stats['cache_hits_after_limit']}回）"
+               if self.stats["cache_hits_after_limit"] else "")
+        )
+
+
+class BudgetedClient(ClientWrapper):
+    """
+    呼び出しごとに CostBudget の枠を予約してから内側のクライアント（計測・応答キャッシュ・レート制限）に渡す。
+    最も外側に置くため、上限で止めた呼び出しはAPI呼び出しとして計測されない。
+    応答キャッシュから返した呼び出しは予算を消費せず、上限に達した後も応答キャッシュにある呼び出しは通す。
+    """
+
+    def __init__(self, client, budget):
+        super().__init__(client)
+        self.budget = budget
+
+    def create(self, **params):
+        try:
+            reservation = self.budget.reserve(params)
+        except BudgetExceeded:
+            lookup_cached = getattr(self.client, "lookup_cached", None)
+            response = lookup_cached(**params) if lookup_cached is not None else None
+            self.budget.count("refused" if response is None else "cache_hits_after_limit")
+            if response is None:
+                raise
+            return response
+        try:
+            response = self.client.chat.completions.create(**params)
+        except Exception:
+            self.budget.release(reservation)
+            raise
+        if getattr(response, "cache_hit", False):
+            self.budget.release(reservation)
+        else:
+            self.budget.settle(reservation, params.get("model"), response)
+        return response
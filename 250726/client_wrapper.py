@@ -0,0 +1,24 @@
+# client_wrapper.py
+
+from types import SimpleNamespace
+
+
+class ClientWrapper:
+    """
+    OpenAIクライアントと同じ `client.chat.completions.create(...)` の形で呼び出せるラッパーの基底クラス。
+    サブクラスは create(**params) で処理を加えてから、内側のクライアント（self.client）にリクエストを渡す。
+    ラッパーに無い属性は内側のクライアントから参照するため、最も外側から cache・governor・budget などを辿れる。
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def __getattr__(self, name):
+        # self.client が未設定のまま参照された場合に、無限に再帰しないようにする
+        if name == "client":
+            raise AttributeError(name)
+        return getattr(self.client, name)
+
+    def create(self, **params):
+        return self.client.chat.completions.create(**params)
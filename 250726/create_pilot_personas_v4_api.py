@@ -3,28 +3,41 @@
 import json
 import os
 import random
-import time
-from openai import OpenAI
+import re
+import unicodedata
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from tqdm.auto import tqdm
+from llm_backend import ClientConfig, build_client
+from telemetry import TELEMETRY
+from dataset_store import ShardedStore, open_store, close_stores
+from budget import BudgetExceeded, CostEstimate, count_message_tokens
+from prefectures import PREFECTURES
 
-class Config:
+class Config(ClientConfig):
     """設定を管理するクラス"""
-    try:
-        from google.colab import userdata
-        API_KEY = userdata.get("OPENAI-KEY")
-    except (ImportError, KeyError):
-        API_KEY = os.environ.get("OPENAI_API_KEY", "YOUR_API_KEY_HERE")
-    
-    LLM_MODEL = "gpt-4o"
+    # 役割ごとのモデルと接続先（API_KEY・BASE_URL・レート制限・再試行・応答キャッシュ・予算の上限などの共通の設定は、
+    # llm_backend.py の ClientConfig を参照）
+    MODEL_ROUTES = {
+        "extractor": {"model": "gpt-4o"},
+    }
     INPUT_FILE = "QA_pairs_100_final.json"
     OUTPUT_DIR = "pilot_personas"
+    # 出力形式。"files" はペルソナごとの persona_XX.json、"sharded" は STORE_DIR のシャード形式のデータセット（dataset_store.py）
+    OUTPUT_FORMAT = "files"
+    STORE_DIR = "pilot_dataset/personas"
+    STORE_COMPRESSION = None # "gzip" で圧縮する
     NUM_PERSONAS = 10
     ANCHOR_CATEGORIES = ["ユーザーの名前", "誕生日", "出身地"]
+    ANCHOR_KEY_MAP = {"ユーザーの名前": "name", "誕生日": "birthday", "出身地": "from"}
+    # 並列抽出の設定（同時に処理するペルソナ数と、1分あたりの上限）
+    MAX_CONCURRENCY = 8
+    # ドライラン（--dry_run）の見積もりに使う、1回の抽出の生成トークン数と、入力ファイルが無い場合のアンカー情報の文章の長さ
+    ESTIMATED_COMPLETION_TOKENS = 50
+    ESTIMATED_ANSWER_TOKENS = 120
 
-def extract_core_info_with_api(client, category, answer_text):
-    """
-    【v4の核心機能 - あなたの提案】
-    OpenAI APIを使い、answerの文章から核心的な情報（名前、日付など）を抽出する。
-    """
+def build_core_info_request(category, answer_text):
+    """1件のアンカー情報を抽出するリクエストのパラメータを作る（不明なカテゴリなら None）"""
     system_prompt = "あなたは、与えられた文章から特定の情報を正確に抽出する専門家です。"
     
     # カテゴリに応じた抽出指示
@@ -51,36 +64,214 @@ def extract_core_info_with_api(client, category, answer_text):
   "core_info": "抽出した情報"
 }}
 """
+    return {
+        "model": Config.MODEL_ROUTES["extractor"]["model"],
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        "response_format": {"type": "json_object"},
+        "temperature": 0.0, # 抽出タスクなので創造性は不要
+    }
+
+def extract_core_info_with_api(client, category, answer_text):
+    """
+    【v4の核心機能 - あなたの提案】
+    OpenAI APIを使い、answerの文章から核心的な情報（名前、日付など）を抽出する。
+    """
+    request = build_core_info_request(category, answer_text)
+    if request is None:
+        return None # 不明なカテゴリ
     try:
-        response = client.chat.completions.create(
-            model=Config.LLM_MODEL,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            response_format={"type": "json_object"},
-            temperature=0.0 # 抽出タスクなので創造性は不要
-        )
+        response = client.chat.completions.create(**request)
         extracted_data = json.loads(response.choices[0].message.content)
         return extracted_data.get("core_info")
+    except BudgetExceeded:
+        # 予算の上限による停止は、抽出の失敗として扱わずに呼び出し元に伝える
+        raise
     except Exception as e:
         print(f"  - API抽出エラー: {e}")
+        TELEMETRY.record_error(e)
         return None
 
-def create_personas():
+# 正規表現による事前抽出（曖昧さなく1つに決まる場合だけ採用し、APIの呼び出しを省く）
+DATE_PATTERN = re.compile(r"(\d{1,2})月(\d{1,2})日")
+NAME_PATTERN = re.compile(r"名前は、?[「『]?([^\s、。「」『』はがをにでのと]{1,10}?)[」』]?(?:さん|くん|君|ちゃん|様)")
+# 出身地は、実在の都道府県名で始まる場合だけ採用する（「下町生まれ」「港町生まれ」などはAPIに回す）。
+# 市区町村名は最長一致で続けて取り込み、「大阪府堺市」が「大阪府」で切れないようにする
+PREFECTURE_PATTERN = (
+    r"(?<![^\s、。「」『』はがをにでのとも])(?:北海道|(?:"
+    + "|".join(sorted((p for p in PREFECTURES if p != "北海道"), key=len, reverse=True))
+    + r")[都府県]?)"
+)
+PLACE_PATTERN = PREFECTURE_PATTERN + r"(?:[^\s、。「」『』はがをにでのとも]{1,10}[市区町村])?"
+PLACE_PATTERNS = [
+    re.compile(r"(" + PLACE_PATTERN + r")(?:の)?(?:出身|生まれ)"),
+    re.compile(r"出身(?:地)?は、?[「『]?(" + PLACE_PATTERN + r")"),
+]
+
+def pre_extract_core_info(category, answer_text):
+    """正規表現で核心情報を抽出する。候補が1つに決まらない場合は None を返す"""
+    text = unicodedata.normalize("NFKC", answer_text)
+    if category == "誕生日":
+        candidates = {f"{int(m)}月{int(d)}日" for m, d in DATE_PATTERN.findall(text)}
+    elif category == "ユーザーの名前":
+        candidates = set(NAME_PATTERN.findall(text))
+    elif category == "出身地":
+        candidates = {claim for pattern in PLACE_PATTERNS for claim in pattern.findall(text)}
+        # 「大阪生まれ…出身は大阪府堺市」のように、同じ地名を詳しく言い直しただけなら、最も長いものを採用する
+        longest = max(candidates, key=len, default=None)
+        if longest and all(longest.startswith(claim) for claim in candidates):
+            return longest
+        return None
+    else:
+        return None
+    return candidates.pop() if len(candidates) == 1 else None
+
+def build_anchors_request(anchor_facts):
+    """複数のアンカー情報（{カテゴリ: answerの文章}）をまとめて抽出するリクエストのパラメータを作る"""
+    system_prompt = "あなたは、与えられた文章から特定の情報を正確に抽出する専門家です。"
+    instructions = {
+        "ユーザーの名前": "ユーザーの名前だけを抽出してください。敬称（さん、くんなど）や読み仮名は含めないでください。",
+        "誕生日": "誕生日（日付）だけを「X月X日」の形式で抽出してください。",
+        "出身地": "出身地（都道府県や市町村名）だけを抽出してください。",
+    }
+    sections = []
+    output_fields = []
+    for category, answer_text in anchor_facts.items():
+        key = Config.ANCHOR_KEY_MAP[category]
+        sections.append(f"## {key}\n# 指示\n{instructions[category]}\n# 文章\n{answer_text}")
+        output_fields.append(f'  "{key}": "抽出した情報"')
+    user_prompt = (
+        "以下の各文章から、それぞれの指示に従って核心的な情報だけを抽出し、JSON形式で出力してください。\n\n"
+        + "\n\n".join(sections)
+        + "\n\n# 出力形式\n{\n" + ",\n".join(output_fields) + "\n}\n"
+    )
+    return {
+        "model": Config.MODEL_ROUTES["extractor"]["model"],
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        "response_format": {"type": "json_object"},
+        "temperature": 0.0, # 抽出タスクなので創造性は不要
+    }
+
+def extract_persona_anchors_with_api(client, anchor_facts):
     """
-    【v4】QAペアからAPIで核心情報を抽出し、クリーンなペルソナを生成する
+    1ペルソナ分の複数のアンカー情報（名前・誕生日・出身地）を、1回のAPI呼び出しでまとめて抽出する。
+    anchor_facts は {カテゴリ: answerの文章}。戻り値は {カテゴリ: 抽出した情報}。
     """
-    print("--- パイロット・ペルソナ生成 (v4 - API抽出) を開始します ---")
-    client = OpenAI(api_key=Config.API_KEY)
-
     try:
-        with open(Config.INPUT_FILE, 'r', encoding='utf-8') as f:
-            all_qa_pairs = json.load(f)
-    except FileNotFoundError:
-        print(f"❌ エラー: 入力ファイル '{Config.INPUT_FILE}' が見つかりません。")
-        return
+        response = client.chat.completions.create(**build_anchors_request(anchor_facts))
+        extracted_data = json.loads(response.choices[0].message.content)
+        return {category: extracted_data.get(Config.ANCHOR_KEY_MAP[category]) for category in anchor_facts}
+    except BudgetExceeded:
+        raise
+    except Exception as e:
+        print(f"  - API抽出エラー: {e}")
+        TELEMETRY.record_error(e)
+        return {}
+
+def extract_persona_profile(client, source_anchor_facts):
+    """
+    1ペルソナ分のアンカー情報を抽出し、(profile, 抽出方法の内訳) を返す。
+    正規表現で決まらなかったカテゴリだけをAPIに回し、2つ以上残った場合は1回の呼び出しにまとめる。
+    """
+    profile, stats = {}, Counter()
+    remaining = {}
+    for fact_qa in source_anchor_facts:
+        category = fact_qa['category']
+        core_info = pre_extract_core_info(category, fact_qa['answer'])
+        if core_info:
+            profile[Config.ANCHOR_KEY_MAP[category]] = core_info
+            stats["regex"] += 1
+        else:
+            remaining[category] = fact_qa['answer']
+
+    if len(remaining) == 1:
+        category, answer_text = next(iter(remaining.items()))
+        extracted = {category: extract_core_info_with_api(client, category, answer_text)}
+        stats["api_calls"] += 1
+    elif remaining:
+        extracted = extract_persona_anchors_with_api(client, remaining)
+        stats["api_calls"] += 1
+    else:
+        extracted = {}
+
+    for category in remaining:
+        core_info = extracted.get(category)
+        if core_info:
+            profile[Config.ANCHOR_KEY_MAP[category]] = core_info
+            stats["api"] += 1
+        else:
+            stats["failed"] += 1
+    # プロフィールのキーの順序は、常に Config.ANCHOR_CATEGORIES の順にそろえる
+    ordered_keys = [Config.ANCHOR_KEY_MAP[category] for category in Config.ANCHOR_CATEGORIES]
+    return {key: profile[key] for key in ordered_keys if key in profile}, stats
 
+def load_qa_pairs(filepath):
+    """
+    結合済みQAファイルを読み込む
+    （merge_batches.py のJSONL形式・シャード形式のデータセットのディレクトリと、従来のJSON配列形式に対応）
+    """
+    if os.path.isdir(filepath):
+        return list(ShardedStore(filepath, readonly=True).iter_records())
+    with open(filepath, 'r', encoding='utf-8') as f:
+        if filepath.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+def build_persona(persona_id, source_anchor_facts, other_facts=()):
+    """ペルソナ1人分のデータ（プロフィールは未抽出）を作る"""
+    return {
+        "persona_id": persona_id,
+        "persona": {
+            "profile": {},
+            "source_anchor_facts": list(source_anchor_facts),
+        },
+        "other_facts": list(other_facts)
+    }
+
+def fill_persona_profile(client, persona):
+    """アンカー情報からプロフィールを抽出してペルソナに設定し、抽出方法の内訳を返す"""
+    with TELEMETRY.tags(phase="B", persona_id=persona["persona_id"]):
+        profile, stats = extract_persona_profile(client, persona["persona"]["source_anchor_facts"])
+    persona["persona"]["profile"] = profile
+    if stats["failed"]:
+        TELEMETRY.event("extraction_failed", phase="B", persona_id=persona["persona_id"], count=stats["failed"])
+        print(f"  - ペルソナ{persona['persona_id']}: {stats['failed']}件の抽出に失敗しました。")
+    return stats
+
+def persona_output_path(persona_id):
+    return os.path.join(Config.OUTPUT_DIR, f"persona_{persona_id:02d}.json")
+
+def persona_store():
+    return open_store(Config.STORE_DIR, key="persona_id", compression=Config.STORE_COMPRESSION)
+
+def persona_exists(persona_id):
+    if Config.OUTPUT_FORMAT == "sharded":
+        return persona_id in persona_store()
+    return os.path.exists(persona_output_path(persona_id))
+
+def save_persona(persona):
+    """
+    ペルソナを一時ファイル経由で書き出す（書き出し途中のファイルを後段のフェーズに読ませない）。
+    Config.OUTPUT_FORMAT が "sharded" の場合は、データセットに1件追加する。
+    """
+    if Config.OUTPUT_FORMAT == "sharded":
+        persona_store().put(persona)
+        return f"{Config.STORE_DIR}#{persona['persona_id']}"
+    os.makedirs(Config.OUTPUT_DIR, exist_ok=True)
+    output_filename = persona_output_path(persona["persona_id"])
+    tmp_filename = output_filename + ".tmp"
+    with open(tmp_filename, 'w', encoding='utf-8') as f:
+        json.dump(persona, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_filename, output_filename)
+    return output_filename
+
+def split_fact_pools(all_qa_pairs):
+    """QAペアを、アンカー（名前・誕生日・出身地）ごとのプールと、その他の事実のプールに振り分ける"""
     anchor_facts_pool = {category: [] for category in Config.ANCHOR_CATEGORIES}
     other_facts_pool = []
     for qa in all_qa_pairs:
@@ -89,52 +280,122 @@ def create_personas():
             anchor_facts_pool[category].append(qa)
         else:
             other_facts_pool.append(qa)
+    return anchor_facts_pool, other_facts_pool
+
+def estimate_persona_extraction():
+    """
+    create_personas を実行した場合のAPI呼び出し数・トークン数・コストを、APIを呼ばずに見積もる（ドライラン）。
+    入力ファイルがあれば、各アンカーの先頭から Config.NUM_PERSONAS 人分を正規表現で事前抽出し、APIに回る分だけ実際のプロンプトを数える
+    （実行時は割り当てをシャッフルするため、同じQAペアからの標本による見積もりになる）。
+    入力ファイルが無い場合は、全ペルソナで3件のアンカー情報をまとめてAPIで抽出するとして見積もる。
+    """
+    model = Config.MODEL_ROUTES["extractor"]["model"]
+    estimate = CostEstimate(f"フェーズB（ペルソナ {Config.NUM_PERSONAS}人）")
+    try:
+        anchor_facts_pool, _ = split_fact_pools(load_qa_pairs(Config.INPUT_FILE))
+    except FileNotFoundError:
+        request = build_anchors_request({category: "" for category in Config.ANCHOR_CATEGORIES})
+        prompt_tokens = count_message_tokens(request["messages"], model) + Config.ESTIMATED_ANSWER_TOKENS * len(Config.ANCHOR_CATEGORIES)
+        estimate.add("アンカー情報抽出", model, prompt_tokens, Config.ESTIMATED_COMPLETION_TOKENS,
+                     expected_calls=Config.NUM_PERSONAS, max_calls=Config.NUM_PERSONAS)
+        estimate.note(f"入力ファイル '{Config.INPUT_FILE}' が無いため、正規表現による事前抽出がすべて外れる場合として見積もっています。")
+        return estimate
 
-    personas = []
     for i in range(Config.NUM_PERSONAS):
-        persona_data = {
-            "persona_id": i + 1,
-            "persona": {
-                "profile": {},
-                "source_anchor_facts": [],
-            },
-            "other_facts": []
+        remaining = {
+            category: pool[i]['answer'] for category, pool in anchor_facts_pool.items()
+            if i < len(pool) and not pre_extract_core_info(category, pool[i]['answer'])
         }
+        if len(remaining) == 1:
+            request = build_core_info_request(*next(iter(remaining.items())))
+        elif remaining:
+            request = build_anchors_request(remaining)
+        else:
+            continue
+        estimate.add("アンカー情報抽出", model, count_message_tokens(request["messages"], model), Config.ESTIMATED_COMPLETION_TOKENS)
+    return estimate
+
+def create_personas():
+    """
+    【v4】QAペアからAPIで核心情報を抽出し、クリーンなペルソナを生成する
+    （正規表現で決まる情報はAPIを使わず、残りはペルソナ単位でまとめて並列に抽出する）
+    """
+    print("--- パイロット・ペルソナ生成 (v4 - API抽出) を開始します ---")
+    client = build_client(Config)
+    TELEMETRY.start(Config.TRACE_FILE)
+
+    try:
+        all_qa_pairs = load_qa_pairs(Config.INPUT_FILE)
+    except FileNotFoundError:
+        print(f"❌ エラー: 入力ファイル '{Config.INPUT_FILE}' が見つかりません。")
+        return
+
+    anchor_facts_pool, other_facts_pool = split_fact_pools(all_qa_pairs)
 
-        for category in Config.ANCHOR_CATEGORIES:
-            if anchor_facts_pool[category]:
-                fact_qa = random.choice(anchor_facts_pool[category])
-                
-                print(f"ペルソナ{i+1}: 「{category}」の情報を抽出中...")
-                # APIを使って核心情報を抽出
-                core_info = extract_core_info_with_api(client, fact_qa['category'], fact_qa['answer'])
-                
-                if core_info:
-                    key_map = {"ユーザーの名前": "name", "誕生日": "birthday", "出身地": "from"}
-                    persona_data["persona"]["profile"][key_map[category]] = core_info
-                else:
-                    print(f"  - 抽出に失敗しました。")
-                    
-                persona_data["persona"]["source_anchor_facts"].append(fact_qa)
-                anchor_facts_pool[category].remove(fact_qa)
-                time.sleep(1) # APIへの負荷軽減
-        
-        personas.append(persona_data)
+    # 各アンカーのプールを一度だけシャッフルし、i番目のペルソナにi番目の事実を割り当てる
+    # （list.remove を使わない、O(1)の非復元抽出）
+    for pool in anchor_facts_pool.values():
+        random.shuffle(pool)
+
+    personas = []
+    for i in range(Config.NUM_PERSONAS):
+        personas.append(build_persona(i + 1, [
+            anchor_facts_pool[category][i]
+            for category in Config.ANCHOR_CATEGORIES if i < len(anchor_facts_pool[category])
+        ]))
+
+    # ペルソナごとの抽出を並列に実行する（APIへの負荷は RateLimiter で調整）
+    extraction_stats = Counter()
+    try:
+        with ThreadPoolExecutor(max_workers=Config.MAX_CONCURRENCY) as executor:
+            results = executor.map(lambda persona: fill_persona_profile(client, persona), personas)
+            for stats in tqdm(results, total=len(personas), desc="アンカー情報抽出中"):
+                extraction_stats.update(stats)
+    except BudgetExceeded as e:
+        # プロフィールが揃っていないペルソナを後段に渡さないよう、1人も書き出さずに停止する
+        print(f"\n⏸ {e}。ペルソナを書き出さずに停止します。")
+        print(client.budget.format_stats())
+        TELEMETRY.close()
+        print("   ※ 抽出済みの結果は応答キャッシュに残っているため、上限を見直して再実行すれば、その分は料金がかかりません。")
+        return
 
     random.shuffle(other_facts_pool)
     for i, fact in enumerate(other_facts_pool):
         persona_index = i % Config.NUM_PERSONAS
         personas[persona_index]["other_facts"].append(fact)
 
-    if not os.path.exists(Config.OUTPUT_DIR):
-        os.makedirs(Config.OUTPUT_DIR)
     for persona in personas:
-        output_filename = os.path.join(Config.OUTPUT_DIR, f"persona_{persona['persona_id']:02d}.json")
-        with open(output_filename, 'w', encoding='utf-8') as f:
-            json.dump(persona, f, indent=2, ensure_ascii=False)
+        save_persona(persona)
             
-    print(f"\n✅ 全てのペルソナプロファイルを '{Config.OUTPUT_DIR}' ディレクトリに出力しました。")
+    print(f"アンカー情報の抽出: 正規表現 {extraction_stats['regex']}件 / API {extraction_stats['api']}件"
+          f"（API呼び出し {extraction_stats['api_calls']}回） / 失敗 {extraction_stats['failed']}件")
+    print(client.cache.format_stats())
+    print(client.governor.format_stats())
+    print(client.budget.format_stats())
+    print(TELEMETRY.format_summary())
+    TELEMETRY.close()
+    if Config.OUTPUT_FORMAT == "sharded":
+        print(f"\n✅ 全てのペルソナプロファイルを {persona_store().describe()} に出力しました。")
+        close_stores()
+    else:
+        print(f"\n✅ 全てのペルソナプロファイルを '{Config.OUTPUT_DIR}' ディレクトリに出力しました。")
     print("\n🎉 パイロット・ペルソナ生成 (v4 - API抽出) が完了しました！")
 
 if __name__ == "__main__":
-    create_personas()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="QAペアからペルソナプロファイルを構築する")
+    parser.add_argument('--dry_run', action='store_true', help='APIを呼ばずに、API呼び出し数・トークン数・コストの見積もりを表示する')
+    parser.add_argument('--budget_usd', type=float, default=None, help='推定コスト（USD）の上限（省略時は Config.BUDGET_USD）')
+    parser.add_argument('--budget_tokens', type=int, default=None, help='トークン数の上限（省略時は Config.BUDGET_TOKENS）')
+    # Colabのカーネルが渡す引数は無視する
+    args, _ = parser.parse_known_args()
+    if args.budget_usd is not None:
+        Config.BUDGET_USD = args.budget_usd
+    if args.budget_tokens is not None:
+        Config.BUDGET_TOKENS = args.budget_tokens
+
+    if args.dry_run:
+        print(estimate_persona_extraction().format(Config.BUDGET_USD))
+    else:
+        create_personas()
@@ -0,0 +1,428 @@
+# dataset_store.py
+
+import argparse
+import glob
+import gzip
+import json
+import mmap
+import os
+import re
+import shutil
+import threading
+import zlib
+
+INDEX_FILE = "index.json"
+SHARD_PATTERN = re.compile(r"^part-(\d{5})\.jsonl(\.gz)?$")
+
+
+class ShardedStore:
+    """
+    QAペア・ペルソナ・対話を、JSONLのシャード（part-00000.jsonl …）と、キーからバイト位置を引く索引
+    （index.json）で保存するデータセット形式。
+    * get(key) は、索引の (シャード, オフセット, 長さ) でメモリマップしたシャードを切り出し、1件だけを読む。
+    * iter_records() は、シャードを先頭から順に読むストリーミング用の反復子（学習時のデータローダー向け）。
+    * compression="gzip" の場合は、block_records 件ごとに独立したgzipメンバーとして書き込む
+      （シャード全体は通常の .gz として展開でき、1件の読み出しは1ブロック分の展開で済む）。
+    同じキーを書き直した場合は索引が新しい位置を指し、古いレコードは読み出し・反復の対象から外れる。
+    索引は flush() / close() で保存する。保存前に中断した場合も、次に開いたときに索引より後ろのシャードの
+    内容を読み直して索引を復元する（書き込み途中で切れた末尾は切り詰める）。
+    """
+
+    def __init__(self, path, key="id", compression=None, shard_records=10000, block_records=64, readonly=False):
+        if compression not in (None, "gzip"):
+            raise ValueError(f"未対応の圧縮形式です: {compression}")
+        self.path = path
+        self.readonly = readonly
+        self._lock = threading.RLock()
+        self._maps = {}
+        self._file = None
+        self._file_shard = None
+        self._pending = []
+        self._pending_keys = set()
+
+        index = self._load_index()
+        if index is None:
+            if readonly:
+                raise FileNotFoundError(f"データセットの索引が見つかりません: {os.path.join(path, INDEX_FILE)}")
+            os.makedirs(path, exist_ok=True)
+            index = {"key": key, "compression": compression, "shard_records": shard_records,
+                     "block_records": block_records, "shards": [], "entries": []}
+        # 既存のデータセットを開いた場合は、作成時の設定に従う
+        self.key = index["key"]
+        self.compression = index["compression"]
+        self.shard_records = index["shard_records"]
+        self.block_records = index["block_records"]
+        self._shards = index["shards"]
+        # 索引の1エントリは [キー, シャード番号, オフセット, 長さ, ブロック内の行番号]
+        self._entries = {str(entry[0]): entry for entry in index["entries"]}
+        self.recovered = self._recover()
+
+    # ---------------------------------
+    # 索引の読み書きと復元
+    # ---------------------------------
+    def _load_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        if not os.path.exists(index_path):
+            return None
+        with open(index_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save_index(self):
+        index = {
+            "key": self.key, "compression": self.compression, "shard_records": self.shard_records,
+            "block_records": self.block_records, "shards": self._shards, "entries": list(self._entries.values()),
+        }
+        index_path = os.path.join(self.path, INDEX_FILE)
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_path, index_path)
+
+    def _shard_path(self, number):
+        return os.path.join(self.path, self._shards[number]["name"])
+
+    def _recover(self):
+        """索引に記録されていないシャードの末尾を読み直して索引に加え、復元したレコード数を返す"""
+        known = {shard["name"] for shard in self._shards}
+        for name in sorted(os.listdir(self.path)):
+            if SHARD_PATTERN.match(name) and name not in known:
+                self._shards.append({"name": name, "records": 0, "bytes": 0})
+        recovered = 0
+        for number, shard in enumerate(self._shards):
+            size = os.path.getsize(self._shard_path(number))
+            if size == shard["bytes"]:
+                continue
+            end = shard["bytes"]
+            for offset, length, line_no, line in self._scan(number, start=shard["bytes"], end=size):
+                key = json.loads(line)[self.key]
+                self._entries[str(key)] = [key, number, offset, length, line_no]
+                shard["records"] += 1
+                recovered += 1
+                end = offset + length
+            if end < size and not self.readonly:
+                with open(self._shard_path(number), 'rb+') as f:
+                    f.truncate(end)
+            shard["bytes"] = end
+        return recovered
+
+    def _scan(self, number, start=0, end=None):
+        """シャードを先頭（start）から読み、(オフセット, 長さ, ブロック内の行番号, 1行分のJSON) を順に返す"""
+        with open(self._shard_path(number), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            end = size if end is None else min(end, size)
+            if end <= start:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                position = start
+                while position < end:
+                    if self.compression:
+                        # gzipメンバー（1ブロック）の終端は、展開し終えた時点の未使用データの長さから求める
+                        decompressor = zlib.decompressobj(wbits=31)
+                        chunks, read_to = [], position
+                        try:
+                            while not decompressor.eof and read_to < end:
+                                chunk = mm[read_to:min(end, read_to + (1 << 16))]
+                                chunks.append(decompressor.decompress(chunk))
+                                read_to += len(chunk)
+                        except zlib.error:
+                            return
+                        if not decompressor.eof:
+                            return
+                        length = read_to - position - len(decompressor.unused_data)
+                        for line_no, line in enumerate(b"".join(chunks).splitlines()):
+                            yield position, length, line_no, line
+                    else:
+                        newline = mm.find(b"\n", position, end)
+                        if newline < 0:
+                            return
+                        length = newline + 1 - position
+                        yield position, length, 0, mm[position:newline]
+                    position += length
+
+    # ---------------------------------
+    # 書き込み
+    # ---------------------------------
+    def put(self, record):
+        """レコードを1件追加する（同じキーのレコードが既にあれば、新しいほうで置き換える）"""
+        if self.readonly:
+            raise PermissionError(f"読み取り専用で開いたデータセットには書き込めません: {self.path}")
+        key = record[self.key]
+        line = json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+        with self._lock:
+            self._pending.append((key, line))
+            self._pending_keys.add(str(key))
+            if not self.compression or len(self._pending) >= self.block_records:
+                self._write_pending()
+
+    def _open_shard(self):
+        """書き込み先のシャードを開く（最後のシャードが満杯なら、新しいシャードを作る）"""
+        if not self._shards or self._shards[-1]["records"] >= self.shard_records:
+            suffix = ".gz" if self.compression else ""
+            self._shards.append({"name": f"part-{len(self._shards):05d}.jsonl{suffix}", "records": 0, "bytes": 0})
+        number = len(self._shards) - 1
+        if self._file_shard != number:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self._shard_path(number), 'ab')
+            self._file_shard = number
+        return number
+
+    def _write_pending(self):
+        if not self._pending:
+            return
+        number = self._open_shard()
+        shard = self._shards[number]
+        offset = shard["bytes"]
+        if self.compression:
+            block = gzip.compress(b"".join(line for _, line in self._pending), mtime=0)
+            self._file.write(block)
+            for line_no, (key, _) in enumerate(self._pending):
+                self._entries[str(key)] = [key, number, offset, len(block), line_no]
+            shard["bytes"] += len(block)
+        else:
+            for key, line in self._pending:
+                self._file.write(line)
+                self._entries[str(key)] = [key, number, shard["bytes"], len(line), 0]
+                shard["bytes"] += len(line)
+        shard["records"] += len(self._pending)
+        # 同じプロセス内の読み出し（メモリマップ）から、書き込んだ内容がすぐに見えるようにする
+        self._file.flush()
+        self._pending = []
+        self._pending_keys = set()
+
+    def flush(self):
+        """書き込み待ちのブロックをシャードに書き出し、索引を保存する"""
+        with self._lock:
+            if self.readonly:
+                return
+            self._write_pending()
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+            self._save_index()
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = self._file_shard = None
+            for mm in self._maps.values():
+                mm.close()
+            self._maps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ---------------------------------
+    # 読み出し
+    # ---------------------------------
+    def _map(self, number, needed):
+        """シャードのメモリマップを返す（書き込みで伸びたシャードは、必要になった時点でマップし直す）"""
+        mm = self._maps.get(number)
+        if mm is None or len(mm) < needed:
+            if mm is not None:
+                mm.close()
+            with open(self._shard_path(number), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[number] = mm
+        return mm
+
+    def get(self, key, default=None):
+        """キー（QAペアの id、ペルソナ・対話の persona_id）で1件を読み出す"""
+        with self._lock:
+            if str(key) in self._pending_keys:
+                self._write_pending()
+            entry = self._entries.get(str(key))
+            if entry is None:
+                return default
+            _, number, offset, length, line_no = entry
+            data = self._map(number, offset + length)[offset:offset + length]
+        if self.compression:
+            data = gzip.decompress(data).splitlines()[line_no]
+        return json.loads(data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return str(key) in self._entries or str(key) in self._pending_keys
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries) + len(self._pending_keys - self._entries.keys())
+
+    def keys(self):
+        """格納済みのキーを、最初に書き込まれた順に返す"""
+        with self._lock:
+            self._write_pending()
+            return [entry[0] for entry in self._entries.values()]
+
+    def iter_records(self, num_workers=1, worker_index=0):
+        """
+        全レコードを、シャードの先頭から書き込まれた順に返すストリーミング用の反復子。
+        データローダーを複数ワーカーで動かす場合は、num_workers と worker_index でシャードを分担する。
+        """
+        with self._lock:
+            self._write_pending()
+            shard_bytes = [shard["bytes"] for shard in self._shards]
+        for number in range(worker_index, len(shard_bytes), num_workers):
+            for offset, length, line_no, line in self._scan(number, end=shard_bytes[number]):
+                record = json.loads(line)
+                # 書き直されたキーの古いレコードは飛ばす
+                if self._entries.get(str(record[self.key]), [None])[1:] == [number, offset, length, line_no]:
+                    yield record
+
+    def __iter__(self):
+        return self.iter_records()
+
+    def describe(self):
+        total_bytes = sum(shard["bytes"] for shard in self._shards)
+        return (f"データセット '{self.path}': {len(self)}件 / シャード {len(self._shards)}個 / "
+                f"{total_bytes / 1024 ** 2:.1f}MB（圧縮: {self.compression or 'なし'}）")
+
+
+# 同じデータセットを、同じプロセス内の複数のフェーズ（書き込み側と読み出し側）で共有する
+_STORES = {}
+_stores_lock = threading.Lock()
+
+def open_store(path, **options):
+    """パスごとに1つの ShardedStore を開いて共有する"""
+    with _stores_lock:
+        key = os.path.abspath(path)
+        if key not in _STORES:
+            _STORES[key] = ShardedStore(path, **options)
+        return _STORES[key]
+
+def close_stores():
+    with _stores_lock:
+        for store in _STORES.values():
+            store.close()
+        _STORES.clear()
+
+def rebuild_store(path, records, **options):
+    """レコードの反復子から新しいデータセットを作り、既存のデータセットと置き換える"""
+    tmp_path = path.rstrip(os.sep) + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    with ShardedStore(tmp_path, **options) as store:
+        for record in records:
+            store.put(record)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return ShardedStore(path, readonly=True)
+
+
+# ---------------------------------
+# 従来の1件1ファイル形式との相互変換
+# ---------------------------------
+LAYOUT_KEYS = {"qa": "id", "personas": "persona_id", "dialogues": "persona_id"}
+
+def _write_json(filepath, data):
+    with open(filepath, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+
+def _read_json(filepath):
+    with open(filepath, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def dialogue_record(persona_id, dialogue, metadata, usage=None):
+    """対話1件分のレコード（dialogue_pXX.json・.metadata.json・.usage.json の内容をまとめたもの）"""
+    return {"persona_id": persona_id, "dialogue": dialogue, "metadata": metadata, "usage": usage}
+
+def export_qa(store, output):
+    """QAペアを、拡張子に応じてJSONL、または従来のJSON配列形式のファイルに書き出す"""
+    with open(output, 'w', encoding='utf-8') as f:
+        if output.endswith(".jsonl"):
+            for record in store.iter_records():
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        else:
+            json.dump(list(store.iter_records()), f, indent=2, ensure_ascii=False)
+    return 1
+
+def export_personas(store, output):
+    os.makedirs(output, exist_ok=True)
+    count = 0
+    for record in store.iter_records():
+        _write_json(os.path.join(output, f"persona_{record['persona_id']:02d}.json"), record)
+        count += 1
+    return count
+
+def export_dialogues(store, output):
+    os.makedirs(output, exist_ok=True)
+    count = 0
+    for record in store.iter_records():
+        prefix = os.path.join(output, f"dialogue_p{record['persona_id']:02d}")
+        _write_json(prefix + ".json", record["dialogue"])
+        _write_json(prefix + ".metadata.json", record["metadata"])
+        if record.get("usage") is not None:
+            _write_json(prefix + ".usage.json", record["usage"])
+        count += 1
+    return count
+
+def iter_qa_files(source):
+    """JSONL、またはJSON配列形式の結合済みQAファイルを読む"""
+    if source.endswith(".jsonl"):
+        with open(source, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        yield from _read_json(source)
+
+def iter_persona_files(source):
+    for filepath in glob.glob(os.path.join(source, "persona_*.json")):
+        if re.search(r"persona_\d+\.json$", filepath):
+            yield _read_json(filepath)
+
+def iter_dialogue_files(source):
+    for filepath in glob.glob(os.path.join(source, "dialogue_p*.json")):
+        match = re.search(r"dialogue_p(\d+)\.json$", filepath)
+        if not match:
+            continue
+        prefix = filepath[:-len(".json")]
+        usage_path = prefix + ".usage.json"
+        yield dialogue_record(
+            int(match.group(1)), _read_json(filepath), _read_json(prefix + ".metadata.json"),
+            _read_json(usage_path) if os.path.exists(usage_path) else None,
+        )
+
+EXPORTERS = {"qa": export_qa, "personas": export_personas, "dialogues": export_dialogues}
+READERS = {"qa": iter_qa_files, "personas": iter_persona_files, "dialogues": iter_dialogue_files}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="シャード形式のデータセットの作成・書き出し・確認")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    pack = subparsers.add_parser("pack", help="従来の1件1ファイル形式（またはJSONL）からデータセットを作る")
+    pack.add_argument("layout", choices=sorted(LAYOUT_KEYS), help="データの種類")
+    pack.add_argument("source", help="QAはJSONL/JSONファイル、ペルソナ・対話はディレクトリ")
+    pack.add_argument("store", help="作成するデータセットのディレクトリ")
+    pack.add_argument("--compression", choices=["gzip"], default=None, help="シャードをgzipで圧縮する")
+    pack.add_argument("--shard_records", type=int, default=10000, help="1シャードあたりのレコード数")
+
+    export = subparsers.add_parser("export", help="データセットを従来の1件1ファイル形式で書き出す")
+    export.add_argument("layout", choices=sorted(LAYOUT_KEYS), help="データの種類")
+    export.add_argument("store", help="データセットのディレクトリ")
+    export.add_argument("output", help="QAはファイル（.jsonl / .json）、ペルソナ・対話はディレクトリ")
+
+    info = subparsers.add_parser("info", help="データセットの件数・シャード数を表示する")
+    info.add_argument("store", help="データセットのディレクトリ")
+
+    args = parser.parse_args()
+    if args.command == "pack":
+        records = sorted(READERS[args.layout](args.source), key=lambda record: record[LAYOUT_KEYS[args.layout]])
+        store = rebuild_store(args.store, records, key=LAYOUT_KEYS[args.layout],
+                              compression=args.compression, shard_records=args.shard_records)
+        print(f"✅ {store.describe()}")
+    elif args.command == "export":
+        store = ShardedStore(args.store, readonly=True)
+        count = EXPORTERS[args.layout](store, args.output)
+        print(f"✅ {store.describe()} を '{args.output}' に書き出しました（{count}ファイル）。")
+    else:
+        store = ShardedStore(args.store, readonly=True)
+        print(store.describe())
+        if store.recovered:
+            print(f"↻ 索引に未記録だった{store.recovered}件を、シャードから復元しました。")
@@ -0,0 +1,194 @@
+# dedup_index.py
+
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+# 文字n-gramに含めない記号・空白（句読点の違いだけの重複を拾うため）
+_IGNORED_CHARS = re.compile(r"[\s、。，．,.!?！？「」『』（）()・…ー〜~\"']")
+
+
+def normalize_text(text):
+    """NFKC正規化し、空白・句読点と、回答の定型の書き出し「はい、」を取り除く"""
+    text = unicodedata.normalize("NFKC", text or "")
+    if text.startswith("はい"):
+        text = text[2:]
+    return _IGNORED_CHARS.sub("", text)
+
+
+class NearDuplicateIndex:
+    """
+    日本語の文字n-gramに対する MinHash/LSH による、カテゴリ別の近似重複インデックス。
+    推定Jaccard類似度が threshold 以上の既存の回答があれば重複とみなす。
+    スレッドセーフで、並列生成中の「検査して追加」を1回のロックで行える。
+    """
+
+    def __init__(self, threshold=0.7, num_perm=32, bands=8, ngram=3, seed=1):
+        if num_perm % bands:
+            raise ValueError("num_perm は bands で割り切れる必要があります")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.ngram = ngram
+        self.seed = seed
+        rng = random.Random(seed)
+        self._perms = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME)) for _ in range(num_perm)]
+        self._signatures = defaultdict(dict)
+        self._buckets = defaultdict(lambda: defaultdict(list))
+        self.rejected = Counter()
+        self._lock = threading.Lock()
+
+    def shingles(self, text):
+        text = normalize_text(text)
+        if len(text) <= self.ngram:
+            return {text}
+        return {text[i:i + self.ngram] for i in range(len(text) - self.ngram + 1)}
+
+    def signature(self, text):
+        hashes = [
+            int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
+            for shingle in self.shingles(text)
+        ]
+        return [min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes) for a, b in self._perms]
+
+    def _band_keys(self, signature):
+        return [(band, tuple(signature[band * self.rows:(band + 1) * self.rows])) for band in range(self.bands)]
+
+    def similarity(self, signature_a, signature_b):
+        return sum(a == b for a, b in zip(signature_a, signature_b)) / self.num_perm
+
+    def _query(self, category, signature, exclude=None):
+        best_key, best_score = None, 0.0
+        signatures = self._signatures[category]
+        seen = {exclude}
+        for band_key in self._band_keys(signature):
+            for key in self._buckets[category].get(band_key, ()):
+                if key in seen:
+                    continue
+                seen.add(key)
+                score = self.similarity(signature, signatures[key])
+                if score >= self.threshold and score > best_score:
+                    best_key, best_score = key, score
+        return best_key
+
+    def _add(self, category, key, signature, replace=False):
+        key = str(key)
+        if key in self._signatures[category]:
+            if not replace:
+                return
+            self._remove(category, key)
+        self._signatures[category][key] = signature
+        for band_key in self._band_keys(signature):
+            self._buckets[category][band_key].append(key)
+
+    def _remove(self, category, key):
+        signature = self._signatures[category].pop(key)
+        for band_key in self._band_keys(signature):
+            self._buckets[category][band_key].remove(key)
+
+    def __contains__(self, category_and_key):
+        category, key = category_and_key
+        return str(key) in self._signatures.get(category, {})
+
+    def __len__(self):
+        return sum(len(signatures) for signatures in self._signatures.values())
+
+    def add(self, category, key, text):
+        signature = self.signature(text)
+        with self._lock:
+            self._add(category, key, signature)
+
+    def check_and_add(self, category, key, text):
+        """
+        既存の回答と近似重複していれば、重複先のキーを返して却下数を数える。
+        重複していなければインデックスに追加して None を返す。
+        同じキーが既に登録されていれば（中断前に登録され、生成ログに残らなかったスロットを再生成した場合など）、
+        その登録とは比較せず、新しい回答の署名で置き換える。
+        """
+        return self.check_and_add_signature(category, key, self.signature(text))
+
+    def check_and_add_signature(self, category, key, signature):
+        """check_and_add と同じ処理を、計算済みの署名で行う"""
+        key = str(key)
+        with self._lock:
+            duplicate_of = self._query(category, signature, exclude=key)
+            if duplicate_of is not None:
+                self.rejected[category] += 1
+                return duplicate_of
+            self._add(category, key, signature, replace=True)
+            return None
+
+    def format_rejections(self):
+        if not self.rejected:
+            return "近似重複による却下: 0件"
+        details = " / ".join(f"{category}: {count}件" for category, count in self.rejected.most_common())
+        return f"近似重複による却下: 合計{sum(self.rejected.values())}件（{details}）"
+
+    def save(self, path):
+        with self._lock:
+            data = {
+                "params": {"threshold": self.threshold, "num_perm": self.num_perm, "bands": self.bands,
+                           "ngram": self.ngram, "seed": self.seed},
+                "signatures": self._signatures,
+                "rejected": dict(self.rejected),
+            }
+            tmp_path = path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, threshold=None):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        params = data["params"]
+        if threshold is not None:
+            params["threshold"] = threshold
+        index = cls(**params)
+        for category, signatures in data["signatures"].items():
+            for key, signature in signatures.items():
+                index._add(category, key, signature)
+        index.rejected.update(data.get("rejected", {}))
+        return index
+
+
+def find_duplicate_clusters(records, threshold=0.7, key_field="id"):
+    """
+    レコード（category と answer を持つdict）の列から、カテゴリ別に近似重複のクラスタを求める。
+    2件以上からなるクラスタごとに {"category", "ids"} のリストを返す。
+    """
+    index = NearDuplicateIndex(threshold=threshold)
+    parent = {}
+
+    def find(key):
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    categories, originals = {}, {}
+    for record in records:
+        key = str(record[key_field])
+        category = record.get("category")
+        parent[key] = key
+        categories[key] = category
+        originals[key] = record[key_field]
+        duplicate_of = index.check_and_add(category, key, record.get("answer", ""))
+        if duplicate_of is not None:
+            parent[find(key)] = find(duplicate_of)
+
+    clusters = defaultdict(list)
+    for key in parent:
+        clusters[find(key)].append(key)
+    return [
+        {"category": categories[root], "ids": [originals[key] for key in members]}
+        for root, members in clusters.items() if len(members) > 1
+    ]
@@ -0,0 +1,93 @@
+# dialogue_memory.py
+
+import math
+from collections import Counter, defaultdict
+from dedup_index import normalize_text
+
+
+def bigrams(text):
+    """関連度の計算に使う、正規化した文字bigramの集合"""
+    text = normalize_text(text)
+    if len(text) <= 2:
+        return {text} if text else set()
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+class DialogueMemory:
+    """
+    長い対話（数百〜数千ターン）を、1ターンあたりのプロンプトの大きさを一定に保ったまま生成するための記憶。
+    * 要約: プロンプトの会話履歴から外すターン（dialogue_history の先頭 summarized_until 件）を、要約に畳み込んでおく
+    * 索引: ユーザーの過去の発言を話題（new_topic 戦略で区切った通し番号）とターン番号で、
+      注入した事実を開示した発言をカテゴリとターン番号で索引し、文字bigramのIDF重み付きの一致で関連するものを引く
+    生成ログの turn / summary エントリから再構築できるため、中断後の再開でも同じ状態に戻る。
+    """
+
+    def __init__(self):
+        self.summary = ""
+        self.summarized_until = 0
+        self.topic = 0
+        self.utterances = []
+        self.facts = []
+        self._postings = defaultdict(list)
+        self._document_frequency = Counter()
+
+    def update_summary(self, summary, summarized_until):
+        self.summary = summary
+        self.summarized_until = summarized_until
+
+    def record_turn(self, turn_num, speaker, content, injection=None, strategy=None):
+        """完了したターンを索引に加える（アシスタントが new_topic 戦略を使ったターンから、新しい話題とする）"""
+        if speaker != "user":
+            if strategy == "new_topic":
+                self.topic += 1
+            return
+        grams = bigrams(content)
+        position = len(self.utterances)
+        self.utterances.append({"turn": turn_num, "topic": self.topic, "content": content, "grams": grams})
+        for gram in grams:
+            self._postings[gram].append(position)
+        self._document_frequency.update(grams)
+        if injection:
+            self.facts.append({"turn": turn_num, "category": injection.get("category"), "content": content, "grams": grams})
+
+    def _idf(self, gram):
+        return math.log(1 + len(self.utterances) / self._document_frequency[gram])
+
+    def _score(self, query_grams, grams):
+        overlap = query_grams & grams
+        return sum(self._idf(gram) for gram in overlap) / math.sqrt(len(grams)) if overlap else 0.0
+
+    def recall(self, query, rng, before_turn, top_k=3):
+        """
+        ターン before_turn より前（プロンプトの会話履歴に含まれない範囲）の、現在とは別の話題のユーザーの発言から、
+        query との関連度が高い上位 top_k 件のうち1件を rng で選んで返す（該当する発言が無ければ None）。
+        どの発言とも一致しない場合は、該当する範囲から無作為に選ぶ。
+        """
+        eligible = [u for u in self.utterances if u["turn"] < before_turn and u["topic"] != self.topic]
+        if not eligible:
+            return None
+        query_grams = bigrams(query)
+        scores = Counter()
+        for gram in query_grams:
+            # どの発言にも無い bigram と、ほとんどの発言に現れる bigram（「です」など）は、関連度の手掛かりにならないため数えない
+            frequency = self._document_frequency.get(gram, 0)
+            if not frequency or frequency * 2 > len(self.utterances):
+                continue
+            idf = self._idf(gram)
+            for position in self._postings.get(gram, ()):
+                scores[position] += idf
+        ranked = sorted(
+            (score / math.sqrt(len(self.utterances[position]["grams"])), position)
+            for position, score in scores.items()
+            if self.utterances[position]["turn"] < before_turn and self.utterances[position]["topic"] != self.topic
+        )
+        if not ranked:
+            return rng.choice(eligible)
+        score, position = rng.choice(ranked[-top_k:])
+        return {**self.utterances[position], "score": round(score, 3)}
+
+    def relevant_facts(self, query, limit):
+        """注入した事実を開示した発言のうち、query との関連度が高いもの（同点なら新しいもの）を最大 limit 件返す"""
+        query_grams = bigrams(query)
+        ranked = sorted(self.facts, key=lambda fact: (self._score(query_grams, fact["grams"]), fact["turn"]), reverse=True)
+        return ranked[:limit]
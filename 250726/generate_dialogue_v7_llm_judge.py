@@ -3,173 +3,1064 @@
 import json
 import os
 import random
-import time
 import re
-from openai import OpenAI
-from tqdm.notebook import tqdm
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from tqdm.auto import tqdm
+from llm_backend import ClientConfig, build_client
+from generation_log import GenerationLog
+from telemetry import TELEMETRY
+from dataset_store import open_store, close_stores, dialogue_record
+from budget import BudgetExceeded, CostEstimate, count_message_tokens
+from dialogue_memory import DialogueMemory
+from prefectures import PREFECTURES
 
-class Config:
-    try:
-        from google.colab import userdata
-        API_KEY = userdata.get("OPENAI-KEY")
-    except (ImportError, KeyError):
-        API_KEY = os.environ.get("OPENAI_API_KEY", "YOUR_API_KEY_HERE")
-    LLM_MODEL = "gpt-4o"
+class Config(ClientConfig):
+    # 役割ごとのモデルと接続先（API_KEY・BASE_URL・レート制限・再試行・応答キャッシュ・予算の上限などの共通の設定は、
+    # llm_backend.py の ClientConfig を参照）
+    # 判定（一貫性チェック）は、より安価・高速なモデルや接続先に振り分けてもよい
+    MODEL_ROUTES = {
+        "generator": {"model": "gpt-4o"},
+        "judge": {"model": "gpt-4o"},
+    }
     PERSONA_DIR = "pilot_personas" # 本番生成時は "personas" に変更
     OUTPUT_DIR = "pilot_dialogues" # 本番生成時は "dialogues" に変更
+    # 出力形式。"files" はペルソナごとの dialogue_pXX.json（と .metadata.json・.usage.json）、
+    # "sharded" は STORE_DIR のシャード形式のデータセット（dataset_store.py）。生成ログは常に OUTPUT_DIR に置く
+    OUTPUT_FORMAT = "files"
+    STORE_DIR = "pilot_dataset/dialogues"
+    STORE_COMPRESSION = None # "gzip" で圧縮する
+    # persona_XX.json が PERSONA_DIR に無い場合に、ペルソナを読み込むシャード形式のデータセット
+    PERSONA_STORE_DIR = "pilot_dataset/personas"
     NUM_TURNS = 50
     NUM_INJECTIONS = 2
     PRESENCE_PENALTY = 0.2
+    # ユーザー発話の候補数。2以上にすると、1回のリクエストで複数の候補を生成（n パラメータ）してまとめて判定し、
+    # 最初に一貫している候補を採用する（1ターンあたりのAPI往復が最大2回になる）。1なら候補を1つずつ生成・判定する
+    NUM_CANDIDATES = 1
+    # プロンプトに含める会話履歴の最小ターン数（開始位置をこの単位でそろえ、プロンプトキャッシュを効かせる）
+    HISTORY_WINDOW = 10
+    # 長い対話モード（NUM_TURNS を500〜2,000にする場合）。True にすると、会話履歴が HISTORY_WINDOW + SUMMARY_INTERVAL ターンに
+    # 達するたびに古い SUMMARY_INTERVAL ターンを要約に畳み込み（要約は SUMMARY_MAX_CHARS 文字まで）、1ターンあたりの
+    # プロンプトの大きさを一定に保つ。connect 戦略は、索引したユーザーの過去の発言から関連するもの（上位 RECALL_TOP_K 件から1件）を
+    # 思い出させ、アシスタントには関連する注入済みの事実を最大 MEMORY_FACTS_IN_PROMPT 件示す。
+    # 注入する事実の数は NUM_INJECTIONS ではなく、INJECTION_INTERVAL ターンに1件の割合で、対話全体に散らばるように決める
+    LONG_DIALOGUE = False
+    SUMMARY_INTERVAL = 20
+    SUMMARY_MAX_CHARS = 800
+    SUMMARY_MAX_TOKENS = 600
+    INJECTION_INTERVAL = 40
+    MEMORY_FACTS_IN_PROMPT = 5
+    RECALL_TOP_K = 3
+    # 一貫性判定の結果をメモ化しておく（発話, プロフィール）の件数の上限（超えたら、最も長く参照されていないものから捨てる）
+    JUDGE_MEMO_MAX_ENTRIES = 10000
+    # 並列生成の設定（同時に対話を生成するペルソナ数と、全体で共有する1分あたりの上限）
+    MAX_CONCURRENCY = 8
+    # API呼び出しが再試行の上限まで失敗したターンを、ペルソナごとに後回しにして再開する回数の上限
+    MAX_TURN_REQUEUES = 3
+    # ドライラン（--dry_run）の見積もりに使う、1発話あたりのトークン数と判定の生成トークン数、
+    # ユーザー発話のうちローカルのルールで判定できずLLMの判定に回る割合と、矛盾として却下される割合
+    ESTIMATED_UTTERANCE_TOKENS = 120
+    ESTIMATED_JUDGE_COMPLETION_TOKENS = 60
+    ESTIMATED_JUDGE_RATE = 0.5
+    ESTIMATED_REJECTION_RATE = 0.05
+
+def create_client(max_concurrency=None):
+    """全ペルソナで共有する、レート制限・予算・応答キャッシュ・計測付きのAPIクライアントを作成する"""
+    TELEMETRY.start(Config.TRACE_FILE)
+    return build_client(Config, max_concurrency)
+
+def dialogue_output_path(persona_id):
+    return os.path.join(Config.OUTPUT_DIR, f"dialogue_p{persona_id:02d}.json")
+
+def dialogue_store():
+    return open_store(Config.STORE_DIR, key="persona_id", compression=Config.STORE_COMPRESSION)
+
+def dialogue_exists(persona_id):
+    if Config.OUTPUT_FORMAT == "sharded":
+        return persona_id in dialogue_store()
+    return os.path.exists(dialogue_output_path(persona_id))
+
+def load_persona(persona_id):
+    """ペルソナを persona_XX.json から、無ければシャード形式のデータセットから読み込む（見つからなければ None）"""
+    persona_filepath = os.path.join(Config.PERSONA_DIR, f"persona_{persona_id:02d}.json")
+    if os.path.exists(persona_filepath):
+        with open(persona_filepath, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    if os.path.isdir(Config.PERSONA_STORE_DIR):
+        return open_store(Config.PERSONA_STORE_DIR, key="persona_id").get(persona_id)
+    return None
 
-def create_dynamic_injection_prompt(persona_data, fact_to_inject, dialogue_history):
+def dialogue_log_path(persona_id):
+    return os.path.join(Config.OUTPUT_DIR, f"dialogue_p{persona_id:02d}.log.jsonl")
+
+def load_dialogue_log(log):
+    """
+    対話の生成ログを再生し、(注入計画, 完了済みターンのリスト) を返す。
+    注入計画には、注入する事実・ターンと、ターンごとの乱数生成器を作るためのシードが含まれる。
+    """
+    plan, turns = None, []
+    for entry in log.replay():
+        if entry["type"] == "plan":
+            plan, turns = entry, []
+        elif entry["type"] == "turn" and plan is not None and entry["turn"] == len(turns) + 1:
+            turns.append(entry)
+    return plan, turns
+
+def load_dialogue_summaries(log):
+    """長い対話モードの生成ログから、最後の注入計画以降の要約のエントリ（古い順）を返す"""
+    summaries = []
+    for entry in log.replay():
+        if entry["type"] == "plan":
+            summaries = []
+        elif entry["type"] == "summary":
+            summaries.append(entry)
+    return summaries
+
+def summarize_candidates(candidate_turns):
+    """ユーザー発話のターンごとの候補の統計を集計する"""
+    round_trips = [turn.get("round_trips", 0) for turn in candidate_turns]
+    return {
+        "user_turns": len(candidate_turns),
+        "candidates_generated": sum(turn.get("generated", 0) for turn in candidate_turns),
+        "candidates_rejected": sum(turn.get("rejected", 0) for turn in candidate_turns),
+        "fallback_turns": sum(turn.get("fallback", 0) for turn in candidate_turns),
+        "mean_round_trips": round(sum(round_trips) / len(round_trips), 3) if round_trips else 0.0,
+        "max_round_trips": max(round_trips, default=0),
+    }
+
+def compile_dialogue_from_log(persona_id, log):
+    """
+    生成ログから、成果物である dialogue_pXX.json と dialogue_pXX.metadata.json、
+    API呼び出しごとのトークン数を記録した dialogue_pXX.usage.json を組み立てる
+    （Config.OUTPUT_FORMAT が "sharded" の場合は、この3つをまとめた1レコードをデータセットに追加する）
+    """
+    plan, turns = load_dialogue_log(log)
+    dialogue_history = [{"speaker": "assistant", "content": plan["opening"]}]
+    dialogue_history += [{"speaker": turn["speaker"], "content": turn["content"]} for turn in turns]
+    injection_metadata = [turn["injection"] for turn in turns if turn.get("injection")]
+    candidate_turns = [{"turn": turn["turn"], **turn["candidates"]} for turn in turns if turn.get("candidates")]
+    summaries = load_dialogue_summaries(log)
+    usage_calls = [dict(call, turn=turn["turn"]) for turn in turns for call in turn.get("usage", [])]
+    usage_calls += [dict(call, turn=summary["turn"]) for summary in summaries for call in summary.get("usage", [])]
+    usage_summary = summarize_usage(usage_calls)
+    metadata = {
+        "injections": injection_metadata,
+        "candidates": {"summary": summarize_candidates(candidate_turns), "turns": candidate_turns},
+    }
+    if plan.get("long_dialogue"):
+        # 長い対話モードでは、要約と、connect 戦略で思い出させた過去の発言（長期記憶の参照の正解）も残す
+        metadata["memory"] = {
+            "summaries": [{"turn": summary["turn"], "until": summary["until"], "content": summary["content"]} for summary in summaries],
+            "recalls": [{"turn": turn["turn"], **turn["recall"]} for turn in turns if turn.get("recall")],
+        }
+
+    if Config.OUTPUT_FORMAT == "sharded":
+        dialogue_store().put(dialogue_record(persona_id, dialogue_history, metadata, {"summary": usage_summary, "calls": usage_calls}))
+        print(f"\n✅ 対話生成が完了し、データセット '{Config.STORE_DIR}' に保存しました。")
+        print(f"✅ {format_usage(usage_summary)}")
+        return f"{Config.STORE_DIR}#{persona_id}"
+
+    output_filename = dialogue_output_path(persona_id)
+    with open(output_filename, 'w', encoding='utf-8') as f: json.dump(dialogue_history, f, indent=2, ensure_ascii=False)
+    print(f"\n✅ 対話生成が完了し、'{output_filename}' に保存しました。")
+    metadata_filename = os.path.join(Config.OUTPUT_DIR, f"dialogue_p{persona_id:02d}.metadata.json")
+    with open(metadata_filename, 'w', encoding='utf-8') as f: json.dump(metadata, f, indent=2, ensure_ascii=False)
+    print(f"✅ 注入メタデータ・候補発話の統計を '{metadata_filename}' に保存しました。")
+    usage_filename = os.path.join(Config.OUTPUT_DIR, f"dialogue_p{persona_id:02d}.usage.json")
+    with open(usage_filename, 'w', encoding='utf-8') as f: json.dump({"summary": usage_summary, "calls": usage_calls}, f, indent=2, ensure_ascii=False)
+    print(f"✅ {format_usage(usage_summary)}")
+    return output_filename
+
+# ---------------------------------
+# プロンプトの組み立て（プロンプトキャッシュが効くよう、固定の system → 会話履歴 → 今回の指示 の順に並べる）
+# ---------------------------------
+DIALOGUE_RULES = """# 【★★重要ルール★★】
+- これは継続した会話です。途中で「こんにちは」のような挨拶を繰り返さないでください。"""
+
+ASSISTANT_STRATEGIES = {
+    "deepen": "ユーザーの直前の発言内容について、さらに一歩踏み込んだオープンな質問を投げかけ、ユーザーの自己開示を促してください。",
+    "connect": "指示で示す、以前ユーザーが話していたことを思い出し、現在の話題と自然に関連付けて会話を広げてください。",
+    "new_topic": "現在の話題が一段落したと判断し、ユーザーが興味を持ちそうな、これまで話していない全く新しい雑談のトピックを自然に提案してください。",
+    "reflect": "ユーザーの発言内容を要約し、その内容に対するあなたの理解や共感を示してください。",
+}
+
+def build_user_system_prompt(persona_data):
+    """ユーザー役の固定部分（ペルソナとルール）。対話を通じて変わらないため、プロンプトキャッシュの対象になる"""
     profile = persona_data["persona"]["profile"]
     persona_summary_text = "\n".join([f"- {key}: {value}" for key, value in profile.items()])
-    history_text = "\n".join([f"{turn['speaker']}: {turn['content']}" for turn in dialogue_history[-10:]])
-    core_fact_to_inject = f"- カテゴリ: {fact_to_inject['category']}\n- 内容: {fact_to_inject['answer']}"
-    user_prompt = f"""
-# これまでの会話の流れ
-{history_text}
-# あなたへのタスク
-以下のペルソナ、会話の流れ、そして開示すべき核心的事実のすべてを考慮し、あなた自身の言葉として、この事実を裏付ける具体的なエピソードを含んだ自然な発話を1つだけ生成してください。
-# あなたが今回、自然に自己開示するべき「核心的な事実」
-{core_fact_to_inject}
+    return f"""あなたは、以下のペルソナになりきってAIアシスタントと会話しているユーザーです。
+会話履歴では、あなた自身のこれまでの発言が assistant、AIアシスタントの発言が user として与えられます。
+最後に与えられる指示に従って、ユーザーとしての次の発話を1つだけ生成してください。
+「核心的な事実」の自己開示を指示された場合は、ペルソナ、会話の流れ、開示すべき事実のすべてを考慮し、あなた自身の言葉として、この事実を裏付ける具体的なエピソードを含んだ自然な発話にしてください。
 # あなたのペルソナ情報（絶対に忘れないでください）
 {persona_summary_text}
-# 【★★重要ルール★★】
-- これは継続した会話です。途中で「こんにちは」のような挨拶を繰り返さないでください。
-"""
-    return user_prompt
+{DIALOGUE_RULES}"""
+
+def build_assistant_system_prompt():
+    """アシスタント役の固定部分（役割・会話戦略の定義・ルール）"""
+    strategy_text = "\n".join([f"- {name}: {description}" for name, description in ASSISTANT_STRATEGIES.items()])
+    return f"""あなたは聞き上手なAIアシスタントです。ユーザーの発言に対して、最後に指定される会話戦略に従って、親身に、かつ自然に応答してください。
+# 会話戦略の定義
+{strategy_text}
+{DIALOGUE_RULES}
+- 会話を締めくくるような発言（「何か他にありますか？」など）は避け、常に対話が続くようなオープンな応答を心がけてください。"""
+
+def history_messages(dialogue_history, speaker):
+    """
+    対話履歴を chat 形式のメッセージに変換する（speaker 自身の発言を assistant、相手の発言を user とする）。
+    直近 Config.HISTORY_WINDOW ターン以上を含め、開始位置を HISTORY_WINDOW 単位でそろえることで、
+    連続するターンの間でメッセージ列の先頭部分が変わらず、プロンプトキャッシュが再利用されるようにする。
+    """
+    start = max(0, len(dialogue_history) - Config.HISTORY_WINDOW)
+    start -= start % Config.HISTORY_WINDOW
+    return [
+        {"role": "assistant" if turn["speaker"] == speaker else "user", "content": turn["content"]}
+        for turn in dialogue_history[start:]
+    ]
+
+def build_turn_messages(system_prompt, dialogue_history, speaker, instruction, memory=None):
+    """
+    1ターン分のメッセージ列を作る。memory（長い対話モードの DialogueMemory）を渡した場合は、
+    要約に畳み込んだターンの代わりに要約を置き、それ以降のターンだけを会話履歴に含める。
+    """
+    if memory is None:
+        history = history_messages(dialogue_history, speaker)
+    else:
+        history = [
+            {"role": "assistant" if turn["speaker"] == speaker else "user", "content": turn["content"]}
+            for turn in dialogue_history[memory.summarized_until:]
+        ]
+        if memory.summary:
+            history.insert(0, {"role": "system", "content": f"# これまでの会話の要約（ターン{memory.summarized_until - 1}まで）\n{memory.summary}"})
+    return (
+        [{"role": "system", "content": system_prompt}]
+        + history
+        + [{"role": "system", "content": instruction}]
+    )
+
+def create_dynamic_injection_prompt(persona_data, fact_to_inject, dialogue_history, memory=None):
+    """核心的な事実を自己開示させるユーザー発話のメッセージ列を作る"""
+    core_fact_to_inject = f"- カテゴリ: {fact_to_inject['category']}\n- 内容: {fact_to_inject['answer']}"
+    instruction = f"""# あなたへのタスク
+直前の相手の発言を受けて、以下の「核心的な事実」を自然に自己開示する発話を1つだけ生成してください。
+# あなたが今回、自然に自己開示するべき「核心的な事実」
+{core_fact_to_inject}"""
+    return build_turn_messages(build_user_system_prompt(persona_data), dialogue_history, "user", instruction, memory)
 
-def is_utterance_consistent_with_llm(client, utterance, persona_profile):
+def create_user_response_prompt(persona_data, dialogue_history, memory=None):
+    """通常のユーザー発話のメッセージ列を作る"""
+    instruction = "# あなたへのタスク\n直前の相手の発言に対し、上記のペルソナとして自然に応答してください。"
+    return build_turn_messages(build_user_system_prompt(persona_data), dialogue_history, "user", instruction, memory)
+
+def create_assistant_prompt(dialogue_history, strategy, past_utterance=None, memory=None):
+    """
+    アシスタント発話のメッセージ列を作る（戦略名と、connect の場合は思い出す過去の発言だけが毎回変わる）。
+    長い対話モードでは、直前の発言に関連する、ユーザーがこれまでに開示した事実も指示に含める。
+    """
+    instruction = f"# 今回の会話戦略\n{strategy}"
+    if past_utterance:
+        instruction += f"\n# 思い出す、以前のユーザーの発言\n「{past_utterance[:30]}...」"
+    if memory is not None and memory.facts:
+        facts = memory.relevant_facts(dialogue_history[-1]["content"], Config.MEMORY_FACTS_IN_PROMPT)
+        instruction += "\n# ユーザーがこれまでに話してくれたこと（必要なときだけ自然に触れてください）\n" + "\n".join(
+            f"- ターン{fact['turn']}（{fact['category']}）: 「{fact['content'][:60]}」" for fact in facts)
+    return build_turn_messages(build_assistant_system_prompt(), dialogue_history, "assistant", instruction, memory)
+
+def build_summary_request(previous_summary, turns):
+    """長い対話モードで、これまでの要約に続きのターンを畳み込んだ、新しい要約を作るリクエストのパラメータを作る"""
+    transcript = "\n".join(f"{'ユーザー' if turn['speaker'] == 'user' else 'アシスタント'}: {turn['content']}" for turn in turns)
+    prompt = f"""以下は、ユーザーとAIアシスタントの長い会話の「これまでの会話の要約」と、その続きの発言です。
+続きの発言の内容を畳み込んで、要約を更新してください。
+# ルール
+- ユーザーが話した具体的な事実（名前・日付・場所・人物・好みなど）とエピソードは、省略せずに残してください。
+- 話題の流れが分かるように、古い内容ほど簡潔にまとめてください。
+- 全体を{Config.SUMMARY_MAX_CHARS}文字以内の、箇条書きではない文章で出力してください。
+# これまでの会話の要約
+{previous_summary or "（まだありません）"}
+# 続きの発言
+{transcript}"""
+    return {
+        "model": Config.MODEL_ROUTES["generator"]["model"],
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0.3,
+        "max_tokens": Config.SUMMARY_MAX_TOKENS,
+    }
+
+def summarize_history(client, memory, dialogue_history):
+    """
+    会話履歴の先頭の、まだ要約していない Config.SUMMARY_INTERVAL ターンを要約に畳み込み、
+    生成ログに記録する summary エントリ（要約・畳み込んだ件数・トークン数）を返す
+    """
+    until = memory.summarized_until + Config.SUMMARY_INTERVAL
+    usage = []
+    with TELEMETRY.tags(kind="summarize"):
+        response = client.chat.completions.create(**build_summary_request(memory.summary, dialogue_history[memory.summarized_until:until]))
+    record_usage(usage, "summarize", response)
+    summary = (response.choices[0].message.content or "").strip()
+    if not summary:
+        raise ValueError("要約が空でした")
+    return {"type": "summary", "until": until, "content": summary[:Config.SUMMARY_MAX_CHARS], "usage": usage}
+
+def plan_injections(rng, other_facts):
+    """
+    注入する事実と、注入するターン（ユーザー発話の奇数ターン）を決める。
+    長い対話モードでは、INJECTION_INTERVAL ターンに1件（少なくとも NUM_INJECTIONS 件、多くてもその他の事実の件数まで）とし、
+    対話を件数分の区間に分けて、各区間から1ターンずつ選ぶことで、対話全体に散らばるようにする。
+    """
+    user_turns = range(5, Config.NUM_TURNS - 5, 2)
+    if not Config.LONG_DIALOGUE:
+        return rng.sample(other_facts, Config.NUM_INJECTIONS), sorted(rng.sample(user_turns, Config.NUM_INJECTIONS))
+    num_injections = min(len(other_facts), len(user_turns), max(Config.NUM_INJECTIONS, Config.NUM_TURNS // Config.INJECTION_INTERVAL))
+    facts = rng.sample(other_facts, num_injections)
+    turns = [
+        rng.choice(user_turns[len(user_turns) * i // num_injections:len(user_turns) * (i + 1) // num_injections])
+        for i in range(num_injections)
+    ]
+    return facts, turns
+
+# 実行全体のトークン使用量（全ペルソナ分）
+USAGE_CALLS = []
+_usage_lock = threading.Lock()
+
+def record_usage(usage_log, kind, response):
+    """1回のAPI呼び出しのトークン数（プロンプト・生成・プロンプトキャッシュ済み）を記録する"""
+    if usage_log is None:
+        return
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+    usage_log.append({
+        "kind": kind,
+        "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+        "cached_tokens": getattr(details, "cached_tokens", 0) or 0,
+        # ローカルの応答キャッシュ（llm_cache）から返した呼び出しは課金されない
+        "cache_hit": bool(getattr(response, "cache_hit", False)),
+    })
+
+def summarize_usage(calls):
+    billed = [call for call in calls if not call["cache_hit"]]
+    prompt_tokens = sum(call["prompt_tokens"] for call in billed)
+    cached_tokens = sum(call["cached_tokens"] for call in billed)
+    return {
+        "api_calls": len(billed),
+        "local_cache_hits": len(calls) - len(billed),
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": sum(call["completion_tokens"] for call in billed),
+        "cached_tokens": cached_tokens,
+        "cached_ratio": round(cached_tokens / prompt_tokens, 4) if prompt_tokens else 0.0,
+    }
+
+def format_usage(summary):
+    return (
+        f"トークン使用量: API呼び出し {summary['api_calls']}回 / プロンプト {summary['prompt_tokens']} "
+        f"（うちプロンプトキャッシュ {summary['cached_tokens']}、{summary['cached_ratio'] * 100:.1f}%） / "
+        f"生成 {summary['completion_tokens']}"
+    )
+
+def build_judge_request(utterance, persona_profile):
+    """1つの発話とプロフィールの一貫性を判定する LLM-as-a-judge のリクエストのパラメータを作る"""
     profile_text = "\n".join([f"- {key}: {value}" for key, value in persona_profile.items()])
     judge_prompt = f"""
 あなたは、事実の矛盾を厳密にチェックする、高性能な判定AIです。
 # ペルソナの確定情報
 {profile_text}
-# 判定対象の発話
-「{utterance}」
 # あなたのタスク
-上記の「判定対象の発話」が、「ペルソナの確定情報」と明確に矛盾する内容を含んでいるかどうかを判定してください。
+ユーザーから与えられる「判定対象の発話」が、「ペルソナの確定情報」と明確に矛盾する内容を含んでいるかどうかを判定してください。
 判定結果を、必ず以下のJSON形式で出力してください。
 {{
   "is_consistent": boolean,
   "reason": "矛盾している、あるいはしていないと判断した簡潔な理由"
 }}
 """
+    return {
+        "model": Config.MODEL_ROUTES["judge"]["model"],
+        "messages": [
+            {"role": "system", "content": judge_prompt},
+            {"role": "user", "content": f"# 判定対象の発話\n「{utterance}」"}
+        ],
+        "response_format": {"type": "json_object"},
+        "temperature": 0.0,
+    }
+
+def is_utterance_consistent_with_llm(client, utterance, persona_profile, usage_log=None):
     try:
-        response = client.chat.completions.create(
-            model=Config.LLM_MODEL,
-            messages=[{"role": "user", "content": judge_prompt}],
-            response_format={"type": "json_object"},
-            temperature=0.0,
-        )
+        with TELEMETRY.tags(kind="judge"):
+            response = client.chat.completions.create(**build_judge_request(utterance, persona_profile))
+        record_usage(usage_log, "judge", response)
         judge_result = json.loads(response.choices[0].message.content)
         if not judge_result.get("is_consistent", True):
             print(f"\n⚠️ 矛盾検知(LLM-as-a-judge): {judge_result.get('reason')}")
         return judge_result.get("is_consistent", True)
+    except BudgetExceeded:
+        # 予算の上限による停止は、判定できなかった発話（一貫しているとみなす）として扱わずに呼び出し元に伝える
+        raise
     except Exception as e:
         print(f"  - 判定APIエラー: {e}")
+        TELEMETRY.record_error(e)
         return True
 
-def generate_dialogue_for_persona(persona_id):
-    print(f"--- ペルソナID: {persona_id} の対話生成を開始します ---")
-    client = OpenAI(api_key=Config.API_KEY)
-    persona_filepath = os.path.join(Config.PERSONA_DIR, f"persona_{persona_id:02d}.json")
+# ---------------------------------
+# ローカルのルールベース事前判定（LLM-as-a-judge の呼び出しを減らす）
+# ---------------------------------
+DATE_PATTERN = re.compile(r"(\d{1,2})月(\d{1,2})日")
+NAME_CLAIM_PATTERNS = [
+    re.compile(r"(?:私|僕|俺|わたし|あたし|自分)の名前は([^\s、。！？!?,]{1,12}?)(?:です|だよ|だ|って|と言|といい|。|、|$)"),
+    re.compile(r"(?:私|僕|俺|わたし|あたし|自分)は([^\s、。！？!?,]{1,12}?)と(?:申します|いいます|言います)"),
+]
+PLACE_CLAIM_PATTERNS = [
+    re.compile(r"(?:私|僕|俺|わたし|あたし|自分)は([^\s、。！？!?,「」]{1,12}?)(?:の)?(?:出身|生まれ)"),
+    re.compile(r"(?:私|僕|俺|わたし|あたし|自分)の(?:出身|出身地|地元|故郷)は([^\s、。！？!?,]{1,12}?)(?:です|だよ|だ|で|。|、|$)"),
+]
+BIRTHDAY_CONTEXT = ("誕生日", "生まれ")
+IDENTITY_KEYWORDS = ("名前", "誕生日", "生まれ", "出身", "地元", "故郷", "ふるさと", "育ち", "育っ", "申します")
+# 本人以外（家族・友人など）についての発言は、ルールでは判定しない
+OTHER_PERSON_WORDS = ("母", "父", "兄", "姉", "弟", "妹", "祖父", "祖母", "妻", "夫", "彼女", "彼氏", "彼", "友達", "友人", "息子", "娘", "子ども", "子供", "ペット", "同僚", "上司")
+NAME_HONORIFICS = re.compile(r"(さん|くん|君|ちゃん|様)$")
+PLACE_SUFFIXES = re.compile(r"(都|道|府|県|市|区|町|村)$")
+LOOKS_LIKE_NAME = re.compile(r"^[\u4e00-\u9fff\u30a0-\u30ff\u3040-\u309f]{1,8}$")
+
+JUDGE_STATS = Counter()
+# (発話, プロフィール) ごとの判定結果のメモ。Config.JUDGE_MEMO_MAX_ENTRIES 件を超えたら、最も長く参照されていないものから捨てる
+_judge_memo = OrderedDict()
+_judge_lock = threading.Lock()
+
+def _normalize_name(name):
+    return NAME_HONORIFICS.sub("", unicodedata.normalize("NFKC", str(name)).replace(" ", "").replace("\u3000", ""))
+
+def _normalize_place(place):
+    return PLACE_SUFFIXES.sub("", unicodedata.normalize("NFKC", str(place)).replace(" ", ""))
+
+def _mentions_profile(text):
+    """プロフィールの項目（名前・誕生日・出身地）に関わりうる語・日付・都道府県名を含むか"""
+    return (any(keyword in text for keyword in IDENTITY_KEYWORDS)
+            or DATE_PATTERN.search(text) is not None
+            or any(prefecture in text for prefecture in PREFECTURES))
+
+def _matches(claim, truth):
+    return bool(claim) and bool(truth) and (claim in truth or truth in claim)
+
+def prejudge_utterance(utterance, persona_profile):
+    """
+    発話から「X月X日」形式の日付・名乗り・出身地の言及を抜き出し、プロフィールと照合する。
+    明らかに一貫していれば True、明らかに矛盾していれば False、判断できなければ None を返す。
+    """
+    text = unicodedata.normalize("NFKC", utterance)
+    if not _mentions_profile(text):
+        # 名前・誕生日・出身地に関わる語も、日付も、地名も含まない発話は、プロフィールと矛盾しようがない
+        return True, "プロフィールに関わる言及なし"
+
+    profile_name = _normalize_name(persona_profile.get("name", ""))
+    profile_place = _normalize_place(persona_profile.get("from", ""))
+    birthday_match = DATE_PATTERN.search(unicodedata.normalize("NFKC", str(persona_profile.get("birthday", ""))))
+    profile_birthday = (int(birthday_match.group(1)), int(birthday_match.group(2))) if birthday_match else None
+
+    ambiguous = False
+    for sentence in re.split(r"[。！？!?\n]", text):
+        if not _mentions_profile(sentence):
+            continue
+        if any(word in sentence for word in OTHER_PERSON_WORDS):
+            ambiguous = True
+            continue
+        claimed_any = False
+
+        if any(context in sentence for context in BIRTHDAY_CONTEXT):
+            dates = [(int(m), int(d)) for m, d in DATE_PATTERN.findall(sentence)]
+            if dates:
+                claimed_any = True
+                if profile_birthday is None:
+                    ambiguous = True
+                elif profile_birthday not in dates:
+                    return False, f"誕生日の言及 {dates} がプロフィール（{persona_profile.get('birthday')}）と異なる"
+
+        for pattern in NAME_CLAIM_PATTERNS:
+            for claim in pattern.findall(sentence):
+                claimed_any = True
+                claim = _normalize_name(claim)
+                if _matches(claim, profile_name):
+                    continue
+                if profile_name and LOOKS_LIKE_NAME.match(claim):
+                    return False, f"名乗り「{claim}」がプロフィールの名前（{persona_profile.get('name')}）と異なる"
+                ambiguous = True
+
+        for pattern in PLACE_CLAIM_PATTERNS:
+            for claim in pattern.findall(sentence):
+                claimed_any = True
+                claim = _normalize_place(claim)
+                if _matches(claim, profile_place):
+                    continue
+                # 都道府県どうしが食い違う場合だけ、明らかな矛盾とみなす
+                claimed_prefectures = {p for p in PREFECTURES if p in claim}
+                profile_prefectures = {p for p in PREFECTURES if p in profile_place}
+                if claimed_prefectures and profile_prefectures and not claimed_prefectures & profile_prefectures:
+                    return False, f"出身地の言及「{claim}」がプロフィール（{persona_profile.get('from')}）と異なる"
+                ambiguous = True
+
+        if not claimed_any:
+            # キーワードはあるが、ルールで抜き出せる形の言及ではない
+            ambiguous = True
+
+    if ambiguous:
+        return None, "ルールでは判定できない言及あり"
+    return True, "言及がすべてプロフィールと一致"
+
+def _memo_key(utterance, persona_profile):
+    return (utterance, tuple(sorted((key, str(value)) for key, value in persona_profile.items())))
+
+def _lookup_memo(memo_key):
+    """メモ化された判定結果を返す（未判定なら None）"""
+    with _judge_lock:
+        if memo_key in _judge_memo:
+            JUDGE_STATS["memo_hit"] += 1
+            _judge_memo.move_to_end(memo_key)
+            return _judge_memo[memo_key]
+    return None
+
+def _record_verdict(memo_key, verdict, stat):
+    with _judge_lock:
+        _judge_memo[memo_key] = verdict
+        _judge_memo.move_to_end(memo_key)
+        while len(_judge_memo) > Config.JUDGE_MEMO_MAX_ENTRIES:
+            _judge_memo.popitem(last=False)
+        JUDGE_STATS[stat] += 1
+    if not verdict:
+        TELEMETRY.event("judge_rejection", judged_by=stat)
+
+def judge_utterance(client, utterance, persona_profile, usage_log=None):
+    """
+    発話とプロフィールの一貫性を判定する。まずローカルのルールで判定し、
+    判断できない発話だけを LLM-as-a-judge に回す。判定結果は (発話, プロフィール) ごとにメモ化する。
+    """
+    memo_key = _memo_key(utterance, persona_profile)
+    memo = _lookup_memo(memo_key)
+    if memo is not None:
+        return memo
+
+    verdict, reason = prejudge_utterance(utterance, persona_profile)
+    if verdict is None:
+        verdict = is_utterance_consistent_with_llm(client, utterance, persona_profile, usage_log)
+        stat = "llm"
+    elif verdict:
+        stat = "local_consistent"
+    else:
+        stat = "local_contradiction"
+        print(f"\n⚠️ 矛盾検知(ローカル判定): {reason}")
+
+    _record_verdict(memo_key, verdict, stat)
+    return verdict
+
+def build_batch_judge_request(utterances, persona_profile):
+    """複数の発話をまとめて判定する LLM-as-a-judge のリクエストのパラメータを作る"""
+    profile_text = "\n".join([f"- {key}: {value}" for key, value in persona_profile.items()])
+    judge_prompt = f"""
+あなたは、事実の矛盾を厳密にチェックする、高性能な判定AIです。
+# ペルソナの確定情報
+{profile_text}
+# あなたのタスク
+ユーザーから与えられる、番号付きの「判定対象の発話」のそれぞれについて、「ペルソナの確定情報」と明確に矛盾する内容を含んでいるかどうかを判定してください。
+判定結果を、すべての発話について、必ず以下のJSON形式で出力してください。
+{{
+  "verdicts": [
+    {{"index": 発話の番号, "is_consistent": boolean, "reason": "矛盾している、あるいはしていないと判断した簡潔な理由"}}
+  ]
+}}
+"""
+    numbered = "\n".join(f"[{i}] 「{utterance}」" for i, utterance in enumerate(utterances, 1))
+    return {
+        "model": Config.MODEL_ROUTES["judge"]["model"],
+        "messages": [
+            {"role": "system", "content": judge_prompt},
+            {"role": "user", "content": f"# 判定対象の発話\n{numbered}"}
+        ],
+        "response_format": {"type": "json_object"},
+        "temperature": 0.0,
+    }
+
+def judge_utterances_with_llm(client, utterances, persona_profile, usage_log=None):
+    """複数の発話を、1回の LLM-as-a-judge の呼び出しでまとめて判定し、発話ごとの判定結果のリストを返す"""
     try:
-        with open(persona_filepath, 'r', encoding='utf-8') as f:
-            persona_data = json.load(f)
-    except FileNotFoundError: return
-
-    facts_to_inject = random.sample(persona_data["other_facts"], Config.NUM_INJECTIONS)
-    injection_turns = sorted(random.sample(range(5, Config.NUM_TURNS - 5, 2), Config.NUM_INJECTIONS))
-    injection_metadata = []
-    dialogue_history = [{"speaker": "assistant", "content": "こんにちは！お元気ですか？"}]
-    
-    for turn_num in tqdm(range(1, Config.NUM_TURNS + 1), desc=f"ペルソナ {persona_id} 対話生成中"):
+        with TELEMETRY.tags(kind="judge"):
+            response = client.chat.completions.create(**build_batch_judge_request(utterances, persona_profile))
+        record_usage(usage_log, "judge", response)
+        verdicts = {}
+        for item in json.loads(response.choices[0].message.content).get("verdicts", []):
+            if isinstance(item, dict) and isinstance(item.get("index"), int):
+                verdicts[item["index"]] = item
+                if not item.get("is_consistent", True):
+                    print(f"\n⚠️ 矛盾検知(LLM-as-a-judge): {item.get('reason')}")
+        # 判定が返ってこなかった発話は、単体の判定でAPIエラーが起きた場合と同じく、一貫しているとみなす
+        return [verdicts.get(i, {}).get("is_consistent", True) is not False for i in range(1, len(utterances) + 1)]
+    except BudgetExceeded:
+        raise
+    except Exception as e:
+        print(f"  - 判定APIエラー: {e}")
+        TELEMETRY.record_error(e)
+        return [True] * len(utterances)
+
+def judge_candidates(client, candidates, persona_profile, usage_log=None):
+    """
+    候補発話を判定し、(採用する候補のインデックス（すべて矛盾していれば None）, 候補ごとの判定結果) を返す。
+    メモ化・ローカルのルールで一貫していると分かった候補があれば、LLMを呼ばずにそれを採用する。
+    そうでなければ、ルールで判断できなかった候補を1回のLLM呼び出しでまとめて判定し、最初に一貫していた候補を採用する。
+    判定結果は True（一貫）/ False（矛盾）/ None（判定不要だったもの）。
+    """
+    verdicts = [None] * len(candidates)
+    ambiguous = []
+    for index, candidate in enumerate(candidates):
+        memo_key = _memo_key(candidate, persona_profile)
+        verdict = _lookup_memo(memo_key)
+        if verdict is None:
+            verdict, reason = prejudge_utterance(candidate, persona_profile)
+            if verdict is None:
+                ambiguous.append(index)
+                continue
+            _record_verdict(memo_key, verdict, "local_consistent" if verdict else "local_contradiction")
+            if not verdict:
+                print(f"\n⚠️ 矛盾検知(ローカル判定): {reason}")
+        verdicts[index] = verdict
+        if verdict:
+            return index, verdicts
+
+    if ambiguous:
+        llm_verdicts = judge_utterances_with_llm(client, [candidates[i] for i in ambiguous], persona_profile, usage_log)
+        with _judge_lock:
+            JUDGE_STATS["llm_batch_calls"] += 1
+        for index, verdict in zip(ambiguous, llm_verdicts):
+            _record_verdict(_memo_key(candidates[index], persona_profile), verdict, "llm")
+            verdicts[index] = verdict
+        for index in ambiguous:
+            if verdicts[index]:
+                return index, verdicts
+    return None, verdicts
+
+def generate_user_utterance_candidates(client, messages, temperature, persona_profile, turn_usage, candidate_stats):
+    """
+    1回のリクエストで Config.NUM_CANDIDATES 個のユーザー発話の候補を生成し、まとめて判定して採用する発話を返す。
+    1ターンあたりのAPI往復は、生成と判定の最大2回。すべての候補が矛盾していた場合は、最初の候補を採用する。
+    """
+    with TELEMETRY.tags(kind="generate"):
+        response = client.chat.completions.create(
+            model=Config.MODEL_ROUTES["generator"]["model"], messages=messages, n=Config.NUM_CANDIDATES,
+            temperature=temperature, presence_penalty=Config.PRESENCE_PENALTY
+        )
+    record_usage(turn_usage, "generate", response)
+    candidates = []
+    for choice in response.choices:
+        text = (choice.message.content or "").strip()
+        if text and text not in candidates:
+            candidates.append(text)
+    if not candidates:
+        raise ValueError("候補発話が空でした")
+    candidate_stats["generated"] += len(response.choices)
+
+    accepted, verdicts = judge_candidates(client, candidates, persona_profile, turn_usage)
+    candidate_stats["rejected"] += sum(verdict is False for verdict in verdicts)
+    if accepted is None:
+        print(f"\n❌ 全ての候補（{len(candidates)}件）が矛盾と判定されました。最初の候補を採用します。")
+        candidate_stats["fallback"] += 1
+        return candidates[0]
+    candidate_stats["accepted_index"] = accepted
+    return candidates[accepted]
+
+def format_judge_stats():
+    total = sum(JUDGE_STATS[stat] for stat in ("llm", "local_consistent", "local_contradiction", "memo_hit"))
+    avoided = total - JUDGE_STATS["llm"]
+    avoided_rate = avoided / total * 100 if total else 0.0
+    return (
+        f"一貫性判定: 合計 {total}件 / LLM判定 {JUDGE_STATS['llm']}件 / "
+        f"ローカル判定（一貫） {JUDGE_STATS['local_consistent']}件 / ローカル判定（矛盾） {JUDGE_STATS['local_contradiction']}件 / "
+        f"メモ化ヒット {JUDGE_STATS['memo_hit']}件 → LLM判定の回避率 {avoided_rate:.1f}%"
+        + (f"（複数候補のまとめての判定 {JUDGE_STATS['llm_batch_calls']}回）" if JUDGE_STATS['llm_batch_calls'] else "")
+    )
+
+class TurnGenerationError(Exception):
+    """API呼び出しの失敗により、ターンを生成できなかったことを表す（そのターンは生成ログに記録しない）"""
+
+    def __init__(self, persona_id, turn):
+        super().__init__(f"ペルソナ {persona_id} のターン{turn}を生成できませんでした")
+        self.persona_id = persona_id
+        self.turn = turn
+
+def generate_dialogue_for_persona(persona_id, client=None, progress=None):
+    """
+    1ペルソナ分の対話を生成する。
+    client を省略した場合はこのペルソナ専用のクライアントを作成する。
+    progress（tqdm）を渡した場合は、ターンごとにその進捗バーを進める（複数ペルソナの並列実行用）。
+    完了したターンは1つずつ生成ログに追記し、中断後の再実行時は次のターンから再開する。
+    API呼び出しが再試行の上限まで失敗した場合は、仮の文章を書き込まずに TurnGenerationError を送出する。
+    予算の上限に達した場合は、そのターンを記録せずに BudgetExceeded を送出する。
+    Config.LONG_DIALOGUE が True の場合は、要約と索引（DialogueMemory）で1ターンあたりのプロンプトの大きさを一定に保つ。
+    要約も生成ログに記録するため、再開時は要約を作り直さない。
+    """
+    print(f"--- ペルソナID: {persona_id} の対話生成を開始します ---")
+    if client is None:
+        client = create_client()
+    persona_data = load_persona(persona_id)
+    if persona_data is None: return None
+
+    log = GenerationLog(dialogue_log_path(persona_id))
+    plan, logged_turns = load_dialogue_log(log)
+    if plan is None:
+        rng_seed = random.getrandbits(64)
+        rng = random.Random(rng_seed)
+        facts_to_inject, injection_turns = plan_injections(rng, persona_data["other_facts"])
+        plan = {
+            "type": "plan",
+            "persona_id": persona_id,
+            "rng_seed": rng_seed,
+            "facts_to_inject": facts_to_inject,
+            "injection_turns": injection_turns,
+            "opening": "こんにちは！お元気ですか？",
+        }
+        if Config.LONG_DIALOGUE:
+            plan["long_dialogue"] = True
+        log.append(plan)
+    facts_to_inject = plan["facts_to_inject"]
+    injection_turns = plan["injection_turns"]
+    dialogue_history = [{"speaker": "assistant", "content": plan["opening"]}]
+    dialogue_history += [{"speaker": turn["speaker"], "content": turn["content"]} for turn in logged_turns]
+    memory = None
+    if plan.get("long_dialogue"):
+        memory = DialogueMemory()
+        for turn in logged_turns:
+            memory.record_turn(turn["turn"], turn["speaker"], turn["content"], turn.get("injection"), turn.get("strategy"))
+        summaries = load_dialogue_summaries(log)
+        if summaries:
+            memory.update_summary(summaries[-1]["content"], summaries[-1]["until"])
+    if logged_turns:
+        print(f"↻ ペルソナ {persona_id}: 生成ログから{len(logged_turns)}ターンを復元し、ターン{len(logged_turns) + 1}から再開します。")
+
+    turns = range(len(logged_turns) + 1, Config.NUM_TURNS + 1)
+    if progress is None:
+        turns = tqdm(turns, desc=f"ペルソナ {persona_id} 対話生成中")
+    else:
+        progress.update(len(logged_turns))
+    for turn_num in turns:
+        # 乱数はシードとターン番号から作るため、どのターンから再開しても同じ戦略選択が再現される
+        rng = random.Random(f"{plan['rng_seed']}:{turn_num}")
+        injection = None
         current_role = "user" if turn_num % 2 != 0 else "assistant"
-        prompt = ""
         temperature = 0.85
-        
+        turn_usage = []
+        strategy = recall = None
+
+        if memory is not None and len(dialogue_history) - memory.summarized_until >= Config.HISTORY_WINDOW + Config.SUMMARY_INTERVAL:
+            # 会話履歴が長くなったら、古い方のターンを要約に畳み込む（失敗した場合は、通常のターンと同じく後で再開する）
+            try:
+                with TELEMETRY.tags(phase="C", persona_id=persona_id, turn=turn_num, role="summary"):
+                    summary = summarize_history(client, memory, dialogue_history)
+            except BudgetExceeded:
+                log.close()
+                raise
+            except Exception as e:
+                TELEMETRY.record_error(e)
+                log.close()
+                raise TurnGenerationError(persona_id, turn_num) from e
+            log.append({**summary, "turn": turn_num})
+            memory.update_summary(summary["content"], summary["until"])
+
         if current_role == "user":
             if turn_num in injection_turns:
                 fact_index = injection_turns.index(turn_num)
                 fact_to_inject = facts_to_inject[fact_index]
-                prompt = create_dynamic_injection_prompt(persona_data, fact_to_inject, dialogue_history)
+                messages = create_dynamic_injection_prompt(persona_data, fact_to_inject, dialogue_history, memory)
                 temperature = 0.9
-                injection_metadata.append({
+                injection = {
                     "injection_turn": turn_num, "qa_id": fact_to_inject.get('id', 'N/A'),
+                    "qa_custom_id": fact_to_inject.get('custom_id', 'N/A'),
                     "category": fact_to_inject.get('category', 'N/A'), "core_fact_answer": fact_to_inject.get('answer', 'N/A')
-                })
+                }
             else:
-                profile_text = "\n".join([f"- {key}: {value}" for key, value in persona_data["persona"]["profile"].items()])
-                prompt = f"""直前の相手の発言「{dialogue_history[-1]['content']}」に対し、以下のペルソナとして自然に応答してください。\n# あなたのペルソナ情報（役割）\n{profile_text}\n# 【★★重要ルール★★】\n- これは継続した会話です。途中で「こんにちは」のような挨拶を繰り返さないでください。"""
+                messages = create_user_response_prompt(persona_data, dialogue_history, memory)
         else:
             # ★★★ あなたの「会話戦略」ロジックをここに統合 ★★★
-            strategy = random.choice(["deepen", "deepen", "connect", "new_topic", "reflect"])
-            instruction = ""
-            if strategy == "deepen":
-                instruction = "ユーザーの直前の発言内容について、さらに一歩踏み込んだオープンな質問を投げかけ、ユーザーの自己開示を促してください。"
-            elif strategy == "connect" and len(dialogue_history) > 10:
+            strategy = rng.choice(["deepen", "deepen", "connect", "new_topic", "reflect"])
+            past_utterance = None
+            if strategy == "connect" and memory is not None:
+                # 長い対話では、会話履歴から外れた別の話題の発言のうち、直前の発言に関連するものを思い出させる
+                recall = memory.recall(dialogue_history[-1]["content"], rng, memory.summarized_until, Config.RECALL_TOP_K)
+                if recall is not None:
+                    past_utterance = recall["content"]
+                    recall = {"past_turn": recall["turn"], "topic": recall["topic"], "score": recall.get("score", 0.0)}
+            if strategy == "connect" and past_utterance is None:
                 user_utterances = [turn['content'] for turn in dialogue_history if turn['speaker'] == 'user']
-                if user_utterances:
-                    past_utterance = random.choice(user_utterances[:-1])
-                    instruction = f"以前ユーザーが「{past_utterance[:30]}...」と話していたことを思い出し、現在の話題と自然に関連付けて会話を広げてください。"
+                if len(dialogue_history) > 10 and user_utterances[:-1]:
+                    past_utterance = rng.choice(user_utterances[:-1])
                 else:
                     strategy = "reflect" # フォールバック
-            elif strategy == "new_topic":
-                instruction = "現在の話題が一段落したと判断し、ユーザーが興味を持ちそうな、これまで話していない全く新しい雑談のトピックを自然に提案してください。"
-            
-            if not instruction or strategy == "reflect":
-                instruction = "ユーザーの発言内容を要約し、その内容に対するあなたの理解や共感を示してください。"
-
-            prompt = f"""あなたは聞き上手なAIアシスタントです。ユーザーの発言「{dialogue_history[-1]['content']}」に対して、以下の戦略に従って、親身に、かつ自然に応答してください。\n# 会話戦略\n{instruction}\n# 【★★重要ルール★★】\n- これは継続した会話です。途中で「こんにちは」のような挨拶を繰り返さないでください。\n- 会話を締めくくるような発言（「何か他にありますか？」など）は避け、常に対話が続くようなオープンな応答を心がけてください。"""
+            messages = create_assistant_prompt(dialogue_history, strategy, past_utterance, memory)
 
         max_retries = 3
         utterance = ""
-        for attempt in range(max_retries):
-            try:
-                response = client.chat.completions.create(
-                    model=Config.LLM_MODEL, messages=[{"role": "user", "content": prompt}],
-                    temperature=temperature, presence_penalty=Config.PRESENCE_PENALTY
-                )
-                temp_utterance = response.choices[0].message.content.strip()
-                if current_role == "user":
-                    if is_utterance_consistent_with_llm(client, temp_utterance, persona_data["persona"]["profile"]):
-                        utterance = temp_utterance
-                        break
-                    else:
-                        if attempt == max_retries - 1:
-                           print(f"\n❌ 再生成リトライ上限到達。")
-                           utterance = temp_utterance
+        # ユーザー発話の候補の生成数・却下数など（dialogue_pXX.metadata.json に記録する）
+        candidate_stats = Counter() if current_role == "user" else None
+        try:
+            with TELEMETRY.tags(phase="C", persona_id=persona_id, turn=turn_num, role=current_role):
+                if current_role == "user" and Config.NUM_CANDIDATES > 1:
+                    utterance = generate_user_utterance_candidates(
+                        client, messages, temperature, persona_data["persona"]["profile"], turn_usage, candidate_stats)
                 else:
-                    utterance = temp_utterance
-                    break
-            except Exception as e:
-                utterance = "(エラーにより発話生成に失敗しました)"
-                break
+                    for attempt in range(max_retries):
+                        if attempt:
+                            TELEMETRY.event("retry", attempt=attempt)
+                        with TELEMETRY.tags(attempt=attempt):
+                            with TELEMETRY.tags(kind="generate"):
+                                response = client.chat.completions.create(
+                                    model=Config.MODEL_ROUTES["generator"]["model"], messages=messages,
+                                    temperature=temperature, presence_penalty=Config.PRESENCE_PENALTY
+                                )
+                            record_usage(turn_usage, "generate", response)
+                            temp_utterance = response.choices[0].message.content.strip()
+                            if current_role == "user":
+                                candidate_stats["generated"] += 1
+                                if judge_utterance(client, temp_utterance, persona_data["persona"]["profile"], turn_usage):
+                                    candidate_stats["accepted_index"] = attempt
+                                    utterance = temp_utterance
+                                    break
+                                else:
+                                    candidate_stats["rejected"] += 1
+                                    if attempt == max_retries - 1:
+                                       print(f"\n❌ 再生成リトライ上限到達。")
+                                       candidate_stats["fallback"] += 1
+                                       utterance = temp_utterance
+                            else:
+                                utterance = temp_utterance
+                                break
+        except BudgetExceeded:
+            # 予算の上限で止まったターンも記録しない（上限を見直して再実行すれば、このターンから再開される）
+            log.close()
+            raise
+        except Exception as e:
+            TELEMETRY.record_error(e)
+            # 失敗したターンは記録せずに中断する（次の実行時や再投入時に、このターンから再開される）
+            log.close()
+            raise TurnGenerationError(persona_id, turn_num) from e
+        if candidate_stats is not None:
+            candidate_stats["round_trips"] = len(turn_usage)
         dialogue_history.append({"speaker": current_role, "content": utterance})
-        time.sleep(1)
+        entry = {"type": "turn", "turn": turn_num, "speaker": current_role, "content": utterance,
+                 "injection": injection, "usage": turn_usage,
+                 "candidates": dict(candidate_stats) if candidate_stats is not None else None}
+        if memory is not None:
+            # 再開時に話題の区切りと思い出させた発言を復元できるよう、戦略も記録する
+            entry.update(strategy=strategy, recall=recall)
+            memory.record_turn(turn_num, current_role, utterance, injection, strategy)
+        log.append(entry)
+        with _usage_lock:
+            USAGE_CALLS.extend(turn_usage)
+        if progress is not None:
+            progress.update(1)
 
-    if not os.path.exists(Config.OUTPUT_DIR): os.makedirs(Config.OUTPUT_DIR)
-    output_filename = os.path.join(Config.OUTPUT_DIR, f"dialogue_p{persona_id:02d}.json")
-    with open(output_filename, 'w', encoding='utf-8') as f: json.dump(dialogue_history, f, indent=2, ensure_ascii=False)
-    print(f"\n✅ 対話生成が完了し、'{output_filename}' に保存しました。")
-    metadata_filename = os.path.join(Config.OUTPUT_DIR, f"dialogue_p{persona_id:02d}.metadata.json")
-    with open(metadata_filename, 'w', encoding='utf-8') as f: json.dump(injection_metadata, f, indent=2, ensure_ascii=False)
-    print(f"✅ 注入メタデータを '{metadata_filename}' に保存しました。")
+    log.close()
+    return compile_dialogue_from_log(persona_id, log)
+
+# ドライランで、ペルソナが1人も作成されていない場合に使う仮のペルソナ
+STAND_IN_PERSONA = {
+    "persona_id": 0,
+    "persona": {"profile": {"name": "山田花子", "birthday": "4月1日", "from": "東京都"}, "source_anchor_facts": []},
+    "other_facts": [],
+}
+
+def estimate_dialogue_generation(start_persona_id, end_persona_id):
+    """
+    run_dialogue_generation を実行した場合のAPI呼び出し数・トークン数・コストを、APIを呼ばずに見積もる（ドライラン）。
+    ターンごとに実際のメッセージ列（システムプロンプト・会話履歴の範囲・指示）を組み立てて数え、
+    会話履歴の各発話は Config.ESTIMATED_UTTERANCE_TOKENS トークンとする。
+    既に対話があるペルソナと、生成ログ上で完了済みのターンは除く。ペルソナがまだ無い場合は、
+    読み込めた他のペルソナ（1人も無ければ仮のペルソナ）で代用する。
+    長い対話モードでは、要約の呼び出しも実際と同じ間隔で数え、要約と注入済みの事実は上限いっぱいの長さとする。
+    """
+    generator, judge = Config.MODEL_ROUTES["generator"]["model"], Config.MODEL_ROUTES["judge"]["model"]
+    utterance_tokens = Config.ESTIMATED_UTTERANCE_TOKENS
+    attempts = 1 + Config.ESTIMATED_REJECTION_RATE
+    persona_ids = [persona_id for persona_id in range(start_persona_id, end_persona_id + 1) if not dialogue_exists(persona_id)]
+    estimate = CostEstimate(f"フェーズC（対話 {len(persona_ids)}人 × {Config.NUM_TURNS}ターン"
+                            f"{'・長い対話モード' if Config.LONG_DIALOGUE else ''}）")
+    stand_ins = 0
+    representative = None
+
+    for persona_id in persona_ids:
+        persona_data = load_persona(persona_id)
+        if persona_data is None:
+            if representative is None:
+                representative = next(
+                    (persona for persona in map(load_persona, range(start_persona_id, end_persona_id + 1)) if persona), STAND_IN_PERSONA)
+            persona_data = representative
+            stand_ins += 1
+        profile = persona_data["persona"]["profile"]
+        log_path = dialogue_log_path(persona_id)
+        plan, logged_turns = load_dialogue_log(GenerationLog(log_path)) if os.path.exists(log_path) else (None, [])
+        if plan is None and Config.LONG_DIALOGUE:
+            pool = persona_data["other_facts"] or [{"category": "", "answer": ""}] * (Config.NUM_TURNS // Config.INJECTION_INTERVAL)
+            facts, turns = plan_injections(random.Random(persona_id), pool)
+            plan = {"facts_to_inject": facts, "injection_turns": turns, "long_dialogue": True}
+        elif plan is None:
+            facts = (persona_data["other_facts"] or [{"category": "", "answer": ""}]) * Config.NUM_INJECTIONS
+            plan = {"facts_to_inject": facts[:Config.NUM_INJECTIONS],
+                    "injection_turns": list(range(5, Config.NUM_TURNS - 5, 2))[:Config.NUM_INJECTIONS]}
+        memory = None
+        if plan.get("long_dialogue"):
+            memory = DialogueMemory()
+            summaries = load_dialogue_summaries(GenerationLog(log_path)) if os.path.exists(log_path) else []
+            memory.update_summary("あ" * Config.SUMMARY_MAX_CHARS if summaries else "", summaries[-1]["until"] if summaries else 0)
+            for turn in logged_turns:
+                if turn.get("injection"):
+                    memory.record_turn(turn["turn"], "user", "あ" * 60, turn["injection"])
+
+        for turn_num in range(len(logged_turns) + 1, Config.NUM_TURNS + 1):
+            # 会話履歴は、冒頭の挨拶と、このターンより前のターン
+            dialogue_history = [{"speaker": "assistant", "content": ""}] * turn_num
+            if memory is not None and turn_num - memory.summarized_until >= Config.HISTORY_WINDOW + Config.SUMMARY_INTERVAL:
+                summary_request = build_summary_request(memory.summary, dialogue_history[:Config.SUMMARY_INTERVAL])
+                estimate.add("会話の要約", generator,
+                             count_message_tokens(summary_request["messages"], generator) + Config.SUMMARY_INTERVAL * utterance_tokens,
+                             Config.SUMMARY_MAX_TOKENS)
+                memory.update_summary("あ" * Config.SUMMARY_MAX_CHARS, memory.summarized_until + Config.SUMMARY_INTERVAL)
+            if memory is None:
+                history_tokens = len(history_messages(dialogue_history, "user")) * utterance_tokens
+            else:
+                history_tokens = (turn_num - memory.summarized_until) * utterance_tokens
+            if turn_num % 2 == 0:
+                messages = create_assistant_prompt(dialogue_history, "deepen", memory=memory)
+                estimate.add("アシスタント発話", generator, count_message_tokens(messages, generator) + history_tokens, utterance_tokens)
+                continue
+            if turn_num in plan["injection_turns"]:
+                fact = plan["facts_to_inject"][plan["injection_turns"].index(turn_num)]
+                messages = create_dynamic_injection_prompt(persona_data, fact, dialogue_history, memory)
+                if memory is not None:
+                    memory.record_turn(turn_num, "user", "あ" * 60, {"category": fact.get("category")})
+            else:
+                messages = create_user_response_prompt(persona_data, dialogue_history, memory)
+            prompt_tokens = count_message_tokens(messages, generator) + history_tokens
+            if Config.NUM_CANDIDATES > 1:
+                # 候補をまとめて生成・判定するため、往復は生成と判定の最大2回
+                judge_tokens = count_message_tokens(build_batch_judge_request([""] * Config.NUM_CANDIDATES, profile)["messages"], judge)
+                estimate.add("ユーザー発話（候補の生成）", generator, prompt_tokens, utterance_tokens * Config.NUM_CANDIDATES)
+                estimate.add("一貫性判定（まとめて判定）", judge, judge_tokens + utterance_tokens * Config.NUM_CANDIDATES,
+                             Config.ESTIMATED_JUDGE_COMPLETION_TOKENS * Config.NUM_CANDIDATES,
+                             expected_calls=Config.ESTIMATED_JUDGE_RATE, max_calls=1)
+            else:
+                # 候補を1つずつ生成・判定し、矛盾と判定されると最大3回まで作り直す
+                judge_tokens = count_message_tokens(build_judge_request("", profile)["messages"], judge)
+                estimate.add("ユーザー発話", generator, prompt_tokens, utterance_tokens, expected_calls=attempts, max_calls=3)
+                estimate.add("一貫性判定", judge, judge_tokens + utterance_tokens, Config.ESTIMATED_JUDGE_COMPLETION_TOKENS,
+                             expected_calls=Config.ESTIMATED_JUDGE_RATE * attempts, max_calls=3)
+
+    if stand_ins:
+        estimate.note(f"{stand_ins}人分のペルソナが見つからないため、"
+                      f"{'仮のペルソナ' if representative is STAND_IN_PERSONA else '作成済みのペルソナ'}で代用しています。")
+    return estimate
+
+def run_dialogue_generation(start_persona_id, end_persona_id, max_concurrency=None):
+    """
+    複数ペルソナの対話を並列に生成するスケジューラ。
+    各ペルソナの対話は自身の履歴にしか依存しないため、ペルソナ単位で並列化する。
+    同時に生成するペルソナ数は max_concurrency で、API呼び出しのペースは全ペルソナ共有の RateLimiter で制限する。
+    既に対話が存在する（dialogue_pXX.json、またはデータセットにレコードがある）ペルソナはスキップする。
+    予算の上限に達したペルソナは再投入せず、生成ログに残ったターンから次回の実行で再開する。
+    """
+    max_concurrency = max_concurrency or Config.MAX_CONCURRENCY
+    persona_ids = []
+    for persona_id in range(start_persona_id, end_persona_id + 1):
+        if dialogue_exists(persona_id):
+            print(f"☑ ペルソナ {persona_id} の対話は既に存在するため、スキップします。")
+        else:
+            persona_ids.append(persona_id)
+
+    print(f"【INFO】{len(persona_ids)}人分の対話を、最大{max_concurrency}人ずつ並列に生成します。")
+    client = create_client(max_concurrency)
+    print(f"モデルの振り分け: {client.describe_routes()}")
+    completed, failed, paused = [], [], []
+    requeues = Counter()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor, \
+            tqdm(total=len(persona_ids) * Config.NUM_TURNS, desc="全ペルソナ対話生成中") as progress:
+        pending = {
+            executor.submit(generate_dialogue_for_persona, persona_id, client, progress): persona_id
+            for persona_id in persona_ids
+        }
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                persona_id = pending.pop(future)
+                try:
+                    output_filename = future.result()
+                except BudgetExceeded as e:
+                    if not paused:
+                        print(f"\n⏸ {e}。生成中のペルソナは完了したターンまでを記録して停止します。")
+                    paused.append(persona_id)
+                    progress.set_postfix(完了=len(completed), 失敗=len(failed), 停止=len(paused))
+                    continue
+                except TurnGenerationError as e:
+                    # 生成できたターンまでは生成ログに残っているので、キューの末尾に入れ直して失敗したターンから再開する
+                    # （再開時に記録済みのターン数だけ進捗バーが進むため、その分を先に戻しておく）
+                    progress.update(-(e.turn - 1))
+                    if requeues[persona_id] < Config.MAX_TURN_REQUEUES:
+                        requeues[persona_id] += 1
+                        print(f"\n↻ {e}。後で再開します（{requeues[persona_id]}/{Config.MAX_TURN_REQUEUES}回目）。")
+                        pending[executor.submit(generate_dialogue_for_persona, persona_id, client, progress)] = persona_id
+                        continue
+                    output_filename = None
+                    print(f"\n❌ {e}。再投入の上限に達したため、このペルソナは次回の実行で再開します。")
+                except Exception as e:
+                    output_filename = None
+                    print(f"\n❌ ペルソナ {persona_id} の対話生成中にエラーが発生しました: {e}")
+                if output_filename:
+                    completed.append(persona_id)
+                else:
+                    failed.append(persona_id)
+                    # 生成できなかったペルソナの分も進捗バーを進め、全体の件数を合わせる
+                    progress.update(Config.NUM_TURNS)
+                progress.set_postfix(完了=len(completed), 失敗=len(failed))
+
+    print(f"\n完了: {len(completed)}人 / 失敗・ペルソナ未検出: {len(failed)}人"
+          + (f" / 予算の上限で停止: {len(paused)}人" if paused else ""))
+    print(client.cache.format_stats())
+    print(client.governor.format_stats())
+    print(client.budget.format_stats())
+    print(format_judge_stats())
+    print(format_usage(summarize_usage(USAGE_CALLS)))
+    print(TELEMETRY.format_summary())
+    TELEMETRY.close()
+    if Config.OUTPUT_FORMAT == "sharded":
+        print(dialogue_store().describe())
+    close_stores()
+    if failed:
+        print(f"  - 失敗したペルソナID: {sorted(failed)}")
+    if paused:
+        print(f"⏸ 予算の上限に達したため停止しました（ペルソナID: {sorted(paused)}）。"
+              "上限（Config.BUDGET_USD / BUDGET_TOKENS）を見直して再実行すると、生成ログの続きから再開します。")
+    return completed, failed
 
 
 if __name__ == "__main__":
+    import argparse
+
     START_PERSONA_ID = 1
     END_PERSONA_ID = 100 
 
-    print(f"【INFO】ペルソナID {START_PERSONA_ID} から {END_PERSONA_ID} までの大規模対話生成を開始します。")
-    for i in range(START_PERSONA_ID, END_PERSONA_ID + 1):
-        print("\n" + "="*50)
-        generate_dialogue_for_persona(persona_id=i)
-        print("="*50)
-        if i < END_PERSONA_ID:
-            print(f"\nペルソナ {i} の生成完了。次のペルソナに進む前に30秒待機します...")
-            time.sleep(30)
+    parser = argparse.ArgumentParser(description="ペルソナベースの対話生成")
+    parser.add_argument('--dry_run', action='store_true', help='APIを呼ばずに、未完了分のAPI呼び出し数・トークン数・コストの見積もりを表示する')
+    parser.add_argument('--budget_usd', type=float, default=None, help='推定コスト（USD）の上限（省略時は Config.BUDGET_USD）')
+    parser.add_argument('--budget_tokens', type=int, default=None, help='トークン数の上限（省略時は Config.BUDGET_TOKENS）')
+    parser.add_argument('--num_turns', type=int, default=None, help='1対話あたりのターン数（省略時は Config.NUM_TURNS）')
+    parser.add_argument('--long_dialogue', action='store_true', help='長い対話モード（要約と索引で、1ターンあたりのプロンプトの大きさを一定に保つ）')
+    # Colabのカーネルが渡す引数は無視する
+    args, _ = parser.parse_known_args()
+    if args.num_turns is not None:
+        Config.NUM_TURNS = args.num_turns
+    if args.long_dialogue:
+        Config.LONG_DIALOGUE = True
+    if args.budget_usd is not None:
+        Config.BUDGET_USD = args.budget_usd
+    if args.budget_tokens is not None:
+        Config.BUDGET_TOKENS = args.budget_tokens
+
+    if args.dry_run:
+        print(estimate_dialogue_generation(START_PERSONA_ID, END_PERSONA_ID).format(Config.BUDGET_USD))
+    else:
+        print(f"【INFO】ペルソナID {START_PERSONA_ID} から {END_PERSONA_ID} までの大規模対話生成を開始します。")
+        run_dialogue_generation(START_PERSONA_ID, END_PERSONA_ID)
 
-    print("\n🎉 全てのペルソナの対話生成が完了しました！")
+        print("\n🎉 全てのペルソナの対話生成が完了しました！")
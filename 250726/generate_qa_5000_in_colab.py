@@ -1,26 +1,49 @@
 # generate_qa_5000_in_colab.py
 import os
+import glob
 import json
-import time
 import math
-from openai import OpenAI
-from tqdm.notebook import tqdm  # Colabのtqdmに変更
+import time
+from itertools import islice
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from tqdm.auto import tqdm  # Colabではノートブック用、ローカルではターミナル用の進捗バーになる
+from llm_backend import ClientConfig, build_client
+from generation_log import GenerationLog
+from dedup_index import NearDuplicateIndex
+from telemetry import TELEMETRY
+from budget import BudgetExceeded, CostEstimate, count_message_tokens
+from topup_planner import ScanCache, assess_dataset, build_topup_plan, compute_deficits, find_sources, format_assessment
 
 # ---------------------------------
 # 1. 設定と計画
 # ---------------------------------
-class Config:
+class Config(ClientConfig):
     """設定を管理するクラス"""
-    try:
-        from google.colab import userdata
-        API_KEY = userdata.get("OPENAI-KEY")
-    except (ImportError, KeyError):
-        API_KEY = os.environ.get("OPENAI_API_KEY", "YOUR_API_KEY_HERE")
-
-    LLM_MODEL = "gpt-4o"
+    # 役割ごとのモデルと接続先（API_KEY・BASE_URL・レート制限・再試行・応答キャッシュ・予算の上限などの共通の設定は、
+    # llm_backend.py の ClientConfig を参照）
+    MODEL_ROUTES = {
+        "generator": {"model": "gpt-4o"},
+    }
     TEMPERATURE = 0.95
     # バッチファイルの出力先ディレクトリ
     BATCH_OUTPUT_DIR = "batches"
+    # 完了したQAペアを1件ずつ記録する生成ログ（BATCH_OUTPUT_DIR 内に作成）
+    QA_LOG_FILENAME = "qa_generation.log.jsonl"
+    # 近似重複インデックス（BATCH_OUTPUT_DIR 内に保存）と、重複とみなす推定Jaccard類似度
+    DEDUP_INDEX_FILENAME = "dedup_index.json"
+    DEDUP_THRESHOLD = 0.7
+    # 追加生成（--mode topup）で既存のバッチファイルを走査した結果のキャッシュ（BATCH_OUTPUT_DIR 内に作成）
+    TOPUP_SCAN_CACHE_FILENAME = "topup_scan_cache.sqlite3"
+    # 並列生成の設定（同時に処理するリクエスト数と、1分あたりの上限）
+    MAX_CONCURRENCY = 16
+    MAX_RETRIES = 3
+    # 1回のリクエストで生成するQAペアの件数（1なら1件ずつ。2以上なら、計画の順に並んだ未完了スロットをこの件数ずつまとめて生成し、
+    # システムプロンプトとルールの入力トークンを複数件で分け合う）
+    ITEMS_PER_REQUEST = 1
+    # ドライラン（--dry_run）の見積もりに使う、1件あたりの生成トークン数と、不正な出力・近似重複による再試行の想定割合
+    ESTIMATED_COMPLETION_TOKENS = 200
+    ESTIMATED_RETRY_RATE = 0.1
 
 def get_full_generation_plan(total_items=5000):
     """5,000件規模の全体計画を生成する"""
@@ -54,12 +77,8 @@ def get_full_generation_plan(total_items=5000):
 # ---------------------------------
 # 2. QAペア生成のコアロジック (v4から流用)
 # ---------------------------------
-def generate_qa_pair(client, category):
-    """高品質なQAペアを1つ生成する（プロンプトは検証済みのものをそのまま使用）"""
-    system_prompt = "あなたは、人間らしい記憶に関する、高品質で創造的なデータセットを生成する専門家です。"
-    user_prompt = f"""
-以下の厳格なルールに従い、「{category}」に関する高品質なQAペアを1つ生成してください。
-# ルール
+# QAペアの品質に関するルール（1件ずつ生成する場合と、まとめて生成する場合で共通）
+QA_RULES = """# ルール
 1.  **回答(Answer)の要件**:
     - アシスタントがユーザーの記憶を確認する形式で、必ず「はい、...」で始めてください。
     - カテゴリに合致する中核的な事実（コア・ファクト）を明確に含んでください。
@@ -69,7 +88,14 @@ def generate_qa_pair(client, category):
     - ユーザーがアシスタントの記憶力を試すような、自然な問いかけにしてください。
     - 【最重要】質問は、あなたが上記ルール1で生成する回答文の中の「コア・ファクト」を、直接的に問う内容でなければなりません。
     - **質問文の主題と疑問詞（例：「何」「誰」「どんな」）は、必ず「コア・ファクト」そのものに向けられていなければなりません。関連する他の情報（例：イベント名、場所、時間）を問う質問は許可しません。**
-    - 質問と回答は、論理的に完全に一貫していなければなりません。
+    - 質問と回答は、論理的に完全に一貫していなければなりません。"""
+
+def build_qa_request(category):
+    """QAペア1つ分のchat.completionsリクエストのパラメータを作る（プロンプトは検証済みのものをそのまま使用）"""
+    system_prompt = "あなたは、人間らしい記憶に関する、高品質で創造的なデータセットを生成する専門家です。"
+    user_prompt = f"""
+以下の厳格なルールに従い、「{category}」に関する高品質なQAペアを1つ生成してください。
+{QA_RULES}
 # 出力形式
 - 必ず以下のJSON形式で出力してください。
 {{
@@ -78,30 +104,235 @@ def generate_qa_pair(client, category):
   "answer": "生成した回答"
 }}
 """
+    return {
+        "model": Config.MODEL_ROUTES["generator"]["model"],
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        "response_format": {"type": "json_object"},
+        "temperature": Config.TEMPERATURE,
+    }
+
+def build_multi_qa_request(categories):
+    """
+    複数のQAペア（カテゴリのリスト。同じカテゴリが続いてもよい）を1回で生成するリクエストのパラメータを作る。
+    ルールは build_qa_request と同じものを使い、結果は番号付きの "items" 配列で受け取る。
+    """
+    system_prompt = "あなたは、人間らしい記憶に関する、高品質で創造的なデータセットを生成する専門家です。"
+    numbered = "\n".join(f"[{i}] {category}" for i, category in enumerate(categories, 1))
+    user_prompt = f"""
+以下の厳格なルールに従い、番号付きの「生成するQAペア」のそれぞれについて、指定されたカテゴリに関する高品質なQAペアを1つずつ生成してください。
+同じカテゴリが複数ある場合は、それぞれ異なる事実とエピソードにしてください。
+{QA_RULES}
+# 出力形式
+- 必ず以下のJSON形式で、すべての番号について出力してください。
+{{
+  "items": [
+    {{"index": 番号, "category": "カテゴリ", "question": "生成した質問", "answer": "生成した回答"}}
+  ]
+}}
+# 生成するQAペア
+{numbered}
+"""
+    return {
+        "model": Config.MODEL_ROUTES["generator"]["model"],
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        "response_format": {"type": "json_object"},
+        "temperature": Config.TEMPERATURE,
+    }
+
+def generate_qa_pair(client, category):
+    """高品質なQAペアを1つ生成する"""
     try:
-        response = client.chat.completions.create(
-            model=Config.LLM_MODEL,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            response_format={"type": "json_object"},
-            temperature=Config.TEMPERATURE,
-        )
+        response = client.chat.completions.create(**build_qa_request(category))
         return json.loads(response.choices[0].message.content)
+    except BudgetExceeded:
+        # 予算の上限による停止は、不正な出力として再試行せずにそのまま呼び出し元に伝える
+        raise
     except Exception as e:
         print(f"  - APIエラー発生: {e}")
+        TELEMETRY.record_error(e)
+        return None
+
+def to_qa_record(tier, category, qa_pair):
+    """APIの出力を検証し、バッチファイルに保存するレコードに変換する（不正な出力なら None）"""
+    if not isinstance(qa_pair, dict):
         return None
+    question, answer = qa_pair.get('question'), qa_pair.get('answer')
+    if not (isinstance(question, str) and question.strip() and isinstance(answer, str) and answer.strip()):
+        return None
+    return {
+        'tier': int(tier),
+        'category': category,
+        'question': question,
+        'answer': answer
+    }
+
+def generate_qa_item(client, tier, category, dedup_index=None, slot_index=None):
+    """
+    計画の1スロット分のQAペアを生成する（最大 Config.MAX_RETRIES 回まで再試行）。
+    dedup_index を渡した場合は、既存の回答と近似重複するQAペアを却下して再生成する。
+    """
+    with TELEMETRY.tags(phase="A", category=category, slot=slot_index):
+        for attempt in range(Config.MAX_RETRIES):
+            if attempt:
+                TELEMETRY.event("retry", attempt=attempt)
+            with TELEMETRY.tags(attempt=attempt):
+                record = to_qa_record(tier, category, generate_qa_pair(client, category))
+            if not record:
+                TELEMETRY.event("invalid_output")
+                continue
+            if dedup_index is not None and dedup_index.check_and_add(category, slot_index, record['answer']) is not None:
+                TELEMETRY.event("duplicate_rejection")
+                continue
+            return record
+        TELEMETRY.event("item_failed")
+    return None
+
+def generate_qa_items(client, slots, dedup_index=None):
+    """
+    計画の複数スロット分のQAペアを、1回のリクエストでまとめて生成する（slots は [(スロット番号, Tier, カテゴリ)]）。
+    返ってきた項目は1件ずつ検証し（スキーマ・カテゴリ・近似重複）、合格した項目だけをそのスロットに割り当てる。
+    足りないスロットだけを集めて次のリクエストで再生成し、全体で最大 Config.MAX_RETRIES 回まで試みる。
+    {スロット番号: レコード（失敗した場合は None）} を返す。
+    予算の上限に達した場合は、それまでに得られたスロットの結果を例外の partial_results に付けて送出する。
+    """
+    results = {}
+    pending = list(slots)
+    with TELEMETRY.tags(phase="A", slot=slots[0][0], items=len(slots)):
+        for attempt in range(Config.MAX_RETRIES):
+            if not pending:
+                break
+            if attempt:
+                TELEMETRY.event("retry", attempt=attempt, missing=len(pending))
+            try:
+                with TELEMETRY.tags(attempt=attempt):
+                    response = client.chat.completions.create(**build_multi_qa_request([category for _, _, category in pending]))
+                items = json.loads(response.choices[0].message.content).get("items", [])
+            except BudgetExceeded as e:
+                # 得られた分は記録できるよう、途中までの結果を付けて呼び出し元に伝える
+                e.partial_results = results
+                raise
+            except Exception as e:
+                print(f"  - APIエラー発生: {e}")
+                TELEMETRY.record_error(e)
+                continue
+
+            returned = {}
+            for item in items if isinstance(items, list) else []:
+                if isinstance(item, dict) and isinstance(item.get("index"), int) and 1 <= item["index"] <= len(pending):
+                    returned.setdefault(item["index"], item)
+            still_pending = []
+            for position, (slot_index, tier, category) in enumerate(pending, 1):
+                item = returned.get(position)
+                record = to_qa_record(tier, category, item) if item and item.get("category", category) == category else None
+                if not record:
+                    TELEMETRY.event("invalid_output", slot=slot_index)
+                    still_pending.append((slot_index, tier, category))
+                elif dedup_index is not None and dedup_index.check_and_add(category, slot_index, record['answer']) is not None:
+                    TELEMETRY.event("duplicate_rejection", slot=slot_index)
+                    still_pending.append((slot_index, tier, category))
+                else:
+                    results[slot_index] = record
+            pending = still_pending
+        for slot_index, _, _ in pending:
+            TELEMETRY.event("item_failed", slot=slot_index)
+            results[slot_index] = None
+    return results
+
+def load_dedup_index(finished, index_path):
+    """
+    保存済みの近似重複インデックスを読み込み、生成ログ上の完了済みQAペアのうち未登録のものを追加する。
+    インデックスのキーは計画上のスロット番号。
+    """
+    if os.path.exists(index_path):
+        dedup_index = NearDuplicateIndex.load(index_path, threshold=Config.DEDUP_THRESHOLD)
+    else:
+        dedup_index = NearDuplicateIndex(threshold=Config.DEDUP_THRESHOLD)
+    for slot_index, record in finished.items():
+        if record and (record['category'], slot_index) not in dedup_index:
+            dedup_index.add(record['category'], slot_index, record['answer'])
+    return dedup_index
+
+def load_finished_slots(log, full_plan):
+    """
+    生成ログを再生し、完了済みスロットの {スロット番号: レコード} と、最後の記録が失敗（qa_failed）のスロット番号の集合を返す。
+    失敗したスロットは完了済みとはみなさず、再実行時に再生成する
+    """
+    finished = {}
+    failed = set()
+    for entry in log.replay():
+        slot_index = entry.get("slot")
+        # 計画が変わっていた場合（件数の変更など）は、カテゴリが一致しないログを無視する
+        if not isinstance(slot_index, int) or slot_index >= len(full_plan) or full_plan[slot_index][1] != entry.get("category"):
+            continue
+        if entry["type"] == "qa_item":
+            finished[slot_index] = entry["record"]
+            failed.discard(slot_index)
+        elif entry["type"] == "qa_failed":
+            failed.add(slot_index)
+    return finished, failed
+
+def reopen_batches_with_failures(pending_batches, num_batches, batch_size, full_plan, finished, failed):
+    """
+    失敗したスロットを含むために欠けたまま書き出されたバッチを、未完了のバッチに戻す（失敗したスロットを再生成して書き出し直す）。
+    残りのスロットがすべて生成ログにあるバッチだけを対象とし、生成ログに無いレコード（取り込んだものなど）を含むバッチには触れない。
+    """
+    reopened = []
+    for i in sorted(set(range(num_batches)) - set(pending_batches)):
+        slot_range = range(i * batch_size, min((i + 1) * batch_size, len(full_plan)))
+        retry = [slot_index for slot_index in slot_range if slot_index in failed]
+        if retry and all(slot_index in finished or slot_index in failed for slot_index in slot_range):
+            print(f"↻ バッチ {i + 1}/{num_batches} は前回生成に失敗したスロットが{len(retry)}件あるため、再生成して書き出し直します。")
+            reopened.append(i)
+    return sorted(pending_batches + reopened)
+
+def write_batch_file(output_filename, batch_dataset):
+    """バッチファイルを一時ファイル経由で書き出す（途中で中断されても壊れたファイルを残さない）"""
+    tmp_filename = output_filename + ".tmp"
+    with open(tmp_filename, 'w', encoding='utf-8') as f:
+        json.dump(batch_dataset, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_filename, output_filename)
 
 # ---------------------------------
-# 3. Colab用バッチ実行・自動保存エンジン
+# 3. Colab用バッチ実行・自動保存エンジン（並列版）
 # ---------------------------------
-def run_batch_generation(total_items=5000, batch_size=100):
-    """Colab環境で、中断・再開可能なバッチ生成を実行する"""
-    
+def batch_output_path(batch_num, round_name=None):
+    """バッチファイルのパス（追加生成のラウンドは batch_topup_01_001.json のように、本来のバッチの後ろに並ぶ名前にする）"""
+    prefix = f"batch_{round_name}" if round_name else "batch"
+    return os.path.join(Config.BATCH_OUTPUT_DIR, f"{prefix}_{batch_num:03d}.json")
+
+def run_batch_generation(total_items=5000, batch_size=100, max_concurrency=None, client=None, on_record=None, plan=None, round_name=None,
+                         items_per_request=None):
+    """
+    Colab環境で、中断・再開可能なバッチ生成を実行する。
+    最大 max_concurrency 件のリクエストを同時に処理し、APIへの負荷は固定のsleepではなく
+    RateLimiter（リクエスト数/分・トークン数/分）で調整する。
+    完了したQAペアは1件ごとに生成ログへ追記し、再実行時は未完了のスロットから再開する。
+    バッチファイルは計画の順序どおりに、バッチ内の全スロットが揃った時点で生成ログから書き出す。
+    client を渡した場合はそのクライアント（他のフェーズと共有するレート制限・キャッシュ）を使う。
+    on_record を渡した場合は、完了したQAペアごとに on_record(スロット番号, レコード) を呼び出す
+    （生成ログから復元したものと、生成ログに無い既存のバッチファイルのものも含む。run_pipeline.py が後段のフェーズに流すために使う）。
+    plan と round_name を渡した場合は、全体計画の代わりにその計画（追加生成の計画）を生成し、
+    バッチファイル・生成ログ・近似重複インデックスをラウンドごとの名前で保存する。
+    予算の上限（Config.BUDGET_USD / BUDGET_TOKENS）に達した場合は、新しいスロットの投入をやめ、
+    投入済みのスロットを待ってから停止する（上限で止まったスロットは記録しないため、再実行時にそこから再開する）。
+    items_per_request（省略時は Config.ITEMS_PER_REQUEST）が2以上の場合は、未完了スロットをその件数ずつまとめて
+    generate_qa_items で生成する（結果はスロットごとに記録するため、再開の単位は1件のまま）。
+    全スロットを処理した場合は True、予算の上限で停止した場合は False を返す。
+    """
+    max_concurrency = max_concurrency or Config.MAX_CONCURRENCY
+    items_per_request = items_per_request or Config.ITEMS_PER_REQUEST
+
     print("--- QAペアの大量生成を開始します ---")
     
-    client = OpenAI(api_key=Config.API_KEY)
+    if client is None:
+        client = build_client(Config, max_concurrency)
+    TELEMETRY.start(Config.TRACE_FILE)
     
     # 出力ディレクトリの作成
     if not os.path.exists(Config.BATCH_OUTPUT_DIR):
@@ -109,56 +340,514 @@ def run_batch_generation(total_items=5000, batch_size=100):
         print(f"出力ディレクトリ '{Config.BATCH_OUTPUT_DIR}' を作成しました。")
 
     # 全体計画の取得
-    full_plan = get_full_generation_plan(total_items)
+    full_plan = plan if plan is not None else get_full_generation_plan(total_items)
+    total_items = len(full_plan)
     num_batches = math.ceil(total_items / batch_size)
 
-    print(f"全体計画: {total_items}件 / バッチサイズ: {batch_size}件 / 合計バッチ数: {num_batches}件")
+    print(f"全体計画: {total_items}件 / バッチサイズ: {batch_size}件 / 合計バッチ数: {num_batches}件 / 同時実行数: {max_concurrency}"
+          f" / 1リクエストあたり: {items_per_request}件")
     print("-" * 30)
 
+    # 【重要】チェックポイント機能：既にファイルが存在するバッチはスキップ
+    pending_batches = []
     for i in range(num_batches):
         batch_num = i + 1
-        output_filename = os.path.join(Config.BATCH_OUTPUT_DIR, f"batch_{batch_num:03d}.json")
-
-        # 【重要】チェックポイント機能：既にファイルが存在すればスキップ
+        output_filename = batch_output_path(batch_num, round_name)
         if os.path.exists(output_filename):
             print(f"☑ バッチ {batch_num}/{num_batches} は既に存在するため、スキップします。")
-            continue
+        else:
+            pending_batches.append(i)
+
+    # 生成ログから、前回までに完了したスロットを復元する（1件単位で再開できる）
+    log = GenerationLog(os.path.join(Config.BATCH_OUTPUT_DIR, f"{round_name}.log.jsonl" if round_name else Config.QA_LOG_FILENAME))
+    finished, failed = load_finished_slots(log, full_plan)
+    if finished:
+        print(f"↻ 生成ログから{len(finished)}件の完了済みスロットを復元しました。")
+    if failed:
+        print(f"↻ 前回生成に失敗した{len(failed)}件のスロットを再生成します。")
+        pending_batches = reopen_batches_with_failures(pending_batches, num_batches, batch_size, full_plan, finished, failed)
+    dedup_index_path = os.path.join(Config.BATCH_OUTPUT_DIR, f"{round_name}.dedup_index.json" if round_name else Config.DEDUP_INDEX_FILENAME)
+    dedup_index = load_dedup_index(finished, dedup_index_path)
+    if on_record is not None:
+        for slot_index in sorted(finished):
+            if finished[slot_index]:
+                on_record(slot_index, finished[slot_index])
+        # 生成ログに記録の無い既存のバッチファイル（Batch APIモードで取り込んだものなど）のQAペアも流す
+        failed_slots = load_failed_slots(failed_ids_path()) if round_name is None else set()
+        for i in sorted(set(range(num_batches)) - set(pending_batches)):
+            slot_range = range(i * batch_size, min((i + 1) * batch_size, len(full_plan)))
+            if all(slot_index in finished for slot_index in slot_range):
+                continue
+            output_filename = batch_output_path(i + 1, round_name)
+            slots = read_batch_file_slots(output_filename, slot_range, failed_slots)
+            if slots is None:
+                print(f"⚠️ '{output_filename}' のレコードをスロットに対応付けられないため、後段のフェーズに流しません。")
+                continue
+            for slot_index, record in slots:
+                if slot_index not in finished:
+                    on_record(slot_index, record)
+
+    # 未完了バッチの未完了スロットを、計画の順序どおりに並べる
+    slots = []
+    remaining = {}
+    for i in pending_batches:
+        slot_range = range(i * batch_size, min((i + 1) * batch_size, len(full_plan)))
+        todo = [slot_index for slot_index in slot_range if slot_index not in finished]
+        slots.extend(todo)
+        remaining[i] = len(todo)
+
+    write_cursor = 0
+    slot_iter = iter(slots)
+    in_flight = {}
+    budget_stop = None
+
+    def submit_next(executor):
+        chunk = list(islice(slot_iter, items_per_request))
+        if not chunk:
+            return False
+        if items_per_request == 1:
+            tier, category = full_plan[chunk[0]]
+            future = executor.submit(generate_qa_item, client, tier, category, dedup_index, chunk[0])
+        else:
+            future = executor.submit(generate_qa_items, client, [(slot_index, *full_plan[slot_index]) for slot_index in chunk], dedup_index)
+        in_flight[future] = chunk
+        return True
 
-        print(f"▶️  バッチ {batch_num}/{num_batches} の生成を開始...")
-        
-        start_index = i * batch_size
-        end_index = start_index + batch_size
-        batch_plan = full_plan[start_index:end_index]
-        
-        batch_dataset = []
-        for tier, category in tqdm(batch_plan, desc=f"バッチ {batch_num} 生成中"):
-            qa_pair = None
-            for _ in range(3): # 3回までリトライ
-                qa_pair = generate_qa_pair(client, category)
-                if qa_pair and qa_pair.get("question") and qa_pair.get("answer"):
-                    break
-                time.sleep(5)
-
-            if qa_pair:
-                batch_dataset.append({
-                    'tier': int(tier),
-                    'category': category,
-                    'question': qa_pair.get('question'),
-                    'answer': qa_pair.get('answer')
-                })
-        
-        # バッチが完了するたびに、結果をファイルに書き出す
-        with open(output_filename, 'w', encoding='utf-8') as f:
-            json.dump(batch_dataset, f, indent=2, ensure_ascii=False)
-        
-        print(f"✅ バッチ {batch_num}/{num_batches} の生成が完了し、'{output_filename}' に保存しました。({len(batch_dataset)}件)\n")
-        time.sleep(10) # APIへの負荷軽減のため小休止
+    def compile_finished_batches(progress):
+        """全スロットが完了したバッチを、計画の順序どおりに生成ログからファイルへ書き出す"""
+        nonlocal write_cursor
+        while write_cursor < len(pending_batches) and remaining[pending_batches[write_cursor]] == 0:
+            i = pending_batches[write_cursor]
+            batch_num = i + 1
+            output_filename = batch_output_path(batch_num, round_name)
+            slot_range = range(i * batch_size, min((i + 1) * batch_size, len(full_plan)))
+            batch_dataset = [(slot_index, finished.pop(slot_index)) for slot_index in slot_range]
+            batch_dataset = [dict(item, custom_id=slot_custom_id(slot_index, round_name)) for slot_index, item in batch_dataset if item]
+            write_batch_file(output_filename, batch_dataset)
+            progress.write(f"✅ バッチ {batch_num}/{num_batches} の生成が完了し、'{output_filename}' に保存しました。({len(batch_dataset)}件)")
+            dedup_index.save(dedup_index_path)
+            write_cursor += 1
 
+    produced = failed_count = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor, \
+            tqdm(total=len(slots), desc="QAペア生成中") as progress:
+        compile_finished_batches(progress)
+        # 書き出し待ちの結果が溜まりすぎないよう、投入済みの件数は同時実行数の2倍までに抑える
+        while len(in_flight) < max_concurrency * 2 and submit_next(executor):
+            pass
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk = in_flight.pop(future)
+                try:
+                    results = future.result()
+                    if items_per_request == 1:
+                        results = {chunk[0]: results}
+                except BudgetExceeded as e:
+                    if budget_stop is None:
+                        progress.write(f"\n⏸ {e}。投入済みのQAペアを待って停止します。")
+                    budget_stop = e
+                    # まとめて生成していた場合は、上限に達する前に得られたスロットだけを記録する
+                    results = getattr(e, "partial_results", {})
+                for slot_index, record in sorted(results.items()):
+                    tier, category = full_plan[slot_index]
+                    if record:
+                        log.append({"type": "qa_item", "slot": slot_index, "category": category, "record": record})
+                        produced += 1
+                    else:
+                        log.append({"type": "qa_failed", "slot": slot_index, "category": category})
+                        failed_count += 1
+                    finished[slot_index] = record
+                    if record and on_record is not None:
+                        on_record(slot_index, record)
+                    remaining[slot_index // batch_size] -= 1
+                    progress.update(1)
+
+            # バッチが完了するたびに、計画の順序どおりに結果をファイルに書き出す
+            compile_finished_batches(progress)
+
+            while budget_stop is None and len(in_flight) < max_concurrency * 2 and submit_next(executor):
+                pass
+
+    log.close()
+    dedup_index.save(dedup_index_path)
+    print(client.cache.format_stats())
+    print(client.governor.format_stats())
+    print(client.budget.format_stats())
+    print(dedup_index.format_rejections())
+    print(format_throughput(produced, time.perf_counter() - started, items_per_request))
+    print(TELEMETRY.format_summary())
+    TELEMETRY.close()
+    if failed_count:
+        print(f"⚠️ {failed_count}件のスロットは再試行しても生成できなかったため、バッチファイルから欠けています。"
+              "再実行すると、これらのスロットを再生成してバッチファイルを書き出し直します。")
+    if budget_stop is not None:
+        print(f"⏸ 予算の上限に達したため、{write_cursor}/{len(pending_batches)}個のバッチを書き出した時点で停止しました。"
+              "上限（Config.BUDGET_USD / BUDGET_TOKENS）を見直して再実行すると、未完了のスロットから再開します。")
+        return False
     print("🎉 全てのバッチ生成が完了しました！")
     print(f"次に、merge_batches.py を実行して、'{Config.BATCH_OUTPUT_DIR}' 内のファイルを結合してください。")
+    return True
+
+def format_throughput(produced, elapsed, items_per_request):
+    """今回の実行で生成したQAペアの、1秒あたりの件数と1件あたりのトークン数（フェーズAのテレメトリから集計）"""
+    stats = TELEMETRY.summary().get("A", {})
+    prompt_tokens = stats.get("prompt_tokens", 0) / produced if produced else 0.0
+    completion_tokens = stats.get("completion_tokens", 0) / produced if produced else 0.0
+    return (
+        f"スループット（1リクエストあたり {items_per_request}件）: 今回生成 {produced}件 / {elapsed:.1f}s → "
+        f"{produced / elapsed if elapsed else 0.0:.2f}件/秒 / 1件あたりのトークン 入力 {prompt_tokens:.0f}・"
+        f"出力 {completion_tokens:.0f} / API呼び出し {stats.get('calls', 0)}回"
+    )
+
+def estimate_batch_generation(total_items=5000, batch_size=100, plan=None, round_name=None, title=None, items_per_request=None):
+    """
+    run_batch_generation を実行した場合のAPI呼び出し数・トークン数・コストを、APIを呼ばずに見積もる（ドライラン）。
+    実際のリクエスト（build_qa_request / build_multi_qa_request）のプロンプトを数え、
+    既にバッチファイルがあるバッチと、生成ログ上で完了済みのスロットは除く。
+    """
+    items_per_request = items_per_request or Config.ITEMS_PER_REQUEST
+    full_plan = plan if plan is not None else get_full_generation_plan(total_items)
+    log_path = os.path.join(Config.BATCH_OUTPUT_DIR, f"{round_name}.log.jsonl" if round_name else Config.QA_LOG_FILENAME)
+    finished, failed = load_finished_slots(GenerationLog(log_path), full_plan) if os.path.exists(log_path) else ({}, set())
+    slots = [
+        slot_index for slot_index in range(len(full_plan))
+        if slot_index in failed
+        or (slot_index not in finished and not os.path.exists(batch_output_path(slot_index // batch_size + 1, round_name)))
+    ]
+
+    model = Config.MODEL_ROUTES["generator"]["model"]
+    estimate = CostEstimate(title or f"フェーズA（QAペア 未完了 {len(slots)}/{len(full_plan)}件）")
+    if items_per_request == 1:
+        prompt_tokens = {}
+        for slot_index in slots:
+            category = full_plan[slot_index][1]
+            if category not in prompt_tokens:
+                prompt_tokens[category] = count_message_tokens(build_qa_request(category)["messages"], model)
+            estimate.add("QAペア生成", model, prompt_tokens[category], Config.ESTIMATED_COMPLETION_TOKENS,
+                         expected_calls=1 + Config.ESTIMATED_RETRY_RATE, max_calls=Config.MAX_RETRIES)
+        return estimate
+
+    # まとめて生成する場合は、run_batch_generation と同じ区切りでリクエストを組み立てて数える。
+    # 再試行は不足したスロットだけを集めた小さなリクエストになるため、想定・最大とも1回目と同じ大きさとして上から見積もる
+    for start in range(0, len(slots), items_per_request):
+        categories = [full_plan[slot_index][1] for slot_index in slots[start:start + items_per_request]]
+        estimate.add(f"QAペア生成（{items_per_request}件まとめ）", model,
+                     count_message_tokens(build_multi_qa_request(categories)["messages"], model),
+                     Config.ESTIMATED_COMPLETION_TOKENS * len(categories),
+                     expected_calls=1 + Config.ESTIMATED_RETRY_RATE, max_calls=Config.MAX_RETRIES)
+    return estimate
+
+
+# ---------------------------------
+# 4. オフラインBatch APIモード（リクエストの書き出しと結果の取り込み）
+# ---------------------------------
+def slot_custom_id(slot_index, round_name=None):
+    """
+    計画の何番目のスロットか（0始まり）から、安定した custom_id を作る（追加生成のラウンドは topup_01-000001 のようにする）。
+    バッチファイルの各レコードにも同じ値を custom_id として残し、結合後のデータセットとペルソナの事実を突き合わせられるようにする。
+    """
+    return f"{round_name or 'qa'}-{slot_index + 1:06d}"
+
+def parse_custom_id(custom_id):
+    return int(custom_id.split("-", 1)[1]) - 1
+
+def export_batch_requests(requests_file, total_items=5000, custom_ids=None):
+    """
+    全体計画を、Batch API に投入できる chat.completions リクエストのJSONLファイルに変換する。
+    custom_ids を指定した場合は、そのスロットだけを書き出す（失敗分の追加生成用）。
+    """
+    full_plan = get_full_generation_plan(total_items)
+    if custom_ids is None:
+        slot_indices = range(len(full_plan))
+    else:
+        slot_indices = sorted(parse_custom_id(custom_id) for custom_id in custom_ids)
+
+    count = 0
+    with open(requests_file, 'w', encoding='utf-8') as f:
+        for slot_index in slot_indices:
+            tier, category = full_plan[slot_index]
+            request = {
+                "custom_id": slot_custom_id(slot_index),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": build_qa_request(category),
+            }
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+            count += 1
+
+    print(f"✅ {count}件のリクエストを '{requests_file}' に書き出しました。")
+    return count
+
+def parse_batch_result_line(line):
+    """Batch APIの結果ファイルの1行から (custom_id, QAペアのdict or None, エラー内容) を取り出す"""
+    result = json.loads(line)
+    custom_id = result.get("custom_id")
+    response = result.get("response") or {}
+    if result.get("error") or response.get("status_code") != 200:
+        return custom_id, None, result.get("error") or f"status_code={response.get('status_code')}"
+    try:
+        content = response["body"]["choices"][0]["message"]["content"]
+        return custom_id, json.loads(content), None
+    except (KeyError, IndexError, TypeError, json.JSONDecodeError) as e:
+        return custom_id, None, f"不正な応答: {e}"
+
+def failed_ids_path():
+    return os.path.join(Config.BATCH_OUTPUT_DIR, "failed_custom_ids.txt")
+
+def load_failed_slots(failed_ids_file):
+    """failed_custom_ids.txt に一覧化された、取り込みに失敗したスロット番号の集合"""
+    if not os.path.exists(failed_ids_file):
+        return set()
+    with open(failed_ids_file, 'r', encoding='utf-8') as f:
+        return {parse_custom_id(line.strip()) for line in f if line.strip()}
+
+def read_batch_file_slots(output_filename, slot_range, failed_slots=()):
+    """
+    バッチファイルのレコードを、計画上のスロット番号と対応付けた [(スロット番号, レコード)] のリストで返す（custom_id は取り除く）。
+    custom_id の無い以前のバッチファイルは、failed_slots を除いた順にレコードが並んでいるものとして対応付け、
+    件数が合わなければ None を返す。
+    """
+    with open(output_filename, 'r', encoding='utf-8') as f:
+        batch_dataset = json.load(f)
+    if all('custom_id' in item for item in batch_dataset):
+        slots = [parse_custom_id(item['custom_id']) for item in batch_dataset]
+    else:
+        slots = [slot_index for slot_index in slot_range if slot_index not in failed_slots]
+        if len(slots) != len(batch_dataset):
+            return None
+    return [(slot_index, {key: value for key, value in item.items() if key != 'custom_id'})
+            for slot_index, item in zip(slots, batch_dataset)]
+
+def load_ingested_slots(full_plan, batch_size, failed_ids_file):
+    """
+    前回までに取り込んだ結果を、既存の batch_XXX.json と failed_custom_ids.txt から復元し、
+    ({スロット番号: レコード}, {スロット番号: エラー内容}) を返す。
+    """
+    errors = {slot_index: "前回の取り込みで失敗しました" for slot_index in load_failed_slots(failed_ids_file)}
+    records = {}
+    for i in range(math.ceil(len(full_plan) / batch_size)):
+        output_filename = batch_output_path(i + 1)
+        if not os.path.exists(output_filename):
+            continue
+        slot_range = range(i * batch_size, min((i + 1) * batch_size, len(full_plan)))
+        slots = read_batch_file_slots(output_filename, slot_range, errors)
+        if slots is None:
+            print(f"  - 警告: '{output_filename}' のレコードをスロットに対応付けられないため、このバッチは前回の結果を引き継ぎません。")
+            continue
+        for slot_index, record in slots:
+            records[slot_index] = record
+            errors.pop(slot_index, None)
+    return records, errors
+
+def ingest_batch_results(results_files, total_items=5000, batch_size=100, final_output_file=None):
+    """
+    Batch APIの結果JSONL（複数指定可。失敗したスロットは後のファイルの結果で埋める）を検証して取り込み、
+    計画の順序どおりに batch_XXX.json を書き出す。
+    前回までに取り込んだ結果（既存のバッチファイルと failed_custom_ids.txt）を引き継ぐため、
+    失敗分を再投入した結果だけを指定して、追加で取り込むこともできる。
+    既に取り込んだ回答と近似重複する結果は失敗として扱う。
+    全スロットの結果が揃ったバッチだけを書き出し、失敗したスロットの custom_id は
+    追加生成用に failed_custom_ids.txt に一覧化する。
+    final_output_file を指定した場合は、IDを振った最終データセットも直接書き出す。
+    """
+    full_plan = get_full_generation_plan(total_items)
+    failed_ids_file = failed_ids_path()
+    records, errors = load_ingested_slots(full_plan, batch_size, failed_ids_file)
+    if records or errors:
+        print(f"↻ 前回までの取り込み結果（成功: {len(records)}件 / 失敗: {len(errors)}件）を引き継ぎます。")
+    dedup_index = NearDuplicateIndex(threshold=Config.DEDUP_THRESHOLD)
+    for slot_index, record in records.items():
+        dedup_index.add(record['category'], slot_index, record['answer'])
+    for results_file in results_files:
+        with open(results_file, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    custom_id, qa_pair, error = parse_batch_result_line(line)
+                    slot_index = parse_custom_id(custom_id)
+                except (json.JSONDecodeError, AttributeError, IndexError, ValueError):
+                    print(f"  - 警告: '{results_file}' の{line_number}行目を解釈できません。スキップします。")
+                    continue
+                if not 0 <= slot_index < len(full_plan):
+                    print(f"  - 警告: 計画にない custom_id '{custom_id}' をスキップします。")
+                    continue
+                if slot_index in records:
+                    continue
+                tier, category = full_plan[slot_index]
+                record = to_qa_record(tier, category, qa_pair) if qa_pair is not None else None
+                if record and dedup_index.check_and_add(category, slot_index, record['answer']) is not None:
+                    record, error = None, "既存の回答と近似重複しています"
+                if record:
+                    records[slot_index] = record
+                    errors.pop(slot_index, None)
+                else:
+                    errors[slot_index] = error or "必須フィールド（question / answer）が不正です"
+
+    os.makedirs(Config.BATCH_OUTPUT_DIR, exist_ok=True)
+    num_batches = math.ceil(len(full_plan) / batch_size)
+    written = 0
+    for i in range(num_batches):
+        slot_range = range(i * batch_size, min((i + 1) * batch_size, len(full_plan)))
+        if not all(slot_index in records or slot_index in errors for slot_index in slot_range):
+            continue
+        batch_dataset = [dict(records[slot_index], custom_id=slot_custom_id(slot_index)) for slot_index in slot_range if slot_index in records]
+        write_batch_file(batch_output_path(i + 1), batch_dataset)
+        written += 1
+
+    with open(failed_ids_file, 'w', encoding='utf-8') as f:
+        for slot_index in sorted(errors):
+            f.write(slot_custom_id(slot_index) + "\n")
+
+    print(dedup_index.format_rejections())
+    if final_output_file:
+        final_dataset = [dict(records[slot_index], custom_id=slot_custom_id(slot_index)) for slot_index in sorted(records)]
+        for i, item in enumerate(final_dataset):
+            item['id'] = i + 1
+        with open(final_output_file, 'w', encoding='utf-8') as f:
+            json.dump(final_dataset, f, indent=2, ensure_ascii=False)
+        print(f"   - 最終データセット: {final_output_file}")
+
+    missing = len(full_plan) - len(records) - len(errors)
+    print(f"✅ 結果の取り込みが完了しました。成功: {len(records)}件 / 失敗: {len(errors)}件 / 結果なし: {missing}件")
+    print(f"   - 書き出したバッチファイル: {written}/{num_batches}個")
+    print(f"   - 失敗した custom_id の一覧: {failed_ids_file}")
+    if errors:
+        print(f"   ※ 追加生成するには: --mode export --only_ids {failed_ids_file} で書き出したリクエストの結果を、--mode ingest で取り込みます")
+    return records, errors
+
+
+# ---------------------------------
+# 5. 不足分の追加生成（Tier・カテゴリごとの目標件数に足りない分だけを生成する）
+# ---------------------------------
+def plan_quotas(total_items=5000):
+    """全体計画から、Tierとカテゴリごとの目標件数を求める"""
+    return Counter((int(tier), category) for tier, category in get_full_generation_plan(total_items))
+
+def load_unfinished_topup_round(plan_files):
+    """最後の追加生成ラウンドのバッチファイルが揃っていなければ、その計画を返す（揃っていれば None）"""
+    if not plan_files:
+        return None
+    with open(plan_files[-1], 'r', encoding='utf-8') as f:
+        round_plan = json.load(f)
+    num_batches = math.ceil(len(round_plan["plan"]) / round_plan["batch_size"])
+    if all(os.path.exists(batch_output_path(batch_num, round_plan["round_name"])) for batch_num in range(1, num_batches + 1)):
+        return None
+    return round_plan
+
+def run_topup(total_items=5000, batch_size=100, source=None, dry_run=False, max_concurrency=None, client=None):
+    """
+    既存のQAペア（batches/ 内の全バッチファイル、または source に指定した結合済みファイル）を走査し、
+    スキーマ不正・近似重複を除いた件数と、全体計画のTier・カテゴリごとの目標件数との差を求めて、
+    不足分だけを追加生成のラウンド（batch_topup_XX_NNN.json）として生成する。
+    走査結果はファイル単位でキャッシュし、変更の無いファイルは読み直さない。
+    ラウンドの計画は topup_XX.plan.json に保存し、中断した場合は次の実行時に同じ計画の続きから再開する。
+    """
+    print("--- 不足分の追加生成（top-up）を開始します ---")
+    os.makedirs(Config.BATCH_OUTPUT_DIR, exist_ok=True)
+    plan_files = sorted(glob.glob(os.path.join(Config.BATCH_OUTPUT_DIR, "topup_*.plan.json")))
+    round_plan = load_unfinished_topup_round(plan_files)
+    if round_plan is not None:
+        print(f"↻ 未完了の追加生成ラウンド '{round_plan['round_name']}'（{len(round_plan['plan'])}件）を再開します。")
+    else:
+        if source is None:
+            missing_batches = [batch_num for batch_num in range(1, math.ceil(total_items / batch_size) + 1)
+                               if not os.path.exists(batch_output_path(batch_num))]
+            if missing_batches:
+                print(f"⚠️ 全体計画のバッチファイルが{len(missing_batches)}個未作成です。"
+                      f"先に通常の生成を完了させないと、その分も不足として追加生成され、後で目標件数を超えます。")
+
+        quotas = plan_quotas(total_items)
+        dedup_index = NearDuplicateIndex(threshold=Config.DEDUP_THRESHOLD)
+        cache = ScanCache(
+            os.path.join(Config.BATCH_OUTPUT_DIR, Config.TOPUP_SCAN_CACHE_FILENAME),
+            {"num_perm": dedup_index.num_perm, "bands": dedup_index.bands, "ngram": dedup_index.ngram, "seed": dedup_index.seed},
+        )
+        counts, stats = assess_dataset(find_sources(Config.BATCH_OUTPUT_DIR, source), dedup_index, cache)
+        cache.close()
+        dedup_index.rejected.clear()
+        deficits = compute_deficits(quotas, counts)
+        print(format_assessment(quotas, counts, stats, deficits))
+        if not deficits:
+            print("✅ 全てのTier・カテゴリが目標件数に達しているため、追加生成は不要です。")
+            return deficits
+        if dry_run:
+            topup_plan = build_topup_plan(get_full_generation_plan(total_items), deficits)
+            print(estimate_batch_generation(batch_size=batch_size, plan=topup_plan, round_name=f"topup_{len(plan_files) + 1:02d}",
+                                            title=f"追加生成（{len(topup_plan)}件）").format(Config.BUDGET_USD))
+            return deficits
+
+        round_name = f"topup_{len(plan_files) + 1:02d}"
+        # 既存の有効なQAペアの署名を登録したインデックスから始め、追加分が既存の回答と重複しないようにする
+        dedup_index.save(os.path.join(Config.BATCH_OUTPUT_DIR, f"{round_name}.dedup_index.json"))
+        round_plan = {
+            "round_name": round_name,
+            "total_items": total_items,
+            "batch_size": batch_size,
+            "source": source,
+            "deficits": [[tier, category, missing] for (tier, category), missing in sorted(deficits.items())],
+            "plan": build_topup_plan(get_full_generation_plan(total_items), deficits),
+        }
+        write_batch_file(os.path.join(Config.BATCH_OUTPUT_DIR, f"{round_name}.plan.json"), round_plan)
+        print(f"追加生成ラウンド '{round_name}' の計画（{len(round_plan['plan'])}件）を保存しました。")
+
+    if dry_run:
+        print(estimate_batch_generation(batch_size=round_plan["batch_size"], plan=[tuple(slot) for slot in round_plan["plan"]],
+                                        round_name=round_plan["round_name"], title=f"追加生成ラウンド '{round_plan['round_name']}'").format(Config.BUDGET_USD))
+        return Counter({(tier, category): missing for tier, category, missing in round_plan["deficits"]})
+    run_batch_generation(batch_size=round_plan["batch_size"], max_concurrency=max_concurrency, client=client,
+                         plan=[tuple(slot) for slot in round_plan["plan"]], round_name=round_plan["round_name"])
+    print("   ※ 追加生成に失敗・重複で不足が残った場合は、もう一度 --mode topup を実行してください。")
+    return Counter({(tier, category): missing for tier, category, missing in round_plan["deficits"]})
 
 
 # ---- 実行 ----
 if __name__ == "__main__":
-    # ★★★ 本番用の設定に戻しました ★★★
-    run_batch_generation(total_items=5000, batch_size=100)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="QAペアの大量生成（逐次API / オフラインBatch API）")
+    parser.add_argument('--mode', choices=['online', 'export', 'ingest', 'topup'], default='online',
+                        help="online: APIを直接呼び出して生成 / export: Batch API用のリクエストJSONLを書き出す / ingest: Batch APIの結果JSONLを取り込む"
+                             " / topup: 既存のQAペアを走査し、Tier・カテゴリごとの不足分だけを追加生成する")
+    parser.add_argument('--total_items', type=int, default=5000, help='生成する全体の件数')
+    parser.add_argument('--batch_size', type=int, default=100, help='1バッチファイルあたりの件数')
+    parser.add_argument('--requests_file', type=str, default='qa_batch_requests.jsonl', help='[export] 書き出すリクエストJSONL')
+    parser.add_argument('--only_ids', type=str, default=None, help='[export] 書き出す custom_id の一覧ファイル（追加生成用）')
+    parser.add_argument('--results_file', type=str, action='append', help='[ingest] Batch APIの結果JSONL（複数指定可、失敗分は後のもので埋める）')
+    parser.add_argument('--final_output_file', type=str, default=None, help='[ingest] IDを振った最終データセットも書き出す場合のファイル名')
+    parser.add_argument('--source', type=str, default=None, help='[topup] バッチファイルの代わりに走査する結合済みファイル（JSONL / JSON）')
+    parser.add_argument('--dry_run', action='store_true',
+                        help='[online / topup] APIを呼ばずに、未完了分のAPI呼び出し数・トークン数・コストの見積もりを表示する（topup では不足数も表示する）')
+    parser.add_argument('--budget_usd', type=float, default=None, help='[online / topup] 推定コスト（USD）の上限（省略時は Config.BUDGET_USD）')
+    parser.add_argument('--budget_tokens', type=int, default=None, help='[online / topup] トークン数の上限（省略時は Config.BUDGET_TOKENS）')
+    parser.add_argument('--items_per_request', type=int, default=None,
+                        help='[online / topup] 1回のリクエストで生成するQAペアの件数（省略時は Config.ITEMS_PER_REQUEST）')
+    # Colabのカーネルが渡す引数は無視する
+    args, _ = parser.parse_known_args()
+    if args.budget_usd is not None:
+        Config.BUDGET_USD = args.budget_usd
+    if args.budget_tokens is not None:
+        Config.BUDGET_TOKENS = args.budget_tokens
+    if args.items_per_request is not None:
+        Config.ITEMS_PER_REQUEST = args.items_per_request
+
+    if args.mode == 'export':
+        custom_ids = None
+        if args.only_ids:
+            with open(args.only_ids, 'r', encoding='utf-8') as f:
+                custom_ids = [line.strip() for line in f if line.strip()]
+        export_batch_requests(args.requests_file, args.total_items, custom_ids)
+    elif args.mode == 'ingest':
+        if not args.results_file:
+            parser.error("--mode ingest には --results_file が必要です。")
+        ingest_batch_results(args.results_file, args.total_items, args.batch_size, args.final_output_file)
+    elif args.mode == 'topup':
+        run_topup(args.total_items, args.batch_size, args.source, args.dry_run)
+    elif args.dry_run:
+        print(estimate_batch_generation(args.total_items, args.batch_size).format(Config.BUDGET_USD))
+    else:
+        # ★★★ 本番用の設定に戻しました ★★★
+        run_batch_generation(total_items=args.total_items, batch_size=args.batch_size)
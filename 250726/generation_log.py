@@ -0,0 +1,74 @@
+# generation_log.py
+
+import json
+import os
+import threading
+
+# 書きかけの末尾の行を探すときに、ファイルの末尾から1回に読むバイト数
+_TAIL_BLOCK_SIZE = 4096
+
+
+class GenerationLog:
+    """
+    生成結果を1件ずつ追記していく、追記専用のJSONLログ（write-ahead log）。
+    1レコード書くたびに flush と fsync を行うため、Colabのセッションが切断されても
+    それまでに完了したQAペア・対話ターンは失われない。
+    batch_XXX.json や dialogue_pXX.json は、このログから組み立てる「成果物」という位置づけになる。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = None
+
+    def replay(self):
+        """ログに記録済みのレコードを先頭から順に返す（書き込み途中で切れた末尾の行は無視する）"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    break
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._truncate_partial_line()
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _truncate_partial_line(self):
+        """前回の実行が書き込み途中で止まっていた場合、壊れた末尾の行を切り詰めてから追記を再開する"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            # ファイル全体は読まずに、末尾から小さなブロック単位で遡って最後の改行を探す
+            size = f.seek(0, os.SEEK_END)
+            position = size
+            end = 0
+            while position > 0:
+                block_start = max(0, position - _TAIL_BLOCK_SIZE)
+                f.seek(block_start)
+                newline = f.read(position - block_start).rfind(b"\n")
+                if newline != -1:
+                    end = block_start + newline + 1
+                    break
+                position = block_start
+            if end != size:
+                f.truncate(end)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
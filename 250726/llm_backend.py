@@ -0,0 +1,138 @@
+# llm_backend.py
+
+import os
+import threading
+from types import SimpleNamespace
+import httpx
+from openai import OpenAI, DefaultHttpxClient
+from rate_limiter import RateLimiter, RateLimitedClient, RequestGovernor
+from llm_cache import LLMCache, CachedClient
+from telemetry import MODEL_PRICING, TELEMETRY, BackendTimer, TelemetryClient
+from budget import BudgetedClient, CostBudget
+
+# 接続先（base_url, api_key）ごとのOpenAIクライアント。プロセス内のすべてのバックエンドで共有し、
+# 同じ接続先へのリクエストは1つのコネクションプール（keep-alive）を使い回す
+_CLIENTS = {}
+_clients_lock = threading.Lock()
+
+
+def pooled_openai_client(api_key, base_url=None, max_connections=100, timeout=None):
+    """接続先ごとに1つだけ作る、コネクションプール付きのOpenAIクライアントを返す"""
+    key = (base_url, api_key)
+    with _clients_lock:
+        if key not in _CLIENTS:
+            http_client = DefaultHttpxClient(limits=httpx.Limits(
+                max_connections=max_connections, max_keepalive_connections=max_connections, keepalive_expiry=60.0,
+            ))
+            options = {} if timeout is None else {"timeout": timeout}
+            # 再試行は RateLimitedClient（RequestGovernor）に任せるため、クライアント側では再試行しない
+            _CLIENTS[key] = OpenAI(api_key=api_key, base_url=base_url, max_retries=0, http_client=http_client, **options)
+        return _CLIENTS[key]
+
+
+def close_pooled_clients():
+    with _clients_lock:
+        for client in _CLIENTS.values():
+            client.close()
+        _CLIENTS.clear()
+
+
+class PooledBackend:
+    """
+    OpenAIクライアントと同じ `client.chat.completions.create(...)` の形で呼び出せる、最も内側のバックエンド。
+    リクエストの model に応じて、その役割（生成・判定・抽出など）のルートに指定された接続先に送る。
+    ルートは {"model", "base_url"（省略時は default_base_url）, "api_key", "max_connections", "timeout", "pricing"} で、
+    OpenAI互換の /v1/chat/completions を持つサーバー（ローカルのCPU推論サーバーなど）なら何でも接続先にできる。
+    """
+
+    def __init__(self, routes, api_key, default_base_url=None):
+        self.api_key = api_key
+        self.default_base_url = default_base_url
+        self._routes = {}
+        for route in routes:
+            endpoint = self._endpoint(route)
+            known = self._routes.get(route["model"])
+            if known is not None and self._endpoint(known) != endpoint:
+                raise ValueError(f"モデル '{route['model']}' に異なる接続先が指定されています: {self._endpoint(known)[0]} / {endpoint[0]}")
+            self._routes[route["model"]] = route
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def _endpoint(self, route):
+        return (route.get("base_url") or self.default_base_url, route.get("api_key") or self.api_key)
+
+    def client_for(self, model):
+        route = self._routes.get(model, {})
+        base_url, api_key = self._endpoint(route)
+        return pooled_openai_client(api_key, base_url, route.get("max_connections", 100), route.get("timeout"))
+
+    def create(self, **params):
+        return self.client_for(params.get("model")).chat.completions.create(**params)
+
+    @property
+    def models(self):
+        return list(self._routes)
+
+    def describe_routes(self):
+        endpoints = {}
+        for model, route in self._routes.items():
+            endpoints.setdefault(self._endpoint(route)[0] or "OpenAI API", []).append(model)
+        return " / ".join(f"{', '.join(models)} → {base_url}" for base_url, models in endpoints.items())
+
+
+class ClientConfig:
+    """
+    build_client が使う、APIクライアントの共通の設定（各スクリプトの Config はこれを継承し、必要な値だけを上書きする）
+    """
+    try:
+        from google.colab import userdata
+        API_KEY = userdata.get("OPENAI-KEY")
+    except (ImportError, KeyError):
+        API_KEY = os.environ.get("OPENAI_API_KEY", "YOUR_API_KEY_HERE")
+    # 接続先（省略時はOpenAIのAPI）。ベンチマーク時はモックサーバーのURLを環境変数で指定する
+    BASE_URL = os.environ.get("OPENAI_BASE_URL")
+    # 役割ごとのモデルと接続先。base_url を省略した役割は BASE_URL（既定ではOpenAIのAPI）に送る。
+    # 例: {"model": "qwen2.5-7b-instruct", "base_url": "http://localhost:8080/v1"} で、ローカルのOpenAI互換サーバーに送る。
+    # telemetry.MODEL_PRICING に無いモデルは、"pricing": {"input": ..., "cached_input": ..., "output": ...}（100万トークンあたりのUSD）で
+    # 料金を指定する（BUDGET_USD を指定した場合は必須）
+    MODEL_ROUTES = {}
+    # 並列実行の設定（同時に処理するリクエスト数と、1分あたりの上限）
+    MAX_CONCURRENCY = 8
+    REQUESTS_PER_MINUTE = 500
+    TOKENS_PER_MINUTE = 300000
+    # 429・一時的なエラーの再試行（Retry-After を優先）と、同時実行数の自動調整・サーキットブレーカーの設定
+    API_MAX_RETRIES = 6
+    CIRCUIT_ERROR_RATE = 0.5
+    CIRCUIT_COOLDOWN_SECONDS = 30
+    # LLM応答キャッシュ（3つのフェーズで同じファイルを共有する）
+    CACHE_PATH = "llm_cache.sqlite3"
+    CACHE_MAX_BYTES = 1024 ** 3
+    # True にすると、高温度の呼び出しも保存して再実行時にそのまま再生する
+    CACHE_HIGH_TEMPERATURE = False
+    # API呼び出しごとの計測結果を追記するトレースファイル（3つのフェーズで共有する）
+    TRACE_FILE = "telemetry_trace.jsonl"
+    # 予算の上限（1回の実行で使ってよい推定コスト（USD）とトークン数。None なら上限なし）。
+    # 上限に達すると、完了した分までを記録して停止し、再実行すれば続きから再開する
+    BUDGET_USD = None
+    BUDGET_TOKENS = None
+
+
+def build_client(config, max_concurrency=None, routes=None):
+    """
+    config（ClientConfig を継承した各スクリプトの Config）の設定から、予算・計測・応答キャッシュ・レート制限付きの
+    APIクライアント（外側から BudgetedClient → TelemetryClient → CachedClient → RateLimitedClient → BackendTimer → PooledBackend）を作る。
+    max_concurrency と routes を省略した場合は、config.MAX_CONCURRENCY と config.MODEL_ROUTES のルートを使う。
+    config.BUDGET_USD を指定した場合、料金の分からないモデルのルートがあれば ValueError を送出する。
+    """
+    routes = list(config.MODEL_ROUTES.values() if routes is None else routes)
+    for route in routes:
+        if "pricing" in route:
+            MODEL_PRICING[route["model"]] = route["pricing"]
+    backend = PooledBackend(routes, config.API_KEY, config.BASE_URL)
+    budget = CostBudget(config.BUDGET_USD, config.BUDGET_TOKENS)
+    budget.require_pricing(backend.models)
+    limiter = RateLimiter(config.REQUESTS_PER_MINUTE, config.TOKENS_PER_MINUTE)
+    governor = RequestGovernor(max_concurrency or config.MAX_CONCURRENCY, max_retries=config.API_MAX_RETRIES,
+                               error_rate_threshold=config.CIRCUIT_ERROR_RATE, cooldown=config.CIRCUIT_COOLDOWN_SECONDS,
+                               on_event=TELEMETRY.event)
+    cache = LLMCache(config.CACHE_PATH, config.CACHE_MAX_BYTES, config.CACHE_HIGH_TEMPERATURE)
+    return BudgetedClient(TelemetryClient(CachedClient(RateLimitedClient(BackendTimer(backend), limiter, governor), cache)), budget)
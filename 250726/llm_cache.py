@@ -0,0 +1,196 @@
+# llm_cache.py
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+from client_wrapper import ClientWrapper
+
+
+class LLMCache:
+    """
+    chat.completions のレスポンスをSQLiteに保存する、ディスク永続型のキャッシュ。
+    キーはリクエストパラメータ（model, messages, temperature, response_format など）全体のハッシュ。
+    合計サイズが max_bytes を超えたら、最後に参照された時刻が古いものから削除する。
+
+    既定では temperature=0 の（結果が決定的な）呼び出しだけをキャッシュする。
+    cache_high_temperature=True にすると、高温度の呼び出しも「同じプロンプトのn回目の呼び出し」
+    ごとに保存し、再実行時にまったく同じ応答を再生できる（並列実行時は、応答がどのスロットに
+    割り当てられるかの順序までは保証されない）。
+    """
+
+    def __init__(self, path, max_bytes=1024 ** 3, cache_high_temperature=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.cache_high_temperature = cache_high_temperature
+        self.stats = Counter()
+        self._occurrences = Counter()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def is_cacheable(self, params):
+        # temperature を省略した場合のAPIの既定値は1.0
+        return params.get("temperature", 1.0) == 0 or self.cache_high_temperature
+
+    def make_key(self, params, advance=True):
+        """
+        リクエストのキー。高温度の呼び出しは「同じプロンプトのn回目」ごとに別のキーになり、advance=True で n を1つ進める。
+        advance=False の場合は、次の呼び出しのキーを n を進めずに返す（呼び出しにならない参照用）
+        """
+        payload = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+        key = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        if params.get("temperature", 1.0) != 0:
+            # 高温度の呼び出しは同じプロンプトでも毎回違う応答が欲しいため、n回目の呼び出しごとに別のキーにする
+            with self._lock:
+                occurrence = self._occurrences[key] + 1
+                if advance:
+                    self._occurrences[key] = occurrence
+            key = hashlib.sha256(f"{key}#{occurrence}".encode("utf-8")).hexdigest()
+        return key
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.stats["hits"] += 1
+        return json.loads(row[0])
+
+    def put(self, key, response_data):
+        payload = json.dumps(response_data, ensure_ascii=False)
+        size = len(payload.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, payload, size, now, now),
+            )
+            self._total_bytes += size - (old[0] if old else 0)
+            self.stats["stores"] += 1
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """合計サイズが上限を超えていれば、上限の9割に収まるまで古いエントリを削除する"""
+        if self._total_bytes <= self.max_bytes:
+            return
+        target = self.max_bytes * 0.9
+        rows = self._conn.execute("SELECT key, size FROM responses ORDER BY last_access")
+        evicted = []
+        for key, size in rows:
+            if self._total_bytes <= target:
+                break
+            evicted.append((key,))
+            self._total_bytes -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self.stats["evictions"] += len(evicted)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+    def format_stats(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        hit_rate = self.stats["hits"] / lookups * 100 if lookups else 0.0
+        return (
+            f"LLMキャッシュ: ヒット {self.stats['hits']}件 / ミス {self.stats['misses']}件 "
+            f"(ヒット率 {hit_rate:.1f}%) / キャッシュ対象外 {self.stats['uncacheable']}件 / "
+            f"追い出し {self.stats['evictions']}件 / 使用量 {self._total_bytes / 1024 ** 2:.1f}MB"
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def response_to_dict(response):
+    """レスポンスのうち、パイプラインが利用する部分だけをJSONに変換する"""
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "choices": [
+            {
+                "index": getattr(choice, "index", i),
+                "content": choice.message.content,
+                "finish_reason": getattr(choice, "finish_reason", None),
+            }
+            for i, choice in enumerate(response.choices)
+        ],
+        "usage": {
+            "prompt_tokens": getattr(usage, "prompt_tokens", 0),
+            "completion_tokens": getattr(usage, "completion_tokens", 0),
+            "total_tokens": getattr(usage, "total_tokens", 0),
+            "cached_tokens": getattr(details, "cached_tokens", 0) or 0,
+        },
+    }
+
+
+def response_from_dict(data):
+    """キャッシュしたJSONから、OpenAIのレスポンスと同じ形でアクセスできるオブジェクトを復元する"""
+    usage = data["usage"]
+    return SimpleNamespace(
+        choices=[
+            SimpleNamespace(
+                index=choice["index"],
+                message=SimpleNamespace(role="assistant", content=choice["content"]),
+                finish_reason=choice["finish_reason"],
+            )
+            for choice in data["choices"]
+        ],
+        usage=SimpleNamespace(
+            prompt_tokens=usage["prompt_tokens"],
+            completion_tokens=usage["completion_tokens"],
+            total_tokens=usage["total_tokens"],
+            prompt_tokens_details=SimpleNamespace(cached_tokens=usage["cached_tokens"]),
+        ),
+        cache_hit=True,
+    )
+
+
+class CachedClient(ClientWrapper):
+    """
+    応答キャッシュを引くラッパー。キャッシュにヒットした場合は、内側のクライアント（APIやレート制限）を一切経由せずに応答を返す。
+    """
+
+    def __init__(self, client, cache):
+        super().__init__(client)
+        self.cache = cache
+
+    def lookup_cached(self, **params):
+        """応答キャッシュにあればその応答を、無ければ None を返す（内側のクライアントは呼ばない）"""
+        if not self.cache.is_cacheable(params):
+            return None
+        # 参照だけでは「n回目の呼び出し」を進めず、ヒットして応答を返す場合だけ1回の呼び出しとして進める
+        cached = self.cache.get(self.cache.make_key(params, advance=False))
+        if cached is None:
+            return None
+        self.cache.make_key(params)
+        return response_from_dict(cached)
+
+    def create(self, **params):
+        if not self.cache.is_cacheable(params):
+            self.cache.count("uncacheable")
+            return self.client.chat.completions.create(**params)
+        key = self.cache.make_key(params)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return response_from_dict(cached)
+        response = self.client.chat.completions.create(**params)
+        self.cache.put(key, response_to_dict(response))
+        return response
@@ -4,16 +4,184 @@ import json
 import glob
 import os
 import argparse
+import bisect
+import hashlib
+from collections import Counter
+from dedup_index import find_duplicate_clusters
+from dataset_store import rebuild_store
 
-def main(input_dir, output_file):
+REQUIRED_FIELDS = {'tier': int, 'category': str, 'question': str, 'answer': str}
+
+def validate_record(item):
+    """1レコードのスキーマを検証し、問題点のリストを返す（問題がなければ空リスト）"""
+    if not isinstance(item, dict):
+        return ["レコードがオブジェクトではありません"]
+    problems = []
+    for field, field_type in REQUIRED_FIELDS.items():
+        value = item.get(field)
+        if not isinstance(value, field_type) or isinstance(value, bool):
+            problems.append(f"'{field}' が存在しないか、型が不正です")
+        elif field_type is str and not value.strip():
+            problems.append(f"'{field}' が空です")
+    if isinstance(item.get('tier'), int) and item['tier'] not in (1, 2, 3, 4):
+        problems.append(f"'tier' の値が不正です: {item['tier']}")
+    return problems
+
+def file_sha256(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def manifest_path_for(output_file):
+    return output_file + ".manifest.json"
+
+def recover_interrupted_rewrite(output_file):
+    """
+    出力ファイルの作り直し（変更・削除されたバッチがある場合）が中断されていれば、その途中の状態を片付ける。
+    作り直しは「一時ファイルの書き出し → 新しいマニフェストを .pending に保存 → 出力ファイルを置き換え → マニフェストを置き換え」
+    の順に行うため、一時ファイルが残っていれば置き換え前（新しいマニフェストを捨てる）、
+    残っていなければ置き換え後（新しいマニフェストを採用する）に中断したことが分かる。
+    """
+    manifest_path = manifest_path_for(output_file)
+    pending_path = manifest_path + ".pending"
+    tmp_file = output_file + ".tmp"
+    if os.path.exists(pending_path) and not os.path.exists(tmp_file):
+        os.replace(pending_path, manifest_path)
+        return
+    for path in (pending_path, tmp_file):
+        if os.path.exists(path):
+            os.remove(path)
+
+def backup_unmanaged_output(output_file):
+    """マニフェストの無い既存の出力ファイル（以前の結合結果や他のツールで作ったファイル）を、上書きしないよう別名に退避する"""
+    backup_file = output_file + ".bak"
+    suffix = 1
+    while os.path.exists(backup_file):
+        backup_file = f"{output_file}.bak{suffix}"
+        suffix += 1
+    os.replace(output_file, backup_file)
+    print(f"⚠️ '{output_file}' に対応するマニフェストが無いため、既存のファイルを '{backup_file}' に退避して、最初から結合し直します。")
+
+def load_manifest(output_file):
+    """
+    前回の結合結果のマニフェストを読み込む（マニフェストか出力ファイルが無い場合は、最初から結合し直す）。
+    出力ファイルは、マニフェストに記録した結合済みの末尾（output_bytes）まで切り詰める。
+    追記の途中で中断した場合も、マニフェストに記録される前のバッチのレコードが残って、IDが重複することはない。
+    マニフェストの無い出力ファイルは切り詰めずに、別名に退避してから結合し直す。
+    """
+    recover_interrupted_rewrite(output_file)
+    manifest_path = manifest_path_for(output_file)
+    manifest = {"next_id": 1, "batches": {}, "output_bytes": 0}
+    if not os.path.exists(output_file):
+        return manifest
+    if not os.path.exists(manifest_path):
+        if os.path.getsize(output_file) > 0:
+            backup_unmanaged_output(output_file)
+        return manifest
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    # output_bytes の無い以前のマニフェストは、現在の出力ファイル全体を結合済みとみなす
+    manifest.setdefault("output_bytes", os.path.getsize(output_file))
+    if os.path.getsize(output_file) > manifest["output_bytes"]:
+        print(f"↻ '{output_file}' の末尾に、前回中断した結合の書きかけのレコードがあるため、取り除きます。")
+        with open(output_file, 'r+b') as f:
+            f.truncate(manifest["output_bytes"])
+    return manifest
+
+def save_manifest(output_file, manifest, pending=False):
+    """マニフェストを保存する（pending=True の場合は、出力ファイルを置き換える前の .pending に保存する）"""
+    manifest_path = manifest_path_for(output_file) + (".pending" if pending else "")
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+def commit_batch(out, output_file, manifest):
+    """追記したバッチのレコードをディスクに書き出してから、結合済みの末尾をマニフェストに記録する"""
+    out.flush()
+    os.fsync(out.fileno())
+    manifest["output_bytes"] = os.fstat(out.fileno()).st_size
+    save_manifest(output_file, manifest)
+
+def append_batch(filepath, out, manifest, checksum):
+    """バッチファイルを1つ読み込み、検証しながら新しいIDを振って出力ファイルに追記する"""
+    name = os.path.basename(filepath)
+    first_id = manifest["next_id"]
+    with open(filepath, 'r', encoding='utf-8') as f:
+        try:
+            data = json.load(f)
+        except json.JSONDecodeError:
+            data = None
+    if not isinstance(data, list):
+        print(f"    - 警告: {name} は不正なJSONファイルです。スキップします。")
+        # ファイルが修正されてチェックサムが変わるまでは、0件として記録しておく
+        manifest["batches"][name] = {"sha256": checksum, "first_id": first_id, "count": 0, "invalid": 0}
+        return 0, 0
+
+    count = invalid = 0
+    for position, item in enumerate(data):
+        problems = validate_record(item)
+        if problems:
+            invalid += 1
+            print(f"    - 警告: {name} の{position + 1}件目をスキップします（{'; '.join(problems)}）")
+            continue
+        item['id'] = first_id + count
+        out.write(json.dumps(item, ensure_ascii=False) + "\n")
+        count += 1
+
+    manifest["next_id"] = first_id + count
+    manifest["batches"][name] = {"sha256": checksum, "first_id": first_id, "count": count, "invalid": invalid}
+    return count, invalid
+
+def write_legacy_json(jsonl_file, legacy_json_file):
+    """JSONLを1行ずつ読みながら、従来形式（JSON配列）のファイルに書き出す"""
+    with open(jsonl_file, 'r', encoding='utf-8') as src, open(legacy_json_file, 'w', encoding='utf-8') as dst:
+        dst.write("[")
+        first = True
+        for line in src:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            dst.write(("\n" if first else ",\n") + "  " + json.dumps(item, indent=2, ensure_ascii=False).replace("\n", "\n  "))
+            first = False
+        dst.write("\n]\n" if not first else "]\n")
+
+def iter_jsonl(jsonl_file):
+    with open(jsonl_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def report_duplicates(output_file, threshold):
+    """データセット全体の近似重複クラスタを求め、カテゴリ別の件数を表示してレポートファイルに書き出す"""
+    clusters = find_duplicate_clusters(iter_jsonl(output_file), threshold=threshold)
+    report_file = output_file + ".duplicates.json"
+    with open(report_file, 'w', encoding='utf-8') as f:
+        json.dump(clusters, f, indent=2, ensure_ascii=False)
+
+    redundant = Counter()
+    for cluster in clusters:
+        redundant[cluster["category"]] += len(cluster["ids"]) - 1
+    print(f"\n近似重複クラスタ: {len(clusters)}個（重複として余分なレコード: {sum(redundant.values())}件）")
+    for category, count in redundant.most_common():
+        print(f"   - {category}: {count}件")
+    print(f"   - レポート: {report_file}")
+
+def main(input_dir, output_file, legacy_json_file=None, duplicate_threshold=None, store_dir=None, store_compression=None):
     """
-    指定されたディレクトリ内のバッチファイル（batch_XXX.json）を結合し、
-    最終的なIDを1から振り直して、単一のJSONファイルとして出力する。
+    指定されたディレクトリ内のバッチファイル（batch_XXX.json）を、1ファイルずつ読み込みながら
+    JSONL形式の出力ファイルに結合する。
+    結合済みのバッチファイルとチェックサムはマニフェストに記録し、再実行時は
+    新規・変更のあったバッチだけを処理する（変更の無いバッチのIDは変わらない）。
+    duplicate_threshold を指定した場合は、データセット全体の近似重複クラスタもレポートする。
+    store_dir を指定した場合は、結合結果からシャード形式のデータセット（dataset_store.py）も作り直す。
     """
     # バッチ処理で生成されるファイル名パターン
     file_pattern = "batch_*.json"
     search_path = os.path.join(input_dir, file_pattern)
-    
+
     # globの結果は順序が保証されないため、ファイル名でソートして処理の順序を安定させる
     batch_files = sorted(glob.glob(search_path))
 
@@ -21,49 +189,133 @@ def main(input_dir, output_file):
         print(f"エラー: ディレクトリ '{input_dir}' に結合対象のバッチファイル（{file_pattern}）が見つかりません。")
         return
 
-    print(f"{len(batch_files)}個のバッチファイルを結合します...")
-    print("-" * 20)
+    manifest = load_manifest(output_file)
+    merged = manifest["batches"]
+    checksums = {filepath: file_sha256(filepath) for filepath in batch_files}
+    names = {os.path.basename(filepath) for filepath in batch_files}
 
-    all_data = []
-    for filepath in batch_files:
-        print(f"  > 読み込み中: {os.path.basename(filepath)}")
-        with open(filepath, 'r', encoding='utf-8') as f:
-            try:
-                data = json.load(f)
-                all_data.extend(data)
-            except json.JSONDecodeError:
-                print(f"    - 警告: {os.path.basename(filepath)} は不正なJSONファイルです。スキップします。")
-
-    # 【重要】最終的なIDを1から振り直す
+    changed = [fp for fp in batch_files if os.path.basename(fp) in merged and merged[os.path.basename(fp)]["sha256"] != checksums[fp]]
+    new = [fp for fp in batch_files if os.path.basename(fp) not in merged]
+    removed = [name for name in merged if name not in names]
+
+    print(f"{len(batch_files)}個のバッチファイルを確認しました。"
+          f"（結合済み・変更なし: {len(batch_files) - len(changed) - len(new)}個 / 新規: {len(new)}個 / 変更あり: {len(changed)}個 / 削除: {len(removed)}個）")
     print("-" * 20)
-    print("全データを結合し、最終IDを振り直しています...")
-    for i, item in enumerate(all_data):
-        item['id'] = i + 1
 
-    # 最終的なファイルに書き出す
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(all_data, f, indent=2, ensure_ascii=False)
+    total_added = total_invalid = 0
+    if not changed and not removed:
+        # 新しいバッチだけを既存の出力ファイルの末尾に追記する（1バッチごとにマニフェストを保存し、中断しても再実行できるようにする）
+        if not os.path.exists(manifest_path_for(output_file)):
+            # 最初のバッチの追記中に中断した場合も、書きかけの出力ファイルを次回に切り詰められるよう、先にマニフェストを作っておく
+            save_manifest(output_file, manifest)
+        with open(output_file, 'a', encoding='utf-8') as out:
+            for filepath in new:
+                print(f"  > 追記中: {os.path.basename(filepath)}")
+                added, invalid = append_batch(filepath, out, manifest, checksums[filepath])
+                commit_batch(out, output_file, manifest)
+                total_added += added
+                total_invalid += invalid
+    else:
+        # 変更・削除されたバッチのレコードだけを取り除き、変更分と新規分を末尾に付け直す
+        stale = sorted(
+            (merged[name]["first_id"], merged[name]["first_id"] + merged[name]["count"])
+            for name in removed + [os.path.basename(fp) for fp in changed]
+        )
+        stale_starts = [start for start, _ in stale]
+        for name in removed:
+            del merged[name]
+        tmp_file = output_file + ".tmp"
+        with open(output_file, 'r', encoding='utf-8') as src, open(tmp_file, 'w', encoding='utf-8') as out:
+            for line in src:
+                if not line.strip():
+                    continue
+                record_id = json.loads(line)['id']
+                k = bisect.bisect_right(stale_starts, record_id) - 1
+                if k >= 0 and record_id < stale[k][1]:
+                    continue
+                out.write(line)
+            for filepath in changed + new:
+                print(f"  > {'再結合' if filepath in changed else '追記'}中: {os.path.basename(filepath)}")
+                added, invalid = append_batch(filepath, out, manifest, checksums[filepath])
+                total_added += added
+                total_invalid += invalid
+            out.flush()
+            os.fsync(out.fileno())
+            manifest["output_bytes"] = os.fstat(out.fileno()).st_size
+        # 新しいマニフェストを先に .pending として保存してから置き換える（中断時は recover_interrupted_rewrite で片付ける）
+        save_manifest(output_file, manifest, pending=True)
+        os.replace(tmp_file, output_file)
+        os.replace(manifest_path_for(output_file) + ".pending", manifest_path_for(output_file))
+
+    save_manifest(output_file, manifest)
+    total = sum(entry["count"] for entry in manifest["batches"].values())
+
+    if legacy_json_file:
+        write_legacy_json(output_file, legacy_json_file)
+    if store_dir:
+        store = rebuild_store(store_dir, iter_jsonl(output_file), key="id", compression=store_compression)
 
     print(f"\n✅ 結合とID付与が完了しました。")
     print(f"   - 出力ファイル: {output_file}")
-    print(f"   - 合計件数: {len(all_data)}件")
+    if legacy_json_file:
+        print(f"   - 従来形式（JSON配列）: {legacy_json_file}")
+    if store_dir:
+        print(f"   - シャード形式: {store.describe()}")
+    print(f"   - 今回追加した件数: {total_added}件（スキーマ不正でスキップ: {total_invalid}件）")
+    print(f"   - 合計件数: {total}件")
+
+    if duplicate_threshold:
+        report_duplicates(output_file, duplicate_threshold)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="QAペアのバッチファイルを結合し、最終IDを付与するスクリプト")
-    
+
     # Colabでもローカルでも使いやすいように、引数でディレクトリとファイル名を指定可能にする
     parser.add_argument(
-        '--input_dir', 
-        type=str, 
-        default='batches', 
+        '--input_dir',
+        type=str,
+        default='batches',
         help='バッチファイルが格納されているディレクトリのパス'
     )
     parser.add_argument(
-        '--output_file', 
-        type=str, 
-        default='QA_pairs_5000_final.json', 
-        help='最終的な出力ファイル名'
+        '--output_file',
+        type=str,
+        default='QA_pairs_5000_final.jsonl',
+        help='最終的な出力ファイル名（JSONL形式）'
+    )
+    parser.add_argument(
+        '--legacy_json_file',
+        type=str,
+        default=None,
+        help='従来形式（JSON配列）のファイルも出力する場合のファイル名（例: QA_pairs_5000_final.json）'
+    )
+
+    parser.add_argument(
+        '--report_duplicates',
+        action='store_true',
+        help='データセット全体の近似重複クラスタをレポートする'
+    )
+    parser.add_argument(
+        '--duplicate_threshold',
+        type=float,
+        default=0.7,
+        help='近似重複とみなす推定Jaccard類似度'
+    )
+
+    parser.add_argument(
+        '--store_dir',
+        type=str,
+        default=None,
+        help='シャード形式のデータセットも作る場合のディレクトリ（例: dataset/qa）'
+    )
+    parser.add_argument(
+        '--store_compression',
+        choices=['gzip'],
+        default=None,
+        help='シャード形式のデータセットをgzipで圧縮する'
     )
 
     args = parser.parse_args()
-    main(args.input_dir, args.output_file)
+    main(args.input_dir, args.output_file, args.legacy_json_file,
+         args.duplicate_threshold if args.report_duplicates else None,
+         args.store_dir, args.store_compression)
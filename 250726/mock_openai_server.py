@@ -0,0 +1,277 @@
+# mock_openai_server.py
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 合成するQAの回答・発話の材料（重複判定に引っかからないよう、組み合わせで毎回違う文章を作る）
+_SURNAMES = ["佐藤", "鈴木", "高橋", "田中", "伊藤", "渡辺", "山本", "中村", "小林", "加藤", "吉田", "山田"]
+_GIVEN_NAMES = ["翔太", "美咲", "健太", "陽菜", "大輝", "結衣", "拓海", "葵", "蓮", "凛", "悠真", "芽依"]
+_PLACES = ["北海道", "青森県", "宮城県", "東京都", "神奈川県", "新潟県", "長野県", "静岡県", "愛知県", "京都府",
+           "大阪府", "兵庫県", "広島県", "愛媛県", "福岡県", "熊本県", "沖縄県"]
+_WORDS = ["夕暮れ", "図書館", "自転車", "雨上がり", "祖母の台所", "夏祭り", "古い喫茶店", "海辺の駅", "雪の朝",
+          "商店街", "キャンプ場", "美術館", "路面電車", "朝市", "山小屋", "花火大会", "港町", "植物園"]
+_VERBS = ["思い出します", "忘れられません", "話していました", "大切にしています", "今でも覚えています", "よく通いました"]
+
+
+def _phrase(rng):
+    return f"{rng.choice(_WORDS)}で{rng.choice(_WORDS)}を{rng.choice(_VERBS)}（{rng.randrange(100000)}）"
+
+
+class MockBehavior:
+    """
+    モックサーバーの振る舞い（応答遅延の分布と、429・不正なJSON・判定による却下の発生率）。
+    遅延は中央値 latency_ms・ばらつき latency_sigma の対数正規分布に従う。
+    dropped_item_rate は、QAペアをまとめて生成するリクエストで、一部の項目を返さない割合。
+    """
+
+    def __init__(self, latency_ms=200, latency_sigma=0.5, rate_limit_rate=0.0, retry_after_ms=200,
+                 malformed_json_rate=0.0, judge_rejection_rate=0.0, identity_mention_rate=0.2, dropped_item_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after_ms = retry_after_ms
+        self.malformed_json_rate = malformed_json_rate
+        self.judge_rejection_rate = judge_rejection_rate
+        self.identity_mention_rate = identity_mention_rate
+        self.dropped_item_rate = dropped_item_rate
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = Counter()
+
+    def draw(self):
+        """1リクエスト分の (遅延秒, 0〜1の乱数) を引く（乱数生成器はスレッド間で共有するためロックする）"""
+        with self._lock:
+            latency = self.latency_ms / 1000 * self.rng.lognormvariate(0, self.latency_sigma) if self.latency_ms else 0.0
+            return latency, random.Random(self.rng.getrandbits(64))
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+
+def synthetic_qa_record(category, rng, tier=None):
+    """カテゴリに合った、それらしいQAペアを合成する（名前・誕生日・出身地は抽出できる形で含める）"""
+    if category == "ユーザーの名前":
+        fact = f"お名前は{rng.choice(_SURNAMES)}{rng.choice(_GIVEN_NAMES)}さん"
+    elif category == "誕生日":
+        fact = f"誕生日は{rng.randint(1, 12)}月{rng.randint(1, 28)}日"
+    elif category == "出身地":
+        fact = f"{rng.choice(_PLACES)}のご出身"
+    else:
+        fact = f"{category}は{rng.choice(_WORDS)}"
+    record = {} if tier is None else {"tier": tier}
+    record.update({
+        "category": category,
+        "question": f"私の{category}について覚えていますか？",
+        "answer": f"はい、{fact}ですね。{_phrase(rng)}とおっしゃっていました。",
+    })
+    return record
+
+
+def classify_request(messages):
+    """リクエストのプロンプトから、どのフェーズのどの呼び出しかを判別する"""
+    text = "\n".join(str(message.get("content", "")) for message in messages)
+    if '"verdicts"' in text:
+        return "judge_batch"
+    if '"is_consistent"' in text:
+        return "judge"
+    if '"items"' in text:
+        return "qa_multi"
+    if '"question"' in text and '"answer"' in text:
+        return "qa"
+    if "抽出した情報" in text:
+        return "extract"
+    if "# これまでの会話の要約\n" in text and "# 続きの発言" in text:
+        return "summary"
+    return "dialogue"
+
+
+def mock_content(kind, messages, rng, behavior):
+    """呼び出しの種類に応じて、それらしい応答の本文を作る"""
+    text = "\n".join(str(message.get("content", "")) for message in messages)
+    if kind == "qa":
+        match = re.search(r"「(.+?)」に関する", text)
+        return json.dumps(synthetic_qa_record(match.group(1) if match else "不明", rng), ensure_ascii=False)
+    if kind == "qa_multi":
+        items = []
+        for index, category in re.findall(r"^\[(\d+)\] (.+)$", text, re.MULTILINE):
+            if rng.random() < behavior.dropped_item_rate:
+                behavior.count("dropped_items")
+                continue
+            items.append({"index": int(index), **synthetic_qa_record(category, rng)})
+        return json.dumps({"items": items}, ensure_ascii=False)
+    if kind == "extract":
+        keys = re.findall(r'"(\w+)": "抽出した情報"', text)
+        values = {
+            "name": f"{rng.choice(_SURNAMES)}{rng.choice(_GIVEN_NAMES)}",
+            "birthday": f"{rng.randint(1, 12)}月{rng.randint(1, 28)}日",
+            "from": rng.choice(_PLACES),
+        }
+        if not keys:
+            return json.dumps({"core_info": rng.choice(list(values.values()))}, ensure_ascii=False)
+        return json.dumps({key: values.get(key, "不明") for key in keys}, ensure_ascii=False)
+    if kind == "judge":
+        consistent = rng.random() >= behavior.judge_rejection_rate
+        if not consistent:
+            behavior.count("judge_rejections")
+        return json.dumps({"is_consistent": consistent, "reason": "モックサーバーによる判定"}, ensure_ascii=False)
+    if kind == "judge_batch":
+        verdicts = []
+        for index in re.findall(r"^\[(\d+)\]", text, re.MULTILINE):
+            consistent = rng.random() >= behavior.judge_rejection_rate
+            if not consistent:
+                behavior.count("judge_rejections")
+            verdicts.append({"index": int(index), "is_consistent": consistent, "reason": "モックサーバーによる判定"})
+        return json.dumps({"verdicts": verdicts}, ensure_ascii=False)
+    if kind == "summary":
+        return f"これまでの会話では、{_phrase(rng)}という話や、{_phrase(rng)}という話をしました。"
+    # 対話の発話（一部は、ローカル判定では決まらない本人の情報への言及を含め、LLM判定に回るようにする）
+    utterance = f"{_phrase(rng)}。{_phrase(rng)}。"
+    if rng.random() < behavior.identity_mention_rate:
+        utterance = f"そういえば、私の名前の由来を昔よく聞かれました。{utterance}"
+    return utterance
+
+
+def build_completion(params, rng, behavior):
+    messages = params.get("messages", [])
+    kind = classify_request(messages)
+    behavior.count(kind)
+    json_mode = (params.get("response_format") or {}).get("type") == "json_object"
+    choices = []
+    for index in range(params.get("n") or 1):
+        content = mock_content(kind, messages, rng, behavior)
+        if json_mode and rng.random() < behavior.malformed_json_rate:
+            behavior.count("malformed_json")
+            content = content[:len(content) // 2]
+        choices.append({"index": index, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"})
+    prompt_tokens = sum(len(str(message.get("content", ""))) for message in messages)
+    completion_tokens = sum(len(choice["message"]["content"]) for choice in choices)
+    return {
+        "id": f"chatcmpl-mock-{rng.getrandbits(48):012x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": params.get("model", "mock"),
+        "choices": choices,
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": 0},
+        },
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive を有効にし、クライアント側のコネクションプールをそのまま使えるようにする
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        behavior = self.server.behavior
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            params = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"message": "invalid JSON body", "type": "invalid_request_error"}})
+            return
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"unknown path: {self.path}", "type": "invalid_request_error"}})
+            return
+
+        latency, rng = behavior.draw()
+        if rng.random() < behavior.rate_limit_rate:
+            behavior.count("rate_limited")
+            self._send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error"}},
+                            {"retry-after-ms": str(behavior.retry_after_ms)})
+            return
+        time.sleep(latency)
+        self._send_json(200, build_completion(params, rng, behavior))
+
+
+class MockOpenAIServer:
+    """
+    OpenAI互換の /v1/chat/completions を返すローカルのモックサーバー。
+    `OpenAI(base_url=server.base_url)`（または環境変数 OPENAI_BASE_URL）で接続する。
+    """
+
+    def __init__(self, behavior=None, host="127.0.0.1", port=0):
+        self.behavior = behavior or MockBehavior()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.behavior = self.behavior
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def add_behavior_arguments(parser):
+    parser.add_argument('--latency_ms', type=float, default=200, help='応答遅延の中央値（ミリ秒）')
+    parser.add_argument('--latency_sigma', type=float, default=0.5, help='応答遅延（対数正規分布）のばらつき')
+    parser.add_argument('--rate_limit_rate', type=float, default=0.0, help='429（レート制限）を返す割合')
+    parser.add_argument('--retry_after_ms', type=int, default=200, help='429応答の retry-after-ms ヘッダーの値')
+    parser.add_argument('--malformed_json_rate', type=float, default=0.0, help='JSONモードの応答を壊して返す割合')
+    parser.add_argument('--judge_rejection_rate', type=float, default=0.0, help='LLM判定で「矛盾あり」を返す割合')
+    parser.add_argument('--dropped_item_rate', type=float, default=0.0, help='QAペアをまとめて生成するリクエストで、項目を返さない割合')
+    parser.add_argument('--seed', type=int, default=None, help='乱数のシード')
+
+
+def behavior_from_args(args):
+    return MockBehavior(
+        latency_ms=args.latency_ms, latency_sigma=args.latency_sigma, rate_limit_rate=args.rate_limit_rate,
+        retry_after_ms=args.retry_after_ms, malformed_json_rate=args.malformed_json_rate,
+        judge_rejection_rate=args.judge_rejection_rate, dropped_item_rate=args.dropped_item_rate, seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI互換のローカルモックサーバーを起動する")
+    parser.add_argument('--port', type=int, default=8000)
+    add_behavior_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(behavior_from_args(args), port=args.port)
+    print(f"モックサーバーを起動しました: {server.base_url}（Ctrl+C で終了）")
+    print(f"  export OPENAI_BASE_URL={server.base_url}")
+    server.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print(f"\n受け付けたリクエスト: {dict(server.behavior.stats)}")
+        server.stop()
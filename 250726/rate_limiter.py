@@ -0,0 +1,247 @@
+# rate_limiter.py
+
+import random
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from openai import APIConnectionError
+from client_wrapper import ClientWrapper
+
+
+class RateLimiter:
+    """
+    「リクエスト数/分」と「トークン数/分」の2つのトークンバケットで、
+    API呼び出しのペースを平準化するスレッドセーフなリミッター。
+    固定のsleepの代わりに、上限に達したときだけ必要な時間だけ待機する。
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._lock = threading.Lock()
+        self._request_allowance = float(requests_per_minute)
+        self._token_allowance = float(tokens_per_minute or 0)
+        self._last_refill = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._request_allowance = min(
+            self.requests_per_minute,
+            self._request_allowance + elapsed * self.requests_per_minute / 60.0,
+        )
+        if self.tokens_per_minute:
+            self._token_allowance = min(
+                self.tokens_per_minute,
+                self._token_allowance + elapsed * self.tokens_per_minute / 60.0,
+            )
+
+    def acquire(self, tokens=0):
+        """1リクエスト分（推定 tokens トークン）の枠が空くまで待機してから枠を消費する"""
+        if self.tokens_per_minute:
+            # 1リクエストがバケット容量を超える場合でも、永久に待たないようにする
+            tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                self._refill()
+                request_wait = (1 - self._request_allowance) * 60.0 / self.requests_per_minute
+                token_wait = 0.0
+                if self.tokens_per_minute:
+                    token_wait = (tokens - self._token_allowance) * 60.0 / self.tokens_per_minute
+                wait = max(request_wait, token_wait)
+                if wait <= 0:
+                    self._request_allowance -= 1
+                    if self.tokens_per_minute:
+                        self._token_allowance -= tokens
+                    return
+            time.sleep(min(wait, 1.0))
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """実際の消費トークン数と推定値の差分をバケットに反映する"""
+        if not self.tokens_per_minute or actual_tokens is None:
+            return
+        with self._lock:
+            self._token_allowance -= actual_tokens - estimated_tokens
+
+
+def estimate_request_tokens(params, completion_tokens=500):
+    """
+    リクエストの消費トークン数を大まかに見積もる。
+    日本語はおおよそ1文字1トークン前後のため、文字数をそのまま使う（やや多めの見積もり）。
+    """
+    prompt_chars = sum(len(str(m.get("content") or "")) for m in params.get("messages", []))
+    return prompt_chars + params.get("max_tokens", completion_tokens) * params.get("n", 1)
+
+
+def retry_after_seconds(error):
+    """エラー応答の retry-after-ms / Retry-After ヘッダーから、待機すべき秒数を読み取る（無ければ None）"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            # HTTP日付形式（例: "Wed, 21 Oct 2026 07:28:00 GMT"）
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable_error(error):
+    """時間をおけば成功し得るエラー（429・408・409・5xx・接続エラー）かどうか"""
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in (408, 409, 429) or status >= 500
+    return isinstance(error, (APIConnectionError, ConnectionError, TimeoutError))
+
+
+def is_overload_error(error):
+    """APIが過負荷を知らせるエラー（429・503）かどうか。この場合は同時実行数を下げる"""
+    return getattr(error, "status_code", None) in (429, 503)
+
+
+class RequestGovernor:
+    """
+    全スレッドで共有する、API呼び出しの同時実行数・再試行・サーキットブレーカーの制御。
+    * 同時実行数は AIMD で調整する（成功が続くと少しずつ増やし、429・503を受けたら半分に減らす）。
+    * 再試行できるエラーは、Retry-After があればその時間、無ければジッター付きの指数バックオフで待ってから再試行する。
+    * 直近 window 件の呼び出しのエラー率が error_rate_threshold 以上になったら回路を開き、
+      cooldown 秒間すべての呼び出しを止めてから、同時実行数1で再開する。
+    on_event を渡すと、再試行などのイベントを on_event(名前, **詳細) で通知する。
+    """
+
+    def __init__(self, max_concurrency, min_concurrency=1, max_retries=6, base_delay=1.0, max_delay=60.0,
+                 error_rate_threshold=0.5, window=20, cooldown=30.0, on_event=None):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.error_rate_threshold = error_rate_threshold
+        self.cooldown = cooldown
+        self.on_event = on_event
+        self.limit = float(max_concurrency)
+        self.stats = Counter()
+        self._in_flight = 0
+        self._outcomes = deque(maxlen=window)
+        self._open_until = 0.0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._rng = random.Random()
+
+    def _emit(self, name, **fields):
+        if self.on_event is not None:
+            self.on_event(name, **fields)
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if now < self._open_until:
+                    self._cond.wait(self._open_until - now)
+                elif self._in_flight < int(self.limit):
+                    self._in_flight += 1
+                    return
+                else:
+                    self._cond.wait()
+
+    def _release(self, error=None, retryable=False, retry_after=None):
+        opened = False
+        with self._cond:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if error is None:
+                self._outcomes.append(True)
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            elif retryable:
+                self._outcomes.append(False)
+                # 同じ混雑で並行して返ってきた429で何度も半減させないよう、減らすのは一定間隔に1回だけにする
+                if is_overload_error(error) and now - self._last_decrease >= max(1.0, retry_after or 0):
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self._last_decrease = now
+                    self.stats["concurrency_decreases"] += 1
+                failures = self._outcomes.count(False)
+                if len(self._outcomes) == self._outcomes.maxlen and failures / len(self._outcomes) >= self.error_rate_threshold:
+                    self._open_until = now + self.cooldown
+                    self.limit = float(self.min_concurrency)
+                    self._outcomes.clear()
+                    self.stats["circuit_opened"] += 1
+                    opened = True
+            self._cond.notify_all()
+        if opened:
+            print(f"\n⚠️ エラー率が{self.error_rate_threshold * 100:.0f}%を超えたため、{self.cooldown:.0f}秒間API呼び出しを停止します。")
+            self._emit("circuit_open", cooldown_s=self.cooldown)
+
+    def backoff_delay(self, attempt, retry_after=None):
+        """Retry-After があればそれに少しのジッターを加え、無ければ上限付きの指数バックオフ（イコールジッター）"""
+        if retry_after is not None:
+            return min(self.max_delay, retry_after) + self._rng.uniform(0, 0.1 * retry_after + 0.05)
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return self._rng.uniform(delay / 2, delay)
+
+    def call(self, fn):
+        """fn() を同時実行数の枠内で実行し、再試行できるエラーは待ってから再試行する"""
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            try:
+                result = fn()
+            except Exception as e:
+                retryable = is_retryable_error(e)
+                retry_after = retry_after_seconds(e) if retryable else None
+                self._release(e, retryable, retry_after)
+                if not retryable or attempt == self.max_retries:
+                    if retryable:
+                        self.stats["gave_up"] += 1
+                    raise
+                status = getattr(e, "status_code", None)
+                self.stats["retries"] += 1
+                if status == 429:
+                    self.stats["rate_limited"] += 1
+                delay = self.backoff_delay(attempt, retry_after)
+                self._emit("api_retry", attempt=attempt + 1, status=status, delay_s=round(delay, 3))
+                time.sleep(delay)
+            else:
+                self._release()
+                return result
+
+    def format_stats(self):
+        return (
+            f"リクエスト制御: API再試行 {self.stats['retries']}回（うち429 {self.stats['rate_limited']}回） / "
+            f"再試行の上限到達 {self.stats['gave_up']}回 / 同時実行数の引き下げ {self.stats['concurrency_decreases']}回"
+            f"（現在 {int(self.limit)}/{self.max_concurrency}） / サーキットブレーカー作動 {self.stats['circuit_opened']}回"
+        )
+
+
+class RateLimitedClient(ClientWrapper):
+    """
+    呼び出しごとに RateLimiter の枠を確保してから、内側のクライアントにリクエストを渡すラッパー。
+    governor（RequestGovernor）を渡した場合は、同時実行数の制御と再試行もここで行う
+    （内側のOpenAIクライアントは max_retries=0 にして、再試行を governor に任せる）。
+    """
+
+    def __init__(self, client, limiter, governor=None):
+        super().__init__(client)
+        self.limiter = limiter
+        self.governor = governor
+
+    def create(self, **params):
+        if self.governor is None:
+            return self._create(params)
+        return self.governor.call(lambda: self._create(params))
+
+    def _create(self, params):
+        estimated = estimate_request_tokens(params)
+        self.limiter.acquire(estimated)
+        response = self.client.chat.completions.create(**params)
+        usage = getattr(response, "usage", None)
+        self.limiter.record_usage(estimated, getattr(usage, "total_tokens", None))
+        return response
@@ -0,0 +1,348 @@
+# run_pipeline.py
+
+import argparse
+import queue
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from tqdm.auto import tqdm
+from llm_backend import ClientConfig, build_client
+from generation_log import GenerationLog
+from telemetry import TELEMETRY
+from dataset_store import close_stores
+from budget import BudgetExceeded, CostEstimate
+import generate_qa_5000_in_colab as qa
+import create_pilot_personas_v4_api as personas
+import generate_dialogue_v7_llm_judge as dialogue
+
+# ---------------------------------
+# 1. 設定
+# ---------------------------------
+class Config(ClientConfig):
+    """
+    設定を管理するクラス（各フェーズの入出力先などは、それぞれのスクリプトの Config に従う。
+    API_KEY・レート制限・応答キャッシュなどの共通の設定は llm_backend.py の ClientConfig を参照）
+    """
+    # フェーズごとの同時実行数（API呼び出しのペースは、全フェーズで共有する1つのレート制限で調整する）
+    QA_CONCURRENCY = 16
+    PERSONA_CONCURRENCY = 4
+    DIALOGUE_CONCURRENCY = 8
+    # フェーズAからフェーズBに渡す、未処理のQAペアの上限（これを超えるとフェーズAの生成を待たせる）
+    QUEUE_SIZE = 256
+    # ペルソナへのQAペアの割り当てを記録するログ（再開時に同じ割り当てを再現する）
+    PIPELINE_LOG = "pipeline.log.jsonl"
+
+def create_shared_client():
+    """3つのフェーズで共有する、レート制限・予算・応答キャッシュ・計測付きのAPIクライアントを作成する"""
+    # 3つのフェーズの役割（生成・抽出・判定）のルートをまとめ、接続先ごとのコネクションプールを共有する
+    routes = [*qa.Config.MODEL_ROUTES.values(), *personas.Config.MODEL_ROUTES.values(), *dialogue.Config.MODEL_ROUTES.values()]
+    return build_client(Config, Config.QA_CONCURRENCY + Config.PERSONA_CONCURRENCY + Config.DIALOGUE_CONCURRENCY, routes)
+
+# ---------------------------------
+# 2. QAペアのペルソナへの割り当て
+# ---------------------------------
+class PersonaAssembler:
+    """
+    フェーズAから届くQAペアを、アンカー（名前・誕生日・出身地）とその他の事実のプールに振り分け、
+    1人分（アンカー各1件＋その他 other_facts_per_persona 件）が揃い次第、次のペルソナに割り当てる。
+    QAペアはスロット番号で識別し、割り当ては {"persona_id", "anchor_slots", "other_slots"} で表す。
+    """
+
+    def __init__(self, num_personas, other_facts_per_persona, anchor_categories, min_other_facts=0):
+        self.num_personas = num_personas
+        self.other_facts_per_persona = other_facts_per_persona
+        self.min_other_facts = min_other_facts
+        self.anchor_categories = anchor_categories
+        self.anchor_pools = {category: deque() for category in anchor_categories}
+        self.other_pool = deque()
+        self.records = {}
+        self.assigned_slots = set()
+        self.waiting = {}
+        self.next_persona_id = 1
+
+    def restore(self, assignment, needs_records=True):
+        """生成ログに記録済みの割り当てを復元する。needs_records なら、QAペアが揃った時点で add() が返す"""
+        self.assigned_slots.update(assignment["anchor_slots"] + assignment["other_slots"])
+        self.next_persona_id = max(self.next_persona_id, assignment["persona_id"] + 1)
+        if needs_records:
+            self.waiting[assignment["persona_id"]] = assignment
+
+    def _is_complete(self, assignment):
+        return all(slot in self.records for slot in assignment["anchor_slots"] + assignment["other_slots"])
+
+    def _assign(self, num_other_facts):
+        assignment = {
+            "persona_id": self.next_persona_id,
+            "anchor_slots": [self.anchor_pools[category].popleft() for category in self.anchor_categories],
+            "other_slots": [self.other_pool.popleft() for _ in range(num_other_facts)],
+        }
+        self.next_persona_id += 1
+        self.assigned_slots.update(assignment["anchor_slots"] + assignment["other_slots"])
+        return assignment
+
+    def add(self, slot_index, record):
+        """
+        QAペアを1件追加し、(新しく割り当てたペルソナ, 復元した割り当てのうちQAペアが揃ったペルソナ) を返す
+        """
+        self.records[slot_index] = record
+        if slot_index not in self.assigned_slots:
+            category = record["category"]
+            (self.anchor_pools[category] if category in self.anchor_pools else self.other_pool).append(slot_index)
+
+        restored = [assignment for assignment in self.waiting.values() if self._is_complete(assignment)]
+        for assignment in restored:
+            del self.waiting[assignment["persona_id"]]
+
+        new = []
+        while (self.next_persona_id <= self.num_personas and all(self.anchor_pools.values())
+               and len(self.other_pool) >= self.other_facts_per_persona):
+            new.append(self._assign(self.other_facts_per_persona))
+        return new, restored
+
+    def flush(self):
+        """
+        フェーズAの完了後、その他の事実が other_facts_per_persona 件に満たないペルソナにも、残りの事実を均等に割り当てる
+        （min_other_facts 件も割り当てられない場合は、それ以上ペルソナを作らない）
+        """
+        new = []
+        while self.next_persona_id <= self.num_personas and all(self.anchor_pools.values()):
+            remaining_personas = min(self.num_personas - self.next_persona_id + 1,
+                                     min(len(pool) for pool in self.anchor_pools.values()))
+            num_other_facts = min(len(self.other_pool) // remaining_personas, self.other_facts_per_persona)
+            if num_other_facts < self.min_other_facts:
+                break
+            new.append(self._assign(num_other_facts))
+        return new
+
+    def build(self, assignment):
+        """
+        割り当てから、ペルソナ1人分のデータを作る。結合後のIDはまだ決まらないため、QAペアの id と custom_id には
+        スロットの custom_id を入れる（結合後のデータセットの各レコードの custom_id と突き合わせられる）。
+        """
+        def with_id(slot_index):
+            custom_id = qa.slot_custom_id(slot_index)
+            return {**self.records[slot_index], "id": custom_id, "custom_id": custom_id}
+        return personas.build_persona(
+            assignment["persona_id"],
+            [with_id(slot_index) for slot_index in assignment["anchor_slots"]],
+            [with_id(slot_index) for slot_index in assignment["other_slots"]],
+        )
+
+# ---------------------------------
+# 3. ストリーミング実行
+# ---------------------------------
+def run_pipeline(total_items=5000, num_personas=100, batch_size=100):
+    """
+    フェーズA（QAペア生成）→ B（ペルソナ構築）→ C（対話生成）を、ファイルの受け渡しを待たずに重ねて実行する。
+    * フェーズAのQAペアは完了した順にキュー（上限 Config.QUEUE_SIZE）で流し、1人分の事実が揃ったペルソナから
+      プロフィールを抽出して persona_XX.json を書き出す（出力形式が "sharded" ならデータセットに追加する）。
+    * ペルソナが書き出されたものから、すぐに対話生成を始める。
+    * API呼び出しのペースは、3つのフェーズで共有する1つのレート制限で調整する。
+    各フェーズの生成ログとペルソナへの割り当てのログ（Config.PIPELINE_LOG）により、中断後の再実行時は続きから再開する。
+    予算の上限（Config.BUDGET_USD / BUDGET_TOKENS）に達した場合も、完了した分までを記録して停止し、再実行時は続きから再開する。
+    """
+    print("--- ストリーミング・パイプライン（フェーズA → B → C）を開始します ---")
+    TELEMETRY.start(Config.TRACE_FILE)
+    client = create_shared_client()
+    print(f"モデルの振り分け: {client.describe_routes()}")
+    dialogue.Config.PERSONA_DIR = personas.Config.OUTPUT_DIR
+    dialogue.Config.PERSONA_STORE_DIR = personas.Config.STORE_DIR
+
+    full_plan = qa.get_full_generation_plan(total_items)
+    anchor_categories = personas.Config.ANCHOR_CATEGORIES
+    num_other_slots = sum(1 for _, category in full_plan if category not in anchor_categories)
+    other_facts_per_persona = max(dialogue.Config.NUM_INJECTIONS, num_other_slots // num_personas)
+    anchors_available = min(sum(1 for _, category in full_plan if category == anchor) for anchor in anchor_categories)
+    if anchors_available < num_personas:
+        print(f"⚠️ 計画に含まれるアンカー情報が足りないため、ペルソナは最大{anchors_available}人までしか作成できません。")
+    print(f"全体計画: QAペア {total_items}件 / ペルソナ {num_personas}人（その他の事実 {other_facts_per_persona}件/人）")
+
+    assembler = PersonaAssembler(num_personas, other_facts_per_persona, anchor_categories,
+                                 min_other_facts=dialogue.Config.NUM_INJECTIONS)
+    log = GenerationLog(Config.PIPELINE_LOG)
+    restored_ready = []
+    for entry in log.replay():
+        if entry.get("type") != "persona":
+            continue
+        has_file = personas.persona_exists(entry["persona_id"])
+        assembler.restore(entry, needs_records=not has_file)
+        if has_file:
+            restored_ready.append(entry["persona_id"])
+    if assembler.next_persona_id > 1:
+        print(f"↻ 割り当てログから{assembler.next_persona_id - 1}人分のペルソナを復元しました（うち作成済み {len(restored_ready)}人）。")
+
+    events = queue.Queue()
+    # フェーズAは、キューに溜まった未処理のQAペアが上限に達したら、フェーズBが追いつくまで待つ
+    qa_slots = threading.BoundedSemaphore(Config.QUEUE_SIZE)
+
+    def on_record(slot_index, record):
+        qa_slots.acquire()
+        events.put(("qa", (slot_index, record)))
+
+    def stage_a():
+        error = None
+        try:
+            qa.run_batch_generation(total_items, batch_size, Config.QA_CONCURRENCY, client=client, on_record=on_record)
+        except Exception as e:
+            error = e
+        events.put(("qa_done", error))
+
+    extraction_stats = Counter()
+    stats_lock = threading.Lock()
+
+    def stage_b(persona):
+        stats = personas.fill_persona_profile(client, persona)
+        personas.save_persona(persona)
+        with stats_lock:
+            extraction_stats.update(stats)
+
+    pending = Counter()
+    requeues = Counter()
+    completed, failed, paused = [], [], []
+
+    with ThreadPoolExecutor(max_workers=Config.PERSONA_CONCURRENCY) as persona_executor, \
+            ThreadPoolExecutor(max_workers=Config.DIALOGUE_CONCURRENCY) as dialogue_executor, \
+            tqdm(total=num_personas * dialogue.Config.NUM_TURNS, desc="対話生成中（フェーズC）") as progress:
+
+        def submit_persona(assignment, is_new):
+            if is_new:
+                log.append({"type": "persona", **assignment})
+            pending["B"] += 1
+            future = persona_executor.submit(stage_b, assembler.build(assignment))
+            future.add_done_callback(lambda f, persona_id=assignment["persona_id"]: events.put(("persona", (persona_id, f.exception()))))
+
+        def submit_dialogue(persona_id):
+            if dialogue.dialogue_exists(persona_id):
+                completed.append(persona_id)
+                progress.update(dialogue.Config.NUM_TURNS)
+                return
+            pending["C"] += 1
+            future = dialogue_executor.submit(dialogue.generate_dialogue_for_persona, persona_id, client, progress)
+            future.add_done_callback(lambda f, persona_id=persona_id: events.put(("dialogue", (persona_id, f))))
+
+        for persona_id in restored_ready:
+            submit_dialogue(persona_id)
+
+        threading.Thread(target=stage_a, daemon=True).start()
+        qa_running = True
+        while qa_running or pending["B"] or pending["C"]:
+            kind, payload = events.get()
+            if kind == "qa":
+                qa_slots.release()
+                new, restored = assembler.add(*payload)
+                for assignment in restored:
+                    submit_persona(assignment, is_new=False)
+                for assignment in new:
+                    submit_persona(assignment, is_new=True)
+            elif kind == "qa_done":
+                qa_running = False
+                if payload is not None:
+                    print(f"\n❌ QAペアの生成中にエラーが発生しました: {payload}")
+                if client.budget.exhausted:
+                    # QAペアが揃っていないため、残りの事実を少ない件数のまま割り当てることはしない
+                    print("\n⏸ 予算の上限に達したため、残りのペルソナへの割り当ては次回の実行で行います。")
+                    continue
+                for assignment in assembler.flush():
+                    submit_persona(assignment, is_new=True)
+                if assembler.waiting:
+                    print(f"\n⚠️ 生成ログにQAペアが見つからないため、ペルソナ {sorted(assembler.waiting)} を作成できませんでした。")
+            elif kind == "persona":
+                persona_id, error = payload
+                pending["B"] -= 1
+                if error is None:
+                    submit_dialogue(persona_id)
+                elif isinstance(error, BudgetExceeded):
+                    paused.append(persona_id)
+                else:
+                    print(f"\n❌ ペルソナ {persona_id} の作成中にエラーが発生しました: {error}")
+                    failed.append(persona_id)
+            elif kind == "dialogue":
+                persona_id, future = payload
+                pending["C"] -= 1
+                try:
+                    output_filename = future.result()
+                except BudgetExceeded:
+                    paused.append(persona_id)
+                    progress.set_postfix(完了=len(completed), 失敗=len(failed), 停止=len(paused))
+                    continue
+                except dialogue.TurnGenerationError as e:
+                    # run_dialogue_generation と同じく、生成ログから失敗したターンを再開できるよう、キューに入れ直す
+                    progress.update(-(e.turn - 1))
+                    if requeues[persona_id] < dialogue.Config.MAX_TURN_REQUEUES:
+                        requeues[persona_id] += 1
+                        print(f"\n↻ {e}。後で再開します（{requeues[persona_id]}/{dialogue.Config.MAX_TURN_REQUEUES}回目）。")
+                        submit_dialogue(persona_id)
+                        continue
+                    output_filename = None
+                    print(f"\n❌ {e}。再投入の上限に達したため、このペルソナは次回の実行で再開します。")
+                except Exception as e:
+                    output_filename = None
+                    print(f"\n❌ ペルソナ {persona_id} の対話生成中にエラーが発生しました: {e}")
+                if output_filename:
+                    completed.append(persona_id)
+                else:
+                    failed.append(persona_id)
+                    progress.update(dialogue.Config.NUM_TURNS)
+                progress.set_postfix(完了=len(completed), 失敗=len(failed))
+
+    log.close()
+    print(f"\nペルソナ: {assembler.next_persona_id - 1}人 / 対話の完了: {len(completed)}人 / 失敗: {len(failed)}人"
+          + (f" / 予算の上限で停止: {len(paused)}人" if paused else ""))
+    print(f"アンカー情報の抽出: 正規表現 {extraction_stats['regex']}件 / API {extraction_stats['api']}件"
+          f"（API呼び出し {extraction_stats['api_calls']}回） / 失敗 {extraction_stats['failed']}件")
+    print(client.cache.format_stats())
+    print(client.governor.format_stats())
+    print(client.budget.format_stats())
+    print(dialogue.format_judge_stats())
+    print(dialogue.format_usage(dialogue.summarize_usage(dialogue.USAGE_CALLS)))
+    print(TELEMETRY.format_summary())
+    TELEMETRY.close()
+    close_stores()
+    if failed:
+        print(f"  - 失敗したペルソナID: {sorted(failed)}")
+    if client.budget.exhausted:
+        print("⏸ 予算の上限に達したため停止しました。上限（Config.BUDGET_USD / BUDGET_TOKENS）を見直して再実行すると、続きから再開します。")
+    return completed, failed
+
+def estimate_pipeline(total_items=5000, num_personas=100, batch_size=100):
+    """run_pipeline を実行した場合の3つのフェーズ合計のAPI呼び出し数・トークン数・コストを、APIを呼ばずに見積もる（ドライラン）"""
+    dialogue.Config.PERSONA_DIR = personas.Config.OUTPUT_DIR
+    dialogue.Config.PERSONA_STORE_DIR = personas.Config.STORE_DIR
+    personas.Config.NUM_PERSONAS = num_personas
+    estimate = CostEstimate(f"パイプライン全体（QAペア {total_items}件 / ペルソナ {num_personas}人）")
+    estimate.merge(qa.estimate_batch_generation(total_items, batch_size))
+    estimate.merge(personas.estimate_persona_extraction())
+    estimate.merge(dialogue.estimate_dialogue_generation(1, num_personas))
+    return estimate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="フェーズA・B・Cを重ねて実行する、ストリーミング・パイプライン")
+    parser.add_argument('--total_items', type=int, default=5000, help='生成するQAペアの件数')
+    parser.add_argument('--num_personas', type=int, default=100, help='作成するペルソナ数')
+    parser.add_argument('--batch_size', type=int, default=100, help='QAペアのバッチファイル1つあたりの件数')
+    parser.add_argument('--dry_run', action='store_true', help='APIを呼ばずに、3つのフェーズ合計のAPI呼び出し数・トークン数・コストの見積もりを表示する')
+    parser.add_argument('--budget_usd', type=float, default=None, help='3つのフェーズ合計の推定コスト（USD）の上限（省略時は Config.BUDGET_USD）')
+    parser.add_argument('--budget_tokens', type=int, default=None, help='3つのフェーズ合計のトークン数の上限（省略時は Config.BUDGET_TOKENS）')
+    parser.add_argument('--qa_items_per_request', type=int, default=None,
+                        help='フェーズAで1回のリクエストで生成するQAペアの件数（省略時は generate_qa_5000_in_colab.Config.ITEMS_PER_REQUEST）')
+    parser.add_argument('--num_turns', type=int, default=None,
+                        help='フェーズCの1対話あたりのターン数（省略時は generate_dialogue_v7_llm_judge.Config.NUM_TURNS）')
+    parser.add_argument('--long_dialogue', action='store_true', help='フェーズCを長い対話モード（要約と索引でプロンプトの大きさを一定に保つ）で生成する')
+    args = parser.parse_args()
+    if args.qa_items_per_request is not None:
+        qa.Config.ITEMS_PER_REQUEST = args.qa_items_per_request
+    if args.num_turns is not None:
+        dialogue.Config.NUM_TURNS = args.num_turns
+    if args.long_dialogue:
+        dialogue.Config.LONG_DIALOGUE = True
+    if args.budget_usd is not None:
+        Config.BUDGET_USD = args.budget_usd
+    if args.budget_tokens is not None:
+        Config.BUDGET_TOKENS = args.budget_tokens
+
+    if args.dry_run:
+        print(estimate_pipeline(args.total_items, args.num_personas, args.batch_size).format(Config.BUDGET_USD))
+    else:
+        run_pipeline(args.total_items, args.num_personas, args.batch_size)
+        print("\n🎉 パイプラインの実行が完了しました！")
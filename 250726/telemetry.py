@@ -0,0 +1,272 @@
+# telemetry.py
+
+import json
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from client_wrapper import ClientWrapper
+
+# 100万トークンあたりの料金（USD）。コスト見積もり用の目安で、実際の請求額とは異なる場合がある
+MODEL_PRICING = {
+    "gpt-4o": {"input": 2.50, "cached_input": 1.25, "output": 10.00},
+    "gpt-4o-mini": {"input": 0.15, "cached_input": 0.075, "output": 0.60},
+}
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    """トークン数から料金（USD）を見積もる。料金表にないモデルは 0 とする"""
+    pricing = MODEL_PRICING.get(model)
+    if pricing is None:
+        return 0.0
+    return (
+        (prompt_tokens - cached_tokens) * pricing["input"]
+        + cached_tokens * pricing["cached_input"]
+        + completion_tokens * pricing["output"]
+    ) / 1_000_000
+
+
+def percentile(values, q):
+    """最近傍順位法によるパーセンタイル"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, min(len(ordered), int(round(q / 100 * len(ordered) + 0.5))))
+    return ordered[rank - 1]
+
+
+class Telemetry:
+    """
+    chat.completions の呼び出しごとの所要時間・トークン数・エラーと、リトライや判定による却下などの
+    イベントを記録する計測レイヤー。
+    記録には、フェーズ（A/B/C）・カテゴリ・ペルソナ・ターンなどのタグ（tags で設定）が付く。
+    start() でトレースファイルを指定すると、1件ごとにJSONLで追記する。
+    メモリにはフェーズごとの集計と、最大 max_latency_samples 件のレイテンシの標本（リザーバーサンプリング）だけを保持する。
+    """
+
+    def __init__(self, max_latency_samples=10000):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._trace_file = None
+        self._users = 0
+        self.max_latency_samples = max_latency_samples
+        self._phases = {}
+        self._rng = random.Random()
+
+    def start(self, trace_path=None):
+        """
+        トレースファイルへの記録を開始する。start と close は対で呼び出し、
+        パイプライン全体で共有している場合は、最後の close でファイルを閉じる。
+        """
+        with self._lock:
+            self._users += 1
+            if trace_path and self._trace_file is None:
+                self._trace_file = open(trace_path, 'a', encoding='utf-8')
+
+    def close(self):
+        with self._lock:
+            self._users = max(0, self._users - 1)
+            if self._users == 0 and self._trace_file is not None:
+                self._trace_file.close()
+                self._trace_file = None
+
+    def current_tags(self):
+        return dict(getattr(self._local, "tags", {}))
+
+    @contextmanager
+    def tags(self, **tags):
+        """このスレッドで、ブロック内の記録にタグを付ける（入れ子にすると外側のタグと合成される）"""
+        previous = getattr(self._local, "tags", {})
+        self._local.tags = {**previous, **tags}
+        try:
+            yield
+        finally:
+            self._local.tags = previous
+
+    def _phase(self, name):
+        if name not in self._phases:
+            self._phases[name] = {"counts": Counter(), "cost_usd": 0.0, "latencies": [], "latency_count": 0}
+        return self._phases[name]
+
+    def _sample_latency(self, phase, latency):
+        """レイテンシをリザーバーサンプリングで標本に加える（標本の大きさは max_latency_samples 件まで）"""
+        phase["latency_count"] += 1
+        if len(phase["latencies"]) < self.max_latency_samples:
+            phase["latencies"].append(latency)
+        else:
+            index = self._rng.randrange(phase["latency_count"])
+            if index < self.max_latency_samples:
+                phase["latencies"][index] = latency
+
+    def _aggregate(self, record):
+        phase = self._phase(record.get("phase", "-"))
+        counts = phase["counts"]
+        if record["type"] != "call":
+            counts[record["event"]] += 1
+            return
+        if record["cache_hit"]:
+            counts["cache_hits"] += 1
+            return
+        counts["calls"] += 1
+        self._sample_latency(phase, record["latency_s"])
+        if record["error"]:
+            counts["errors"] += 1
+        for key in ("prompt_tokens", "completion_tokens", "cached_tokens", "attempts"):
+            counts[key] += record[key]
+        counts["wait_ms"] += int(record["wait_s"] * 1000)
+        phase["cost_usd"] += estimate_cost(
+            record["model"], record["prompt_tokens"], record["completion_tokens"], record["cached_tokens"])
+
+    def _write(self, record):
+        record = {"ts": round(time.time(), 3), **self.current_tags(), **record}
+        with self._lock:
+            self._aggregate(record)
+            if self._trace_file is not None:
+                self._trace_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                self._trace_file.flush()
+
+    def begin_call(self):
+        """このスレッドで、1回の呼び出し（再試行を含む）のバックエンドへの各試行の所要時間の記録を始める"""
+        self._local.attempts = []
+
+    def record_attempt(self, latency):
+        """バックエンドへの1回の試行の所要時間を記録する（BackendTimer から呼ばれる）"""
+        attempts = getattr(self._local, "attempts", None)
+        if attempts is not None:
+            attempts.append(latency)
+
+    def end_call(self):
+        attempts = getattr(self._local, "attempts", None) or []
+        self._local.attempts = None
+        return attempts
+
+    def record_call(self, model, latency, response=None, error=None, wait=0.0, attempts=1):
+        """
+        latency はバックエンドの最後の試行の所要時間、wait はレート制限・同時実行数の枠・再試行のバックオフの待ち時間と、
+        失敗した試行の所要時間の合計
+        """
+        usage = getattr(response, "usage", None)
+        details = getattr(usage, "prompt_tokens_details", None)
+        self._write({
+            "type": "call",
+            "model": model,
+            "latency_s": round(latency, 4),
+            "wait_s": round(wait, 4),
+            "attempts": attempts,
+            "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+            "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+            "cached_tokens": getattr(details, "cached_tokens", 0) or 0,
+            "cache_hit": bool(getattr(response, "cache_hit", False)),
+            "error": None if error is None else f"{type(error).__name__}: {error}",
+        })
+
+    def event(self, name, **fields):
+        """リトライ・判定による却下・項目の失敗などのイベントを記録する"""
+        self._write({"type": "event", "event": name, **fields})
+
+    def record_error(self, error):
+        """スクリプト側で捕捉した例外を記録する（API呼び出しで既に記録済みの例外は二重に数えない）"""
+        if not getattr(error, "_telemetry_recorded", False):
+            self.event("error", error=f"{type(error).__name__}: {error}")
+
+    def summary(self):
+        """
+        フェーズごとの集計（呼び出し数・エラー・リトライ・却下・レイテンシのp50/p95・待ち時間・トークン数・コスト見積もり）。
+        レイテンシはバックエンドへの最後の試行の所要時間で、レート制限や再試行の待ち時間は wait_s に別に集計する
+        """
+        with self._lock:
+            phases = {name: {"counts": Counter(phase["counts"]), "cost_usd": phase["cost_usd"],
+                             "latencies": list(phase["latencies"])}
+                      for name, phase in self._phases.items()}
+        result = {}
+        for name, phase in sorted(phases.items()):
+            counts = phase["counts"]
+            wait_ms = counts.pop("wait_ms", 0)
+            result[name] = {
+                **counts,
+                "latency_p50_s": round(percentile(phase["latencies"], 50), 3),
+                "latency_p95_s": round(percentile(phase["latencies"], 95), 3),
+                "wait_s": round(wait_ms / 1000, 3),
+                "cost_usd": round(phase["cost_usd"], 4),
+            }
+        return result
+
+    def format_summary(self):
+        lines = ["--- テレメトリ集計 ---"]
+        for phase, stats in self.summary().items():
+            lines.append(
+                f"フェーズ{phase}: API呼び出し {stats.get('calls', 0)}回（応答キャッシュ {stats.get('cache_hits', 0)}回） / "
+                f"エラー {stats.get('errors', 0) + stats.get('error', 0)}件 / リトライ {stats.get('retry', 0)}回"
+                f"（API再試行 {stats.get('api_retry', 0)}回・サーキットブレーカー作動 {stats.get('circuit_open', 0)}回） / "
+                f"判定による却下 {stats.get('judge_rejection', 0)}件 / "
+                f"レイテンシ p50 {stats['latency_p50_s']}s・p95 {stats['latency_p95_s']}s"
+                f"（レート制限・再試行の待ち時間 合計 {stats['wait_s']}s） / "
+                f"トークン 入力 {stats.get('prompt_tokens', 0)}（うちキャッシュ {stats.get('cached_tokens', 0)}）・"
+                f"出力 {stats.get('completion_tokens', 0)} / 推定コスト ${stats['cost_usd']:.4f}"
+            )
+        return "\n".join(lines)
+
+
+# 3つのスクリプトで共有する計測インスタンス
+TELEMETRY = Telemetry()
+
+
+class TelemetryClient(ClientWrapper):
+    """
+    呼び出しごとの所要時間・トークン数・エラーを TELEMETRY に記録するラッパー。
+    レート制限・再試行の内側にある BackendTimer が各試行の所要時間を測るため、レイテンシには
+    トークンバケットや同時実行数の枠の待ち時間・バックオフを含めず、それらは待ち時間として別に記録する。
+    """
+
+    def __init__(self, client, telemetry=None):
+        super().__init__(client)
+        self.telemetry = telemetry or TELEMETRY
+
+    def create(self, **params):
+        self.telemetry.begin_call()
+        started = time.perf_counter()
+        try:
+            response = self.client.chat.completions.create(**params)
+        except Exception as e:
+            self._record(params, started, error=e)
+            e._telemetry_recorded = True
+            raise
+        self._record(params, started, response)
+        return response
+
+    def _record(self, params, started, response=None, error=None):
+        elapsed = time.perf_counter() - started
+        attempts = self.telemetry.end_call()
+        if not attempts:
+            # 応答キャッシュのヒットなど、バックエンドを呼ばなかった場合
+            self.telemetry.record_call(params.get("model"), elapsed, response, error, attempts=0)
+            return
+        self.telemetry.record_call(params.get("model"), attempts[-1], response, error,
+                                   wait=max(0.0, elapsed - attempts[-1]), attempts=len(attempts))
+
+    def lookup_cached(self, **params):
+        """内側の応答キャッシュだけを引き（CachedClient.lookup_cached）、ヒットした場合は呼び出しとして記録する"""
+        lookup_cached = getattr(self.client, "lookup_cached", None)
+        response = lookup_cached(**params) if lookup_cached is not None else None
+        if response is not None:
+            self.telemetry.record_call(params.get("model"), 0.0, response, attempts=0)
+        return response
+
+
+class BackendTimer(ClientWrapper):
+    """
+    バックエンドへの1回の試行の所要時間だけを測るラッパー。RateLimitedClient（再試行・待機）の内側に置き、
+    測った時間を外側の TelemetryClient が呼び出しのレイテンシとして記録する。
+    """
+
+    def __init__(self, client, telemetry=None):
+        super().__init__(client)
+        self.telemetry = telemetry or TELEMETRY
+
+    def create(self, **params):
+        started = time.perf_counter()
+        try:
+            return self.client.chat.completions.create(**params)
+        finally:
+            self.telemetry.record_attempt(time.perf_counter() - started)
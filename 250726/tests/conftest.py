@@ -0,0 +1,7 @@
+# tests/conftest.py
+
+import os
+import sys
+
+# スクリプトはパッケージではなく 250726/ 直下に並んでいるため、そのディレクトリから import できるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,98 @@
+# tests/test_budget.py
+
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import budget
+from budget import BudgetExceeded, BudgetedClient, CostBudget
+
+MESSAGES = [{"role": "user", "content": "こんにちは" * 20}]
+
+
+class FakeClient:
+    """応答を返すクライアント。cached に入っている params の応答は、応答キャッシュのヒットとして返す"""
+
+    def __init__(self, cached=()):
+        self.cached = list(cached)
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def _response(self, cache_hit=False):
+        usage = SimpleNamespace(prompt_tokens=100, completion_tokens=50, prompt_tokens_details=None)
+        return SimpleNamespace(usage=usage, cache_hit=cache_hit)
+
+    def create(self, **params):
+        if params in self.cached:
+            return self._response(cache_hit=True)
+        self.calls += 1
+        return self._response()
+
+    def lookup_cached(self, **params):
+        return self._response(cache_hit=True) if params in self.cached else None
+
+
+def request(content="質問"):
+    return {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": content}], "max_tokens": 100}
+
+
+def test_usage_is_settled_and_the_limit_stops_calls():
+    client = BudgetedClient(FakeClient(), CostBudget(max_tokens=400))
+    client.chat.completions.create(**request())
+    client.chat.completions.create(**request())
+    assert client.budget.spent_tokens == 300
+    # 予約（入力の見積もり＋max_tokens）を加えると上限を超える
+    with pytest.raises(BudgetExceeded):
+        client.chat.completions.create(**request())
+    assert client.budget.exhausted
+    assert client.budget.stats["refused"] == 1
+
+
+def test_cache_hits_pass_after_the_limit():
+    cached = request("キャッシュ済み")
+    client = BudgetedClient(FakeClient(cached=[cached]), CostBudget(max_tokens=1))
+    with pytest.raises(BudgetExceeded):
+        client.chat.completions.create(**request())
+    assert client.chat.completions.create(**cached).cache_hit
+    assert client.budget.stats["cache_hits_after_limit"] == 1
+    assert client.budget.spent_tokens == 0
+
+
+def test_no_limit_skips_token_counting(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("上限が無い場合はトークン数を数えない")
+
+    monkeypatch.setattr(budget, "count_message_tokens", fail)
+    client = BudgetedClient(FakeClient(), CostBudget())
+    client.chat.completions.create(**request())
+    assert client.budget.spent_tokens == 150
+
+
+def test_usd_limit_requires_pricing():
+    CostBudget(max_tokens=100).require_pricing(["local-model"])
+    with pytest.raises(ValueError):
+        CostBudget(max_cost_usd=1.0).require_pricing(["gpt-4o-mini", "local-model"])
+
+
+def test_encoding_is_loaded_once_across_threads(monkeypatch, capsys):
+    loads = []
+
+    class BrokenTiktoken:
+        @staticmethod
+        def encoding_for_model(model):
+            loads.append(model)
+            raise OSError("offline")
+
+    monkeypatch.setattr(budget, "tiktoken", BrokenTiktoken)
+    monkeypatch.setattr(budget, "_encodings", {})
+    threads = [threading.Thread(target=budget.count_message_tokens, args=(MESSAGES, "gpt-4o-mini")) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert loads == ["gpt-4o-mini"]
+    assert capsys.readouterr().out.count("⚠️") == 1
+    # 読み込めない場合は1文字1トークンの目安で数える
+    assert budget.count_text_tokens("こんにちは", "gpt-4o-mini") == 5
@@ -0,0 +1,115 @@
+# tests/test_dataset_store.py
+
+import os
+
+import pytest
+
+from dataset_store import ShardedStore, rebuild_store
+
+
+def qa(n, question=None):
+    return {"id": n, "question": question or f"質問{n}", "answer": f"回答{n}"}
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_put_and_get(tmp_path, compression):
+    path = str(tmp_path / "qa")
+    with ShardedStore(path, compression=compression, shard_records=3, block_records=2) as store:
+        for n in range(1, 8):
+            store.put(qa(n))
+        # 書き込み待ちのブロックにあるレコードも読み出せる
+        assert store.get(7) == qa(7)
+        assert len(store) == 7
+
+    store = ShardedStore(path, readonly=True)
+    assert store.compression == compression
+    assert [store.get(n) for n in range(1, 8)] == [qa(n) for n in range(1, 8)]
+    assert store.get(99) is None
+    assert 3 in store and 99 not in store
+    assert [record["id"] for record in store] == list(range(1, 8))
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_rewritten_key_returns_latest_record(tmp_path, compression):
+    path = str(tmp_path / "qa")
+    with ShardedStore(path, compression=compression, block_records=1) as store:
+        store.put(qa(1))
+        store.put(qa(2))
+        store.put(qa(1, "書き直した質問"))
+
+    store = ShardedStore(path, readonly=True)
+    assert store.get(1)["question"] == "書き直した質問"
+    assert len(store) == 2
+    # 古いレコードは反復の対象から外れる
+    assert [record["question"] for record in store] == ["質問2", "書き直した質問"]
+
+
+def test_iter_records_splits_shards_between_workers(tmp_path):
+    path = str(tmp_path / "qa")
+    with ShardedStore(path, shard_records=2) as store:
+        for n in range(1, 8):
+            store.put(qa(n))
+
+    store = ShardedStore(path, readonly=True)
+    parts = [[record["id"] for record in store.iter_records(num_workers=2, worker_index=i)] for i in range(2)]
+    assert parts == [[1, 2, 5, 6], [3, 4, 7]]
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_unflushed_records_are_recovered(tmp_path, compression):
+    path = str(tmp_path / "qa")
+    with ShardedStore(path, compression=compression, shard_records=3, block_records=1) as store:
+        store.put(qa(1))
+    # 索引を保存する前に中断した（シャードには書き込み済み、2つ目のシャードは索引に載っていない）
+    store = ShardedStore(path, compression=compression, shard_records=3, block_records=1)
+    for n in range(2, 6):
+        store.put(qa(n))
+    store._file.close()
+
+    store = ShardedStore(path)
+    assert store.recovered == 4
+    assert [store.get(n) for n in range(1, 6)] == [qa(n) for n in range(1, 6)]
+    assert [record["id"] for record in store] == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_partial_tail_is_truncated(tmp_path, compression):
+    path = str(tmp_path / "qa")
+    with ShardedStore(path, compression=compression, block_records=1) as store:
+        store.put(qa(1))
+        store.put(qa(2))
+    shard = os.path.join(path, store._shards[0]["name"])
+    size = os.path.getsize(shard)
+    with open(shard, 'ab') as f:
+        f.write(b'{"id": 3, "question": "\xe6\x9b\xb8' if not compression else b"\x1f\x8b\x08\x00")
+
+    store = ShardedStore(path)
+    assert store.recovered == 0
+    assert os.path.getsize(shard) == size
+    # 切り詰めた後ろに、続けて書き込める
+    store.put(qa(3))
+    store.close()
+    assert [record["id"] for record in ShardedStore(path, readonly=True)] == [1, 2, 3]
+
+
+def test_readonly_store(tmp_path):
+    path = str(tmp_path / "qa")
+    with pytest.raises(FileNotFoundError):
+        ShardedStore(path, readonly=True)
+    with ShardedStore(path) as store:
+        store.put(qa(1))
+
+    store = ShardedStore(path, readonly=True)
+    with pytest.raises(PermissionError):
+        store.put(qa(2))
+
+
+def test_rebuild_store_replaces_existing_dataset(tmp_path):
+    path = str(tmp_path / "qa")
+    with ShardedStore(path) as store:
+        store.put(qa(1))
+
+    store = rebuild_store(path, (qa(n) for n in range(10, 13)), compression="gzip")
+    assert store.keys() == [10, 11, 12]
+    assert store.compression == "gzip"
+    assert not os.path.exists(path + ".tmp")
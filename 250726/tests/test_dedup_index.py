@@ -0,0 +1,72 @@
+# tests/test_dedup_index.py
+
+from dedup_index import NearDuplicateIndex, find_duplicate_clusters, normalize_text
+
+ANSWER = "はい、私は毎朝コーヒーを飲みながら新聞を読むのが日課になっています。"
+OTHER_ANSWER = "週末はたいてい近所の山に登って、頂上でおにぎりを食べています。"
+
+
+def test_normalize_text_ignores_punctuation_and_leading_hai():
+    assert normalize_text("はい、東京 です。") == normalize_text("東京です")
+
+
+def test_near_duplicate_is_rejected_and_counted():
+    index = NearDuplicateIndex()
+    assert index.check_and_add("趣味", 1, ANSWER) is None
+    # 句読点が違うだけの回答は、先に登録したキーの重複として却下される
+    assert index.check_and_add("趣味", 2, ANSWER.replace("、", "")) == "1"
+    assert index.rejected["趣味"] == 1
+    assert ("趣味", 2) not in index
+    assert len(index) == 1
+
+
+def test_different_answers_and_categories_are_kept():
+    index = NearDuplicateIndex()
+    assert index.check_and_add("趣味", 1, ANSWER) is None
+    assert index.check_and_add("趣味", 2, OTHER_ANSWER) is None
+    # カテゴリが違えば、同じ回答でも重複とはみなさない
+    assert index.check_and_add("日課", 3, ANSWER) is None
+    assert len(index) == 3
+
+
+def test_rechecking_the_same_key_is_not_a_self_duplicate():
+    # 中断前に登録されたまま生成ログに残らなかったスロットを、再開後に再生成した場合
+    index = NearDuplicateIndex()
+    assert index.check_and_add("趣味", 5, ANSWER) is None
+    assert index.check_and_add("趣味", 5, ANSWER) is None
+    assert index.rejected["趣味"] == 0
+
+
+def test_rechecking_the_same_key_replaces_its_signature():
+    index = NearDuplicateIndex()
+    index.check_and_add("趣味", 5, ANSWER)
+    index.check_and_add("趣味", 5, OTHER_ANSWER)
+    # 古い回答の署名は残らないため、別のスロットが古い回答と同じ内容でも却下されない
+    assert index.check_and_add("趣味", 6, ANSWER) is None
+    assert index.check_and_add("趣味", 7, OTHER_ANSWER) == "5"
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / "dedup_index.json")
+    index = NearDuplicateIndex(threshold=0.6)
+    index.check_and_add("趣味", 1, ANSWER)
+    index.check_and_add("趣味", 2, ANSWER)
+    index.save(path)
+
+    loaded = NearDuplicateIndex.load(path)
+    assert loaded.threshold == 0.6
+    assert ("趣味", 1) in loaded
+    assert loaded.rejected["趣味"] == 1
+    assert loaded.check_and_add("趣味", 3, ANSWER) == "1"
+    # 読み込み時に閾値を上書きできる
+    assert NearDuplicateIndex.load(path, threshold=0.9).threshold == 0.9
+
+
+def test_find_duplicate_clusters():
+    records = [
+        {"id": 1, "category": "趣味", "answer": ANSWER},
+        {"id": 2, "category": "趣味", "answer": OTHER_ANSWER},
+        {"id": 3, "category": "趣味", "answer": ANSWER + "！"},
+        {"id": 4, "category": "日課", "answer": ANSWER},
+    ]
+    assert find_duplicate_clusters(records) == [{"category": "趣味", "ids": [1, 3]}]
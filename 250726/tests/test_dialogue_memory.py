@@ -0,0 +1,70 @@
+# tests/test_dialogue_memory.py
+
+import random
+
+from dialogue_memory import DialogueMemory, bigrams
+
+
+def memory_with_topics():
+    """話題0: 料理・旅行、話題1: 音楽（アシスタントの new_topic で区切る）"""
+    memory = DialogueMemory()
+    memory.record_turn(1, "user", "週末はカレーを作るのが好きです")
+    memory.record_turn(2, "assistant", "いいですね")
+    memory.record_turn(3, "user", "去年の夏に北海道へ旅行しました", injection={"category": "旅行"})
+    memory.record_turn(4, "assistant", "ところで音楽は聴きますか", strategy="new_topic")
+    memory.record_turn(5, "user", "ジャズをよく聴きます")
+    return memory
+
+
+def test_bigrams():
+    assert bigrams("北海道") == {"北海", "海道"}
+    # 長音符・句読点は正規化で取り除く
+    assert bigrams("カレー。") == {"カレ"}
+    assert bigrams("あ") == {"あ"}
+    assert bigrams("") == set()
+
+
+def test_only_user_utterances_are_indexed_by_topic():
+    memory = memory_with_topics()
+    assert [(u["turn"], u["topic"]) for u in memory.utterances] == [(1, 0), (3, 0), (5, 1)]
+    assert memory.topic == 1
+    assert [fact["turn"] for fact in memory.facts] == [3]
+
+
+def test_recall_returns_most_relevant_utterance_from_other_topics():
+    memory = memory_with_topics()
+    recall = memory.recall("北海道の旅行はどうでしたか", random.Random(0), before_turn=10, top_k=1)
+    assert recall["turn"] == 3
+    assert recall["score"] > 0
+
+
+def test_recall_excludes_current_topic_and_recent_turns():
+    memory = memory_with_topics()
+    # 現在の話題（ジャズ）の発言は、関連度が高くても選ばない
+    assert memory.recall("ジャズ", random.Random(0), before_turn=10, top_k=3)["turn"] != 5
+    # プロンプトの会話履歴に含まれるターン（before_turn 以降）は選ばない
+    assert memory.recall("北海道の旅行", random.Random(0), before_turn=3, top_k=3)["turn"] == 1
+    assert memory.recall("北海道の旅行", random.Random(0), before_turn=1) is None
+
+
+def test_recall_falls_back_to_random_choice_without_matches():
+    memory = memory_with_topics()
+    recall = memory.recall("まったく関係のない話", random.Random(0), before_turn=10)
+    assert recall["turn"] in (1, 3)
+    assert "score" not in recall
+
+
+def test_relevant_facts_prefers_relevant_then_recent():
+    memory = DialogueMemory()
+    memory.record_turn(1, "user", "出身は北海道の札幌", injection={"category": "出身地"})
+    memory.record_turn(3, "user", "仕事はエンジニア", injection={"category": "職業"})
+    memory.record_turn(5, "user", "猫を二匹飼っている", injection={"category": "ペット"})
+
+    assert [fact["category"] for fact in memory.relevant_facts("札幌の冬は寒いですか", 2)] == ["出身地", "ペット"]
+    assert [fact["turn"] for fact in memory.relevant_facts("", 3)] == [5, 3, 1]
+
+
+def test_update_summary():
+    memory = DialogueMemory()
+    memory.update_summary("要約", 20)
+    assert (memory.summary, memory.summarized_until) == ("要約", 20)
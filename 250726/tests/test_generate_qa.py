@@ -0,0 +1,179 @@
+# tests/test_generate_qa.py
+
+import glob
+import json
+import re
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+import generate_qa_5000_in_colab as qa
+
+
+class FakeClient:
+    """QAペアのJSONを返すクライアント。fail_categories のカテゴリは不正な出力を返す"""
+
+    def __init__(self, fail_categories=()):
+        self.fail_categories = set(fail_categories)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        stats = SimpleNamespace(format_stats=lambda: "")
+        self.cache = self.governor = self.budget = stats
+
+    def create(self, **params):
+        category = re.search(r"「(.+?)」に関する", params["messages"][-1]["content"]).group(1)
+        content = "壊れた出力" if category in self.fail_categories else json.dumps(
+            {"category": category, "question": "何でしたか？", "answer": f"はい、{uuid.uuid4().hex}です。"}, ensure_ascii=False)
+        message = SimpleNamespace(content=content)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(qa.Config, "BATCH_OUTPUT_DIR", "batches")
+    monkeypatch.setattr(qa.Config, "MAX_CONCURRENCY", 4)
+    monkeypatch.setattr(qa.Config, "ITEMS_PER_REQUEST", 1)
+    return tmp_path
+
+
+def batch_records():
+    return [record for path in sorted(glob.glob("batches/batch_*.json")) for record in json.load(open(path, encoding='utf-8'))]
+
+
+def test_failed_slots_are_retried_on_the_next_run(workdir):
+    plan = qa.get_full_generation_plan(40)
+    failing = {category for tier, category in plan if tier == "2"}
+    qa.run_batch_generation(total_items=40, batch_size=20, client=FakeClient(fail_categories=failing))
+    missing = sum(1 for _, category in plan if category in failing)
+    assert len(batch_records()) == 40 - missing
+
+    # 再実行すると、失敗したスロットだけを再生成し、欠けていたバッチファイルを書き出し直す
+    qa.run_batch_generation(total_items=40, batch_size=20, client=FakeClient())
+    records = batch_records()
+    assert [record["custom_id"] for record in records] == [qa.slot_custom_id(i) for i in range(40)]
+    assert [record["category"] for record in records] == [category for _, category in plan]
+
+
+def test_finished_slots_are_not_regenerated(workdir):
+    qa.run_batch_generation(total_items=20, batch_size=10, client=FakeClient())
+    first = batch_records()
+    qa.run_batch_generation(total_items=20, batch_size=10, client=FakeClient(fail_categories={c for _, c in qa.get_full_generation_plan(20)}))
+    assert batch_records() == first
+
+
+def batch_result(request, ok=True):
+    """Batch API の結果ファイルの1行（ok=False なら失敗した結果）"""
+    category = re.search(r"「(.+?)」に関する", request["body"]["messages"][-1]["content"]).group(1)
+    content = json.dumps({"category": category, "question": "何でしたか？", "answer": f"はい、{uuid.uuid4().hex}です。"},
+                         ensure_ascii=False)
+    if not ok:
+        return {"custom_id": request["custom_id"], "response": {"status_code": 500}, "error": None}
+    body = {"choices": [{"message": {"content": content}}]}
+    return {"custom_id": request["custom_id"], "response": {"status_code": 200, "body": body}, "error": None}
+
+
+def write_results(requests_file, results_file, failing=()):
+    with open(requests_file, 'r', encoding='utf-8') as src, open(results_file, 'w', encoding='utf-8') as dst:
+        for line in src:
+            request = json.loads(line)
+            dst.write(json.dumps(batch_result(request, request["custom_id"] not in failing), ensure_ascii=False) + "\n")
+
+
+def test_export_and_ingest_round_trip(workdir):
+    assert qa.export_batch_requests("requests.jsonl", total_items=40) == 40
+    failing = {qa.slot_custom_id(3), qa.slot_custom_id(17)}
+    write_results("requests.jsonl", "results.jsonl", failing)
+
+    records, errors = qa.ingest_batch_results(["results.jsonl"], total_items=40, batch_size=10)
+    assert len(records) == 38 and set(errors) == {3, 17}
+    with open(qa.failed_ids_path(), 'r', encoding='utf-8') as f:
+        assert set(f.read().split()) == failing
+    # バッチファイルの各レコードに、計画上のスロットに対応する custom_id が残る
+    assert [record["custom_id"] for record in batch_records()] == [
+        qa.slot_custom_id(i) for i in range(40) if qa.slot_custom_id(i) not in failing]
+
+    # 失敗分だけを書き出して再投入した結果を取り込むと、前回の結果を引き継いで埋まる
+    with open(qa.failed_ids_path(), 'r', encoding='utf-8') as f:
+        assert qa.export_batch_requests("retry.jsonl", total_items=40, custom_ids=f.read().split()) == 2
+    write_results("retry.jsonl", "retry_results.jsonl")
+    records, errors = qa.ingest_batch_results(["retry_results.jsonl"], total_items=40, batch_size=10,
+                                              final_output_file="final.json")
+    assert len(records) == 40 and not errors
+    with open("final.json", 'r', encoding='utf-8') as f:
+        final = json.load(f)
+    assert [item["id"] for item in final] == list(range(1, 41))
+    assert [item["custom_id"] for item in final] == [qa.slot_custom_id(i) for i in range(40)]
+    assert [item["category"] for item in final] == [category for _, category in qa.get_full_generation_plan(40)]
+
+
+def test_malformed_result_lines_are_skipped(workdir):
+    with open("results.jsonl", 'w', encoding='utf-8') as f:
+        f.write("not json\n")
+        f.write(json.dumps({"custom_id": "qa-999999", "response": {"status_code": 200}}) + "\n")
+    records, errors = qa.ingest_batch_results(["results.jsonl"], total_items=10, batch_size=10)
+    assert not records and not errors
+
+
+class FakeMultiClient:
+    """まとめて生成するリクエストに、responses の関数が作った items を返すクライアント"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requested = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **params):
+        categories = re.findall(r"^\[\d+\] (.+)$", params["messages"][-1]["content"], re.MULTILINE)
+        self.requested.append(categories)
+        items = self.responses.pop(0)(categories)
+        message = SimpleNamespace(content=json.dumps({"items": items}, ensure_ascii=False))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+def qa_items(categories, skip=()):
+    return [{"index": i, "category": category, "question": "何でしたか？", "answer": f"はい、{uuid.uuid4().hex}です。"}
+            for i, category in enumerate(categories, 1) if i not in skip]
+
+
+SLOTS = [(10, "1", "価値観"), (11, "3", "誕生日"), (12, "3", "誕生日")]
+
+
+def test_multi_item_response_is_split_into_slots():
+    client = FakeMultiClient(lambda categories: list(reversed(qa_items(categories))))
+    results = qa.generate_qa_items(client, SLOTS)
+    # 返ってきた順序ではなく、番号でスロットに割り当てる
+    assert {slot: (record["tier"], record["category"]) for slot, record in results.items()} == {
+        10: (1, "価値観"), 11: (3, "誕生日"), 12: (3, "誕生日")}
+    assert client.requested == [["価値観", "誕生日", "誕生日"]]
+
+
+def test_missing_and_invalid_items_are_regenerated_alone():
+    def first(categories):
+        items = qa_items(categories, skip={2})
+        items[0]["category"] = "別のカテゴリ"
+        return items
+
+    client = FakeMultiClient(first, qa_items)
+    results = qa.generate_qa_items(client, SLOTS)
+    assert all(results[slot] for slot in (10, 11, 12))
+    # 2回目は、足りなかったスロットだけを集めて生成する
+    assert client.requested == [["価値観", "誕生日", "誕生日"], ["価値観", "誕生日"]]
+
+
+def test_slots_fail_after_max_retries(monkeypatch):
+    monkeypatch.setattr(qa.Config, "MAX_RETRIES", 2)
+    client = FakeMultiClient(lambda categories: qa_items(categories, skip={3}), lambda categories: [])
+    results = qa.generate_qa_items(client, SLOTS)
+    assert results[10] and results[11]
+    assert results[12] is None
+
+
+def test_budget_stop_keeps_partial_results():
+    def stop(categories):
+        raise qa.BudgetExceeded("上限")
+
+    client = FakeMultiClient(lambda categories: qa_items(categories, skip={1}), stop)
+    with pytest.raises(qa.BudgetExceeded) as excinfo:
+        qa.generate_qa_items(client, SLOTS)
+    assert set(excinfo.value.partial_results) == {11, 12}
@@ -0,0 +1,52 @@
+# tests/test_generation_log.py
+
+import generation_log
+from generation_log import GenerationLog
+
+
+def test_appended_records_are_replayed_in_order(tmp_path):
+    path = str(tmp_path / "logs" / "qa.log.jsonl")
+    log = GenerationLog(path)
+    for i in range(3):
+        log.append({"type": "qa_item", "slot": i})
+    log.close()
+    assert [entry["slot"] for entry in GenerationLog(path).replay()] == [0, 1, 2]
+
+
+def test_missing_log_replays_nothing(tmp_path):
+    assert list(GenerationLog(str(tmp_path / "none.jsonl")).replay()) == []
+
+
+def test_partial_last_line_is_ignored_and_truncated(tmp_path, monkeypatch):
+    # 末尾から遡るブロックを小さくして、複数ブロックにまたがる書きかけの行も扱えることを確かめる
+    monkeypatch.setattr(generation_log, "_TAIL_BLOCK_SIZE", 8)
+    path = str(tmp_path / "qa.log.jsonl")
+    log = GenerationLog(path)
+    log.append({"slot": 0})
+    log.append({"slot": 1})
+    log.close()
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"slot": 2, "record": "書き込み途中で切れた長い行')
+
+    log = GenerationLog(path)
+    assert [entry["slot"] for entry in log.replay()] == [0, 1]
+    log.append({"slot": 2})
+    log.close()
+    assert [entry["slot"] for entry in GenerationLog(path).replay()] == [0, 1, 2]
+
+
+def test_log_without_any_newline_is_emptied(tmp_path):
+    path = str(tmp_path / "qa.log.jsonl")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"slot": 0')
+    log = GenerationLog(path)
+    log.append({"slot": 0})
+    log.close()
+    assert [entry["slot"] for entry in GenerationLog(path).replay()] == [0]
+
+
+def test_corrupt_line_stops_replay(tmp_path):
+    path = str(tmp_path / "qa.log.jsonl")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"slot": 0}\nnot json\n{"slot": 2}\n')
+    assert [entry["slot"] for entry in GenerationLog(path).replay()] == [0]
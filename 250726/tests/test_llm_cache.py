@@ -0,0 +1,88 @@
+# tests/test_llm_cache.py
+
+from types import SimpleNamespace
+
+import pytest
+
+from llm_cache import CachedClient, LLMCache
+
+
+class FakeClient:
+    """呼び出しごとに「応答1」「応答2」…を返すクライアント"""
+
+    def __init__(self):
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **params):
+        self.calls += 1
+        message = SimpleNamespace(content=f"応答{self.calls}")
+        usage = SimpleNamespace(prompt_tokens=10, completion_tokens=5, total_tokens=15, prompt_tokens_details=None)
+        return SimpleNamespace(choices=[SimpleNamespace(index=0, message=message, finish_reason="stop")], usage=usage)
+
+
+def request(temperature):
+    return {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "こんにちは"}], "temperature": temperature}
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / "llm_cache.sqlite3")
+
+
+def content(response):
+    return response.choices[0].message.content
+
+
+def test_deterministic_calls_are_served_from_disk(cache_path):
+    backend = FakeClient()
+    client = CachedClient(backend, LLMCache(cache_path))
+    assert content(client.chat.completions.create(**request(0))) == "応答1"
+
+    # 別のプロセス（新しい LLMCache）からも同じ応答が返り、APIは呼ばれない
+    resumed = CachedClient(backend, LLMCache(cache_path))
+    response = resumed.chat.completions.create(**request(0))
+    assert content(response) == "応答1" and response.cache_hit
+    assert backend.calls == 1
+
+
+def test_high_temperature_calls_are_not_cached_by_default(cache_path):
+    backend = FakeClient()
+    client = CachedClient(backend, LLMCache(cache_path))
+    client.chat.completions.create(**request(1.0))
+    client.chat.completions.create(**request(1.0))
+    assert backend.calls == 2
+    assert client.cache.stats["uncacheable"] == 2
+
+
+def test_high_temperature_calls_replay_in_order(cache_path):
+    backend = FakeClient()
+    client = CachedClient(backend, LLMCache(cache_path, cache_high_temperature=True))
+    assert [content(client.chat.completions.create(**request(1.0))) for _ in range(2)] == ["応答1", "応答2"]
+
+    resumed = CachedClient(backend, LLMCache(cache_path, cache_high_temperature=True))
+    assert [content(resumed.chat.completions.create(**request(1.0))) for _ in range(3)] == ["応答1", "応答2", "応答3"]
+
+
+def test_lookup_does_not_shift_the_occurrence(cache_path):
+    backend = FakeClient()
+    client = CachedClient(backend, LLMCache(cache_path, cache_high_temperature=True))
+    client.chat.completions.create(**request(1.0))
+
+    resumed = CachedClient(backend, LLMCache(cache_path, cache_high_temperature=True))
+    # 参照でヒットした場合は1回目の呼び出しとして進み、ミスした参照は何度行っても進まない
+    assert content(resumed.lookup_cached(**request(1.0))) == "応答1"
+    assert resumed.lookup_cached(**request(1.0)) is None
+    assert resumed.lookup_cached(**request(1.0)) is None
+    # 2回目の呼び出しはキャッシュに無いため、APIから新しい応答を得る
+    assert content(resumed.chat.completions.create(**request(1.0))) == "応答2"
+    assert backend.calls == 2
+
+
+def test_least_recently_used_entries_are_evicted(cache_path):
+    cache = LLMCache(cache_path, max_bytes=1000)
+    for i in range(20):
+        cache.put(f"key{i}", {"content": "x" * 100})
+    assert cache.stats["evictions"] > 0
+    assert cache.get("key0") is None
+    assert cache.get("key19") is not None
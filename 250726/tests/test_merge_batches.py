@@ -0,0 +1,180 @@
+# tests/test_merge_batches.py
+
+import json
+import os
+
+import pytest
+
+import merge_batches
+
+
+class Crash(Exception):
+    """テスト用に、結合の途中で処理が止まったことを表す"""
+
+
+def record(n):
+    return {"tier": 1, "category": "趣味", "question": f"質問{n}", "answer": f"回答{n}"}
+
+
+def write_batch(input_dir, name, numbers):
+    with open(os.path.join(input_dir, name), 'w', encoding='utf-8') as f:
+        json.dump([record(n) for n in numbers], f, ensure_ascii=False)
+
+
+def read_output(output_file):
+    """出力ファイルの (id, question) の一覧"""
+    with open(output_file, 'r', encoding='utf-8') as f:
+        return [(item["id"], item["question"]) for item in map(json.loads, f)]
+
+
+@pytest.fixture
+def paths(tmp_path):
+    input_dir = tmp_path / "batches"
+    input_dir.mkdir()
+    return str(input_dir), str(tmp_path / "QA_pairs_final.jsonl")
+
+
+def test_first_merge_assigns_sequential_ids(paths):
+    input_dir, output_file = paths
+    write_batch(input_dir, "batch_001.json", [1, 2])
+    write_batch(input_dir, "batch_002.json", [3])
+    merge_batches.main(input_dir, output_file)
+
+    assert read_output(output_file) == [(1, "質問1"), (2, "質問2"), (3, "質問3")]
+    with open(merge_batches.manifest_path_for(output_file), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    assert manifest["next_id"] == 4
+    assert manifest["output_bytes"] == os.path.getsize(output_file)
+
+
+def test_invalid_records_are_skipped(paths):
+    input_dir, output_file = paths
+    with open(os.path.join(input_dir, "batch_001.json"), 'w', encoding='utf-8') as f:
+        json.dump([record(1), {"tier": 9, "category": "趣味", "question": "q", "answer": "a"}, record(2)], f, ensure_ascii=False)
+    merge_batches.main(input_dir, output_file)
+
+    assert read_output(output_file) == [(1, "質問1"), (2, "質問2")]
+
+
+def test_new_batches_are_appended_without_renumbering(paths):
+    input_dir, output_file = paths
+    write_batch(input_dir, "batch_001.json", [1, 2])
+    merge_batches.main(input_dir, output_file)
+    write_batch(input_dir, "batch_002.json", [3, 4])
+    merge_batches.main(input_dir, output_file)
+
+    assert read_output(output_file) == [(1, "質問1"), (2, "質問2"), (3, "質問3"), (4, "質問4")]
+
+
+def test_changed_and_removed_batches_are_remerged(paths):
+    input_dir, output_file = paths
+    write_batch(input_dir, "batch_001.json", [1, 2])
+    write_batch(input_dir, "batch_002.json", [3])
+    write_batch(input_dir, "batch_003.json", [4])
+    merge_batches.main(input_dir, output_file)
+
+    write_batch(input_dir, "batch_001.json", [5])
+    os.remove(os.path.join(input_dir, "batch_003.json"))
+    merge_batches.main(input_dir, output_file)
+
+    # 変更のないバッチのIDはそのままで、変更されたバッチは新しいIDで末尾に付け直される
+    assert read_output(output_file) == [(3, "質問3"), (5, "質問5")]
+    assert not os.path.exists(output_file + ".tmp")
+
+
+def test_interrupted_append_does_not_duplicate_ids(paths, monkeypatch):
+    input_dir, output_file = paths
+    write_batch(input_dir, "batch_001.json", [1, 2])
+    merge_batches.main(input_dir, output_file)
+    write_batch(input_dir, "batch_002.json", [3])
+    write_batch(input_dir, "batch_003.json", [4])
+
+    append_batch = merge_batches.append_batch
+
+    def crash_after_writing(filepath, out, manifest, checksum):
+        result = append_batch(filepath, out, manifest, checksum)
+        if filepath.endswith("batch_003.json"):
+            # レコードは書いたが、マニフェストに記録する前に止まった
+            out.flush()
+            raise Crash()
+        return result
+
+    monkeypatch.setattr(merge_batches, "append_batch", crash_after_writing)
+    with pytest.raises(Crash):
+        merge_batches.main(input_dir, output_file)
+    monkeypatch.undo()
+
+    merge_batches.main(input_dir, output_file)
+    assert read_output(output_file) == [(1, "質問1"), (2, "質問2"), (3, "質問3"), (4, "質問4")]
+
+
+def test_partial_trailing_line_is_removed(paths):
+    input_dir, output_file = paths
+    write_batch(input_dir, "batch_001.json", [1])
+    merge_batches.main(input_dir, output_file)
+    with open(output_file, 'a', encoding='utf-8') as f:
+        f.write('{"id": 2, "question": "書きかけ')
+    write_batch(input_dir, "batch_002.json", [2])
+    merge_batches.main(input_dir, output_file)
+
+    assert read_output(output_file) == [(1, "質問1"), (2, "質問2")]
+
+
+def test_output_without_manifest_is_backed_up(paths):
+    input_dir, output_file = paths
+    with open(output_file, 'w', encoding='utf-8') as f:
+        f.write('{"id": 1, "question": "別のツールで作ったデータ"}\n')
+    write_batch(input_dir, "batch_001.json", [1])
+    merge_batches.main(input_dir, output_file)
+
+    assert read_output(output_file) == [(1, "質問1")]
+    # マニフェストの無い既存の出力ファイルは、切り詰めずに別名で残す
+    assert read_output(output_file + ".bak") == [(1, "別のツールで作ったデータ")]
+
+
+def test_interrupted_first_merge_is_not_backed_up(paths, monkeypatch):
+    input_dir, output_file = paths
+    write_batch(input_dir, "batch_001.json", [1, 2])
+
+    def crash_after_writing(filepath, out, manifest, checksum):
+        out.write('{"id": 1, "question": "書きかけ')
+        out.flush()
+        raise Crash()
+
+    monkeypatch.setattr(merge_batches, "append_batch", crash_after_writing)
+    with pytest.raises(Crash):
+        merge_batches.main(input_dir, output_file)
+    monkeypatch.undo()
+
+    merge_batches.main(input_dir, output_file)
+    assert read_output(output_file) == [(1, "質問1"), (2, "質問2")]
+    assert not os.path.exists(output_file + ".bak")
+
+
+@pytest.mark.parametrize("crash_after_replace", [False, True])
+def test_interrupted_rewrite_is_recovered(paths, monkeypatch, crash_after_replace):
+    input_dir, output_file = paths
+    write_batch(input_dir, "batch_001.json", [1, 2])
+    write_batch(input_dir, "batch_002.json", [3])
+    merge_batches.main(input_dir, output_file)
+    write_batch(input_dir, "batch_001.json", [5])
+
+    replace = os.replace
+
+    def crash_on_output_replace(src, dst):
+        if src == output_file + ".tmp":
+            if crash_after_replace:
+                replace(src, dst)
+            raise Crash()
+        replace(src, dst)
+
+    monkeypatch.setattr(merge_batches.os, "replace", crash_on_output_replace)
+    with pytest.raises(Crash):
+        merge_batches.main(input_dir, output_file)
+    monkeypatch.undo()
+
+    # 出力ファイルの置き換えの前後どちらで止まっても、再実行すれば同じ結果になり、IDは重複しない
+    merge_batches.main(input_dir, output_file)
+    assert read_output(output_file) == [(3, "質問3"), (4, "質問5")]
+    assert not os.path.exists(output_file + ".tmp")
+    assert not os.path.exists(merge_batches.manifest_path_for(output_file) + ".pending")
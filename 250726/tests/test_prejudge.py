@@ -0,0 +1,34 @@
+# tests/test_prejudge.py
+
+import pytest
+
+from generate_dialogue_v7_llm_judge import prejudge_utterance
+
+PROFILE = {"name": "佐藤花子", "from": "東京都", "birthday": "3月5日"}
+
+
+@pytest.mark.parametrize("utterance", ["今日は晴れてるね。", "最近はカレーばかり作っています。"])
+def test_utterance_without_profile_mentions_is_consistent(utterance):
+    assert prejudge_utterance(utterance, PROFILE)[0] is True
+
+
+@pytest.mark.parametrize("utterance", ["私は東京出身です。", "私の誕生日は3月5日です。", "私の名前は佐藤花子です。"])
+def test_matching_claims_are_consistent(utterance):
+    assert prejudge_utterance(utterance, PROFILE)[0] is True
+
+
+@pytest.mark.parametrize("utterance", ["私は大阪出身です。", "私の誕生日は12月1日です。", "私の名前は田中です。"])
+def test_contradicting_claims_are_rejected(utterance):
+    assert prejudge_utterance(utterance, PROFILE)[0] is False
+
+
+@pytest.mark.parametrize("utterance", [
+    # 出身地と食い違いうるが、ルールで抜き出せる形ではない言及は LLM の判定に回す
+    "大阪で育ったんだよね。",
+    "大阪に旅行したよ。",
+    "3月5日に映画を見た。",
+    # 本人以外についての言及
+    "母は大阪出身です。",
+])
+def test_unclear_mentions_go_to_the_llm_judge(utterance):
+    assert prejudge_utterance(utterance, PROFILE)[0] is None
@@ -0,0 +1,152 @@
+# tests/test_rate_limiter.py
+
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from rate_limiter import RateLimiter, RateLimitedClient, RequestGovernor, estimate_request_tokens, retry_after_seconds
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **params):
+        self.calls += 1
+        return SimpleNamespace(usage=SimpleNamespace(total_tokens=10))
+
+
+def test_requests_within_the_allowance_do_not_wait():
+    limiter = RateLimiter(requests_per_minute=600)
+    started = time.monotonic()
+    for _ in range(10):
+        limiter.acquire()
+    assert time.monotonic() - started < 0.1
+
+
+def test_requests_beyond_the_allowance_wait_for_refill():
+    # 1分あたり600リクエスト = 0.1秒に1リクエストずつ回復する
+    limiter = RateLimiter(requests_per_minute=600)
+    for _ in range(600):
+        limiter.acquire()
+    started = time.monotonic()
+    limiter.acquire()
+    assert 0.05 < time.monotonic() - started < 0.5
+
+
+def test_token_allowance_is_shared_across_threads():
+    limiter = RateLimiter(requests_per_minute=10000, tokens_per_minute=60000)
+    limiter.acquire(60000)
+    started = time.monotonic()
+    threads = [threading.Thread(target=limiter.acquire, args=(50,)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 1秒あたり1000トークン回復するため、4スレッド合計200トークン分の枠が空くまで約0.2秒待つ
+    assert time.monotonic() - started > 0.15
+
+
+def test_oversized_request_does_not_wait_forever():
+    limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=100)
+    started = time.monotonic()
+    limiter.acquire(10 ** 6)
+    assert time.monotonic() - started < 0.5
+
+
+def test_rate_limited_client_passes_requests_through():
+    backend = FakeClient()
+    client = RateLimitedClient(backend, RateLimiter(600, 100000))
+    params = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "あいう"}], "max_tokens": 10}
+    assert estimate_request_tokens(params) == 13
+    client.chat.completions.create(**params)
+    assert backend.calls == 1
+
+
+class StatusError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers=headers or {})
+
+
+def failing(errors):
+    """errors の例外を順に送出し、尽きたら "ok" を返す関数"""
+    errors = list(errors)
+
+    def fn():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+    return fn
+
+
+def test_retryable_errors_are_retried_with_retry_after():
+    events = []
+    governor = RequestGovernor(4, base_delay=0.01, on_event=lambda name, **fields: events.append((name, fields)))
+    assert retry_after_seconds(StatusError(429, {"retry-after-ms": "20"})) == 0.02
+    assert governor.call(failing([StatusError(429, {"retry-after-ms": "20"}), StatusError(503)])) == "ok"
+    assert governor.stats["retries"] == 2
+    assert governor.stats["rate_limited"] == 1
+    assert [name for name, _ in events] == ["api_retry", "api_retry"]
+
+
+def test_non_retryable_errors_are_raised_immediately():
+    governor = RequestGovernor(4, base_delay=0.01)
+    with pytest.raises(StatusError):
+        governor.call(failing([StatusError(400)]))
+    assert governor.stats["retries"] == 0
+
+
+def test_gives_up_after_max_retries():
+    governor = RequestGovernor(4, max_retries=2, base_delay=0.001)
+    with pytest.raises(StatusError):
+        governor.call(failing([StatusError(500)] * 5))
+    assert governor.stats["gave_up"] == 1
+    assert governor.stats["retries"] == 2
+
+
+def test_overload_halves_concurrency_and_success_restores_it():
+    governor = RequestGovernor(8, base_delay=0.001, window=100)
+    governor.call(failing([StatusError(429)]))
+    assert governor.limit < 8
+    for _ in range(200):
+        governor.call(failing([]))
+    assert governor.limit == 8
+
+
+def test_circuit_opens_when_the_error_rate_is_high():
+    governor = RequestGovernor(4, max_retries=0, window=4, error_rate_threshold=0.5, cooldown=0.2)
+    for _ in range(4):
+        with pytest.raises(StatusError):
+            governor.call(failing([StatusError(500)]))
+    assert governor.stats["circuit_opened"] == 1
+    assert governor.limit == 1
+    started = time.monotonic()
+    assert governor.call(failing([])) == "ok"
+    assert time.monotonic() - started >= 0.1
+
+
+def test_concurrency_never_exceeds_the_limit():
+    governor = RequestGovernor(3)
+    in_flight = []
+    peak = []
+    lock = threading.Lock()
+
+    def work():
+        with lock:
+            in_flight.append(1)
+            peak.append(len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.pop()
+
+    threads = [threading.Thread(target=governor.call, args=(work,)) for _ in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(peak) <= 3
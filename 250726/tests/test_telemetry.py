@@ -0,0 +1,75 @@
+# tests/test_telemetry.py
+
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from rate_limiter import RateLimiter, RateLimitedClient, RequestGovernor
+from telemetry import BackendTimer, Telemetry, TelemetryClient
+
+
+class FakeBackend:
+    """1回目の呼び出しだけ 429 を返し、以降は sleep 秒かけて応答する"""
+
+    def __init__(self, sleep=0.0, fail_first=False):
+        self.sleep = sleep
+        self.fail_first = fail_first
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **params):
+        self.calls += 1
+        if self.fail_first and self.calls == 1:
+            error = Exception("rate limited")
+            error.status_code = 429
+            raise error
+        time.sleep(self.sleep)
+        usage = SimpleNamespace(prompt_tokens=10, completion_tokens=5, total_tokens=15, prompt_tokens_details=None)
+        return SimpleNamespace(usage=usage)
+
+
+def build(telemetry, backend, base_delay):
+    governor = RequestGovernor(4, base_delay=base_delay, max_delay=base_delay)
+    return TelemetryClient(RateLimitedClient(BackendTimer(backend, telemetry), RateLimiter(6000), governor), telemetry)
+
+
+def test_latency_excludes_retry_backoff():
+    telemetry = Telemetry()
+    client = build(telemetry, FakeBackend(sleep=0.01, fail_first=True), base_delay=0.3)
+    with telemetry.tags(phase="A"):
+        client.chat.completions.create(model="gpt-4o-mini", messages=[{"role": "user", "content": "x"}])
+
+    stats = telemetry.summary()["A"]
+    assert stats["calls"] == 1
+    assert stats["attempts"] == 2
+    # バックオフ（0.15〜0.3秒）は待ち時間に入り、レイテンシは最後の試行の時間だけになる
+    assert stats["latency_p95_s"] < 0.1
+    assert stats["wait_s"] >= 0.15
+    assert stats["prompt_tokens"] == 10
+
+
+def test_errors_are_counted():
+    telemetry = Telemetry()
+    backend = FakeBackend()
+    backend.create = lambda **params: (_ for _ in ()).throw(ValueError("bad request"))
+    backend.chat = SimpleNamespace(completions=SimpleNamespace(create=backend.create))
+    client = build(telemetry, backend, base_delay=0.0)
+    with pytest.raises(ValueError), telemetry.tags(phase="B"):
+        client.chat.completions.create(model="gpt-4o-mini", messages=[])
+    assert telemetry.summary()["B"]["errors"] == 1
+
+
+def test_latency_samples_are_bounded():
+    telemetry = Telemetry(max_latency_samples=50)
+    with telemetry.tags(phase="C"):
+        for i in range(1000):
+            telemetry.record_call("gpt-4o-mini", i / 1000)
+        telemetry.event("judge_rejection")
+
+    stats = telemetry.summary()["C"]
+    assert stats["calls"] == 1000
+    assert stats["judge_rejection"] == 1
+    assert len(telemetry._phases["C"]["latencies"]) == 50
+    # 標本は全体から一様に選ばれるため、中央値はおおよそ全体の中央値になる
+    assert 0.2 < stats["latency_p50_s"] < 0.8
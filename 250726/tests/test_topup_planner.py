@@ -0,0 +1,71 @@
+# tests/test_topup_planner.py
+
+import json
+import os
+from collections import Counter
+
+from dedup_index import NearDuplicateIndex
+from topup_planner import ScanCache, assess_dataset, build_topup_plan, compute_deficits, find_sources
+
+ANSWERS = [
+    "はい、私は毎朝コーヒーを飲みながら新聞を読むのが日課になっています。",
+    "週末はたいてい近所の山に登って、頂上でおにぎりを食べています。",
+    "はい、子どもの頃に犬に追いかけられて以来、大きな犬が苦手なんです。",
+]
+
+
+def record(tier, category, answer):
+    return {"tier": tier, "category": category, "question": "何でしたか？", "answer": answer}
+
+
+def write_json(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    return str(path)
+
+
+def test_assess_counts_valid_unique_records(tmp_path):
+    batch = write_json(tmp_path / "batch_001.json", [
+        record(4, "趣味・休日の過ごし方", ANSWERS[0]),
+        record(4, "趣味・休日の過ごし方", ANSWERS[0] + "！"),  # 近似重複
+        record(4, "趣味・休日の過ごし方", ANSWERS[1]),
+        {"tier": 9, "category": "趣味・休日の過ごし方", "question": "q", "answer": "a"},  # スキーマ不正
+        record(2, "恐怖症", ANSWERS[2]),
+    ])
+    counts, stats = assess_dataset([batch], NearDuplicateIndex())
+    assert counts == Counter({(4, "趣味・休日の過ごし方"): 2, (2, "恐怖症"): 1})
+    assert (stats["records"], stats["invalid"], stats["duplicates"]) == (5, 1, 1)
+
+
+def test_scan_cache_skips_unchanged_files(tmp_path):
+    batch = write_json(tmp_path / "batch_001.json", [record(2, "恐怖症", ANSWERS[2])])
+    cache = ScanCache(str(tmp_path / "scan.sqlite3"), {"threshold": 0.7})
+    first, stats = assess_dataset([batch], NearDuplicateIndex(), cache)
+    assert stats["files_scanned"] == 1
+    second, stats = assess_dataset([batch], NearDuplicateIndex(), cache)
+    assert stats["files_cached"] == 1 and second == first
+
+    write_json(batch, [record(2, "恐怖症", ANSWERS[2]), record(4, "趣味・休日の過ごし方", ANSWERS[1])])
+    os.utime(batch, ns=(0, 10 ** 9))
+    third, stats = assess_dataset([batch], NearDuplicateIndex(), cache)
+    assert stats["files_scanned"] == 1 and sum(third.values()) == 2
+    cache.close()
+
+
+def test_deficits_and_plan_follow_the_full_plan_order():
+    quotas = Counter({(1, "価値観"): 2, (3, "誕生日"): 2, (3, "出身地"): 1})
+    counts = Counter({(1, "価値観"): 3, (3, "誕生日"): 1})
+    deficits = compute_deficits(quotas, counts)
+    assert deficits == Counter({(3, "誕生日"): 1, (3, "出身地"): 1})
+
+    full_plan = [("1", "価値観"), ("1", "価値観"), ("3", "出身地"), ("3", "誕生日"), ("3", "誕生日")]
+    assert build_topup_plan(full_plan, deficits) == [("3", "出身地"), ("3", "誕生日")]
+
+
+def test_find_sources_only_includes_planned_topup_rounds(tmp_path):
+    for name in ["batch_001.json", "batch_002.json", "batch_topup_01_001.json", "batch_topup_02_001.json", "batch_notes.json"]:
+        write_json(tmp_path / name, [])
+    write_json(tmp_path / "topup_01.plan.json", [])
+    assert [os.path.basename(path) for path in find_sources(str(tmp_path))] == [
+        "batch_001.json", "batch_002.json", "batch_topup_01_001.json"]
+    assert find_sources(str(tmp_path), source="merged.jsonl") == ["merged.jsonl"]
@@ -0,0 +1,186 @@
+# topup_planner.py
+
+import glob
+import json
+import os
+import sqlite3
+import struct
+from collections import Counter
+from merge_batches import validate_record
+
+
+class ScanCache:
+    """
+    バッチファイル・結合済みファイルを走査した結果（レコードごとのTier・カテゴリ・スキーマの問題点・MinHash署名）を
+    ファイル単位でSQLiteに保存するキャッシュ。サイズと更新時刻が変わっていないファイルは読み直さないため、
+    10万件を超えるデータセットでも、2回目以降の走査は署名の読み込みだけで済む。
+    """
+
+    def __init__(self, path, params):
+        self.path = path
+        self.params = json.dumps(params, sort_keys=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, params TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            " path TEXT NOT NULL, position INTEGER NOT NULL, tier INTEGER, category TEXT,"
+            " problems TEXT NOT NULL, signature BLOB, PRIMARY KEY (path, position))"
+        )
+        self._conn.commit()
+
+    def lookup(self, filepath):
+        """ファイルが前回の走査から変わっていなければ、キャッシュしたレコードの一覧を返す"""
+        stat = os.stat(filepath)
+        row = self._conn.execute("SELECT size, mtime_ns, params FROM files WHERE path = ?", (filepath,)).fetchone()
+        if row != (stat.st_size, stat.st_mtime_ns, self.params):
+            return None
+        rows = self._conn.execute(
+            "SELECT tier, category, problems, signature FROM records WHERE path = ? ORDER BY position", (filepath,)
+        )
+        return [(tier, category, json.loads(problems), _unpack(signature)) for tier, category, problems, signature in rows]
+
+    def store(self, filepath, stat, scanned):
+        self._conn.execute("DELETE FROM records WHERE path = ?", (filepath,))
+        self._conn.executemany(
+            "INSERT INTO records (path, position, tier, category, problems, signature) VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (filepath, position, tier, category, json.dumps(problems, ensure_ascii=False), _pack(signature))
+                for position, (tier, category, problems, signature) in enumerate(scanned)
+            ],
+        )
+        self._conn.execute(
+            "INSERT OR REPLACE INTO files (path, size, mtime_ns, params) VALUES (?, ?, ?, ?)",
+            (filepath, stat.st_size, stat.st_mtime_ns, self.params),
+        )
+        self._conn.commit()
+
+    def forget_others(self, filepaths):
+        """今回の走査対象に含まれないファイル（削除されたバッチなど）のキャッシュを取り除く"""
+        keep = set(filepaths)
+        stale = [(path,) for (path,) in self._conn.execute("SELECT path FROM files") if path not in keep]
+        self._conn.executemany("DELETE FROM records WHERE path = ?", stale)
+        self._conn.executemany("DELETE FROM files WHERE path = ?", stale)
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+def _pack(signature):
+    return None if signature is None else struct.pack(f"<{len(signature)}I", *signature)
+
+def _unpack(blob):
+    return None if blob is None else list(struct.unpack(f"<{len(blob) // 4}I", blob))
+
+
+def read_records(filepath):
+    """バッチファイル（JSON配列）、または結合済みのJSONLファイルのレコードを読む（壊れたファイルは0件）"""
+    with open(filepath, 'r', encoding='utf-8') as f:
+        if filepath.endswith(".jsonl"):
+            records = []
+            for line in f:
+                if line.strip():
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        records.append(None)
+            return records
+        try:
+            data = json.load(f)
+        except json.JSONDecodeError:
+            return []
+    return data if isinstance(data, list) else []
+
+
+def scan_file(filepath, dedup_index):
+    """1ファイル分のレコードを検証し、(Tier, カテゴリ, 問題点, 署名) のリストを返す"""
+    scanned = []
+    for record in read_records(filepath):
+        problems = validate_record(record)
+        if problems:
+            tier = record.get('tier') if isinstance(record, dict) else None
+            category = record.get('category') if isinstance(record, dict) else None
+            scanned.append((tier if isinstance(tier, int) else None, category if isinstance(category, str) else None, problems, None))
+        else:
+            scanned.append((record['tier'], record['category'], [], dedup_index.signature(record['answer'])))
+    return scanned
+
+
+def find_sources(batch_dir, source=None):
+    """
+    走査対象のファイル（source を指定した場合は結合済みファイルだけ）。
+    既定は本来のバッチファイル（batch_NNN.json）と、計画（topup_XX.plan.json）のある追加生成ラウンドのバッチファイル
+    （batch_topup_XX_NNN.json）で、計画の無いラウンドのファイルなど、それ以外の batch_*.json は数えない。
+    """
+    if source:
+        return [source]
+    sources = glob.glob(os.path.join(batch_dir, "batch_[0-9]*.json"))
+    for plan_file in glob.glob(os.path.join(batch_dir, "topup_*.plan.json")):
+        round_name = os.path.basename(plan_file)[:-len(".plan.json")]
+        sources += glob.glob(os.path.join(batch_dir, f"batch_{round_name}_[0-9]*.json"))
+    return sorted(sources)
+
+
+def assess_dataset(filepaths, dedup_index, cache=None):
+    """
+    既存のQAペアを走査し、(Tierとカテゴリごとの有効なレコード数, 内訳の統計) を返す。
+    スキーマ不正のレコードと、先に現れた回答と近似重複するレコードは数えない。
+    有効なレコードの署名は dedup_index に登録するため、追加生成でもこれらとの重複を却下できる。
+    """
+    counts = Counter()
+    stats = Counter()
+    for filepath in filepaths:
+        scanned = cache.lookup(filepath) if cache is not None else None
+        if scanned is None:
+            stat = os.stat(filepath)
+            scanned = scan_file(filepath, dedup_index)
+            stats["files_scanned"] += 1
+            if cache is not None:
+                cache.store(filepath, stat, scanned)
+        else:
+            stats["files_cached"] += 1
+        name = os.path.basename(filepath)
+        for position, (tier, category, problems, signature) in enumerate(scanned):
+            stats["records"] += 1
+            if problems:
+                stats["invalid"] += 1
+                continue
+            if dedup_index.check_and_add_signature(category, f"{name}:{position}", signature) is not None:
+                stats["duplicates"] += 1
+                continue
+            counts[(tier, category)] += 1
+    if cache is not None:
+        cache.forget_others(filepaths)
+    return counts, stats
+
+
+def compute_deficits(quotas, counts):
+    """Tierとカテゴリごとの不足数（目標数 − 有効なレコード数。超過分は0）"""
+    return Counter({key: quota - counts[key] for key, quota in quotas.items() if quota > counts[key]})
+
+
+def build_topup_plan(full_plan, deficits):
+    """
+    不足分だけを、全体計画と同じ並び（Tierごと・カテゴリの順繰り）で並べた追加生成の計画を作る
+    """
+    remaining = Counter(deficits)
+    plan = []
+    for tier, category in full_plan:
+        if remaining[(int(tier), category)] > 0:
+            remaining[(int(tier), category)] -= 1
+            plan.append((tier, category))
+    return plan
+
+
+def format_assessment(quotas, counts, stats, deficits):
+    lines = [
+        f"既存のQAペア: {stats['records']}件（有効 {sum(counts.values())}件 / スキーマ不正 {stats['invalid']}件 / "
+        f"近似重複 {stats['duplicates']}件） / 走査したファイル {stats['files_scanned']}個・キャッシュから読み込み {stats['files_cached']}個",
+        f"目標 {sum(quotas.values())}件に対する不足: 合計{sum(deficits.values())}件",
+    ]
+    for (tier, category), missing in sorted(deficits.items()):
+        lines.append(f"   - Tier{tier} {category}: {counts[(tier, category)]}/{quotas[(tier, category)]}件（不足 {missing}件）")
+    return "\n".join(lines)